@@ -0,0 +1,158 @@
+"""
+Benchmark of the cached appstc_paths table against the recursive view it replaced,
+on a generated complete tree. With the defaults, the tree has 100k nodes in 11
+levels. Runs in a scratch schema in a transaction that is rolled back.
+
+    python -m bench.appstc_paths --connstr postgresql+psycopg://... \\
+        [--nodes 100000] [--fanout 3] [--repeat 200]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import Connection, create_engine, text
+
+from src.model import AppStc_Paths
+
+SCHEMA = "bench_appstc_paths"
+
+VIEW = """
+    create view appstc_paths_view as
+    with recursive tree as (
+      select
+        appstc_id as id,
+        array[appstc_id] as id_path,
+        1 as depth
+      from appstc
+      where appstc_parent_appstc_id is null
+      union all
+      select
+        appstc_id,
+        id_path || array[appstc_id],
+        depth + 1
+      from appstc
+      join tree
+        on id = appstc_parent_appstc_id
+    )
+    select * from tree
+"""
+
+# The shapes of the queries used during authentication
+QUERIES = {
+    # Is the assigned node an ancestor of the requested one?
+    "ancestor": """
+        select exists (select 1 from {paths} where id = :id and :anc = any(id_path))
+    """,
+    # The "first" of the assigned nodes
+    "first": """
+        select id from {paths} where id = any(:ids) order by depth, id_path limit 1
+    """,
+}
+
+
+def timed(conn: Connection, sql: str, params: dict) -> float:
+    start = time.perf_counter()
+    conn.execute(text(sql), params).all()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connstr", required=True)
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = create_engine(args.connstr)
+    results: dict[str, float] = {}
+    with engine.connect() as conn:
+        conn.exec_driver_sql(f"create schema {SCHEMA}")
+        try:
+            conn.exec_driver_sql(f"set search_path to {SCHEMA}")
+            conn.exec_driver_sql(
+                """
+                create table appstc (
+                  appstc_id bigint primary key,
+                  appstc_name text not null,
+                  appstc_parent_appstc_id bigint
+                    references appstc on update cascade on delete cascade
+                );
+                create index on appstc (appstc_parent_appstc_id);
+                """
+            )
+            conn.exec_driver_sql(AppStc_Paths.ddl)
+            conn.exec_driver_sql(VIEW)
+
+            # Complete tree: Node i has parent (i - 2) / fanout + 1
+            start = time.perf_counter()
+            conn.execute(
+                text(
+                    """
+                    insert into appstc
+                    select
+                      i,
+                      'node ' || i,
+                      case when i > 1 then (i - 2) / :fanout + 1 end
+                    from generate_series(1, :nodes) i
+                    order by i
+                    """
+                ),
+                {"nodes": args.nodes, "fanout": args.fanout},
+            )
+            results["insert_seconds"] = time.perf_counter() - start
+            conn.exec_driver_sql("analyze appstc; analyze appstc_paths")
+            results["depth"] = conn.exec_driver_sql(
+                "select max(depth) from appstc_paths"
+            ).scalar_one()
+
+            # Deepest nodes and their ancestors
+            leaves = list(range(args.nodes // 2, args.nodes + 1))
+            rng = random.Random(0)
+            for name, query in QUERIES.items():
+                for paths in ("appstc_paths_view", "appstc_paths"):
+                    total = 0.0
+                    for _ in range(args.repeat):
+                        leaf = rng.choice(leaves)
+                        params = {
+                            "id": leaf,
+                            "anc": (leaf - 2) // args.fanout + 1,
+                            "ids": rng.sample(leaves, 5),
+                        }
+                        total += timed(conn, query.format(paths=paths), params)
+                    kind = "view" if paths.endswith("view") else "table"
+                    results[f"{name}_{kind}_ms"] = total / args.repeat * 1000
+
+            # Move the subtree of a node on the third level below its sibling
+            size = conn.exec_driver_sql(
+                "select count(*) from appstc_paths where id_path @> array[5::bigint]"
+            ).scalar_one()
+            start = time.perf_counter()
+            conn.exec_driver_sql(
+                "update appstc set appstc_parent_appstc_id = 6 where appstc_id = 5"
+            )
+            results["move_seconds"] = time.perf_counter() - start
+            results["moved_nodes"] = size
+            wrong = conn.exec_driver_sql(
+                """
+                select count(*)
+                from appstc_paths_view v
+                join appstc_paths t using (id)
+                where v.id_path <> t.id_path or v.depth <> t.depth
+                """
+            ).scalar_one()
+            if wrong:
+                raise RuntimeError(f"{wrong} paths differ from the view after move")
+        finally:
+            # Everything happened in one transaction, including creating the schema
+            conn.rollback()
+
+    for key, value in results.items():
+        print(f"{key:24} {value:12.3f}")
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Options and fixtures of the benchmarks in this directory. The database fixtures are
+the ones of the tests.
+
+    python -m pytest bench/endpoints.py [--bench-users 1000] [--bench-requests 200]
+        [--bench-output bench-results.json] ...
+"""
+
+import json
+import subprocess
+import time
+
+import pytest
+
+from src.tests.conftest import client, connstr, session  # noqa: F401
+
+from .generator import Dataset, generate
+
+OPTIONS = {
+    "users": 1000,
+    "apikeys": 1000,
+    "logins": 1000,
+    "depth": 6,
+    "fanout": 3,
+    "requests": 200,
+    "concurrency": 10,
+}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("bench")
+    for name, default in OPTIONS.items():
+        group.addoption(f"--bench-{name}", type=int, default=default)
+    group.addoption(
+        "--bench-output",
+        default="bench-results.json",
+        help="Where to write the results as JSON",
+    )
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+@pytest.fixture(scope="session")
+def bench_params(request) -> dict[str, int]:
+    return {name: request.config.getoption(f"bench_{name}") for name in OPTIONS}
+
+
+@pytest.fixture(scope="session")
+def bench_results(request, bench_params):
+    """
+    Collects the results of all benchmarks and writes them when the session ends
+    """
+    results: dict[str, dict] = {}
+    yield results
+    if not results:
+        return
+    with open(request.config.getoption("bench_output"), "w") as f:
+        json.dump(
+            {
+                "version": _version(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "params": bench_params,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+@pytest.fixture
+def dataset(client, session, bench_params) -> Dataset:  # noqa: F811
+    data = generate(
+        session.connection(),
+        users=bench_params["users"],
+        apikeys=bench_params["apikeys"],
+        logins=bench_params["logins"],
+        depth=bench_params["depth"],
+        fanout=bench_params["fanout"],
+    )
+    session.commit()
+    return data
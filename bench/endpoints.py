@@ -0,0 +1,184 @@
+"""
+Throughput and latency of the endpoints on a generated dataset (see generator.py),
+in both the sync and the async database mode. Requests are sent through the ASGI
+interface with the configured concurrency. The endpoints that only read are
+measured twice, first with empty caches and then with the same requests again.
+
+    python -m pytest bench/endpoints.py -s [options, see conftest.py]
+"""
+
+import asyncio
+import random
+import statistics
+import time
+from collections import Counter
+from typing import Any
+
+import httpx
+import pytest
+
+from src.app import app
+from src.dbsession import db, settings
+from src.stctree import stc_index
+from src.throttle import client_buckets, user_buckets
+
+from .generator import ADMIN_COOKIE, PASSWORD, Dataset
+
+# method, url, headers, json body
+Request = tuple[str, str, dict[str, str], Any]
+
+SAME_ORIGIN = {"sec-fetch-site": "same-origin"}
+READ_ONLY = {
+    "roles_cookie",
+    "roles_cookie_appstc",
+    "roles_apikey",
+    "roles_apikey_appstc",
+    "roles_tree",
+}
+
+
+def _requests(scenario: str, data: Dataset, count: int) -> list[Request]:
+    rng = random.Random(0)
+
+    def cookie(value: str) -> dict[str, str]:
+        return {"cookie": f"__user_cookie={value}"}
+
+    def appstc(scenario: str) -> str:
+        if scenario.endswith("_appstc"):
+            return f"?__appstc_id={rng.choice(data.appstc_ids)}"
+        return ""
+
+    if scenario == "login":
+        return [
+            (
+                "POST",
+                "/login",
+                SAME_ORIGIN,
+                {"username": f"user{rng.randint(1, data.users)}", "password": PASSWORD},
+            )
+            for _ in range(count)
+        ]
+    if scenario.startswith("roles_cookie"):
+        return [
+            ("GET", "/roles" + appstc(scenario), cookie(rng.choice(data.cookies)), None)
+            for _ in range(count)
+        ]
+    if scenario == "roles_tree":
+        return [
+            ("GET", "/roles/tree", cookie(rng.choice(data.cookies)), None)
+            for _ in range(count)
+        ]
+    if scenario.startswith("roles_apikey"):
+        return [
+            (
+                "GET",
+                "/roles" + appstc(scenario),
+                {"Authorization": rng.choice(data.apikeys)},
+                None,
+            )
+            for _ in range(count)
+        ]
+    if scenario == "logout":
+        # Each login can only be ended once
+        return [
+            ("POST", "/logout", {**SAME_ORIGIN, **cookie(value)}, None)
+            for value in rng.sample(data.cookies, min(count, len(data.cookies)))
+        ]
+    if scenario == "rotate_cookies":
+        # Each request rotates all logins
+        return [
+            (
+                "POST",
+                "/admin/rotate_cookies",
+                {**SAME_ORIGIN, **cookie(ADMIN_COOKIE)},
+                None,
+            )
+            for _ in range(max(2, count // 10))
+        ]
+    raise ValueError(scenario)
+
+
+async def _measure(
+    http: httpx.AsyncClient, requests: list[Request], concurrency: int
+) -> dict[str, Any]:
+    latencies: list[float] = []
+    statuses: Counter[int] = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(method: str, url: str, headers: dict[str, str], body: Any) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.request(method, url, headers=headers, json=body)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(*request) for request in requests))
+    seconds = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(requests),
+        "seconds": seconds,
+        "throughput": len(requests) / seconds,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "max_ms": max(latencies) * 1000,
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+    }
+
+
+async def _run(scenario: str, requests: list[Request], concurrency: int) -> dict:
+    # Fresh engines with pooling, unlike the tests
+    await db.dispose()
+    # The cookies are secure, so the client does not keep them for http
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://testserver"
+    ) as http:
+        try:
+            # Load the appstc index, so it is used like in production
+            deadline = time.monotonic() + 30
+            while stc_index.get() is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            result = {"cold": await _measure(http, requests, concurrency)}
+            if scenario in READ_ONLY:
+                result["warm"] = await _measure(http, requests, concurrency)
+            return result
+        finally:
+            await db.dispose()
+
+
+@pytest.mark.parametrize(
+    "scenario",
+    [
+        "login",
+        "roles_cookie",
+        "roles_cookie_appstc",
+        "roles_apikey",
+        "roles_apikey_appstc",
+        "roles_tree",
+        "logout",
+        "rotate_cookies",
+    ],
+)
+def test_endpoint(scenario, dataset, bench_params, bench_results, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "pooling", True)
+    monkeypatch.setattr(settings, "pool_check_interval", 0)
+    monkeypatch.setattr(settings, "stc_index", True)
+    # All requests come from one client
+    monkeypatch.setattr(client_buckets, "rate", 0)
+    monkeypatch.setattr(user_buckets, "rate", 0)
+    requests = _requests(scenario, dataset, bench_params["requests"])
+    result = asyncio.run(_run(scenario, requests, bench_params["concurrency"]))
+    mode = "async" if settings.async_db else "sync"
+    bench_results[f"{scenario}[{mode}]"] = result
+    for phase, numbers in result.items():
+        print(
+            f"\n{scenario:22} {mode:5} {phase:4} {numbers['throughput']:9.1f} req/s"
+            f"  p50 {numbers['p50_ms']:8.2f} ms  p99 {numbers['p99_ms']:8.2f} ms"
+            f"  {numbers['statuses']}"
+        )
+    assert all(
+        int(code) < 500 for numbers in result.values() for code in numbers["statuses"]
+    )
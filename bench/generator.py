@@ -0,0 +1,205 @@
+"""
+Synthetic data for benchmarks: A complete appstc tree, groups and permissions
+assigned to random nodes, users assigned to random nodes and permissions, API keys
+and active logins. Everything is inserted with set-based statements, so large
+datasets are created in seconds. Only one password and one API key secret are
+hashed, all users and keys share them.
+"""
+
+import random
+from dataclasses import dataclass, field
+
+from sqlalchemy import Connection, text
+
+from src.hashing import hash_password
+
+PASSWORD = "bench-password"
+SECRET = "bench-secret"
+ADMIN_COOKIE = "bench-admin"
+
+
+@dataclass
+class Dataset:
+    users: int
+    apikeys: list[str] = field(default_factory=list)
+    cookies: list[str] = field(default_factory=list)
+    appstc_ids: list[int] = field(default_factory=list)
+
+
+def generate(
+    conn: Connection,
+    users: int = 1000,
+    apikeys: int = 1000,
+    logins: int = 1000,
+    depth: int = 6,
+    fanout: int = 3,
+    perms: int = 50,
+    seed: int = 0,
+) -> Dataset:
+    """
+    Fill the database that has the schema and the root appstc, as created by the
+    tests. The caller commits. There is also an "admin" user with the role Admin on
+    the root, logged in with ADMIN_COOKIE.
+    """
+    rng = random.Random(seed)
+    conn.execute(text("select setseed(:seed)"), {"seed": rng.random()})
+
+    # The tree, one level at a time, so the parents have their paths already
+    for level in range(1, depth):
+        conn.execute(
+            text(
+                """
+                insert into appstc (appstc_name, appstc_parent_appstc_id)
+                select 'node ' || id || '.' || k, id
+                from appstc_paths, generate_series(1, :fanout) k
+                where depth = :level
+                order by id, k
+                """
+            ),
+            {"fanout": fanout, "level": level},
+        )
+
+    for sql in (
+        """
+        insert into appgroup (appgroup_zoperole)
+        select 'Role' || i from generate_series(1, :perms) i
+        """,
+        """
+        insert into appperm (appperm_name)
+        select 'Perm' || i from generate_series(1, :perms) i
+        """,
+        """
+        insert into apppermxgroup (apppermxgroup_appperm_id, apppermxgroup_appgroup_id)
+        select appperm_id, appgroup_id
+        from appperm
+        join appgroup
+          on substr(appgroup_zoperole, 5) = substr(appperm_name, 5)
+        """,
+        # Each permission on three random nodes. Referring to the outer row makes
+        # the subquery run for each of them.
+        """
+        insert into apppermxstc (apppermxstc_appperm_id, apppermxstc_appstc_id)
+        select appperm_id, node.id
+        from appperm
+        cross join lateral (
+          select id from appstc_paths
+          where appperm_id is not null
+          order by random() limit 3
+        ) node
+        """,
+    ):
+        conn.execute(text(sql), {"perms": perms})
+
+    # Users on two random nodes with five random permissions each
+    hashed = hash_password(PASSWORD)
+    for sql in (
+        """
+        insert into appuser (appuser_name, appuser_password)
+        select 'user' || i, :hashed from generate_series(1, :users) i
+        """,
+        """
+        insert into appuserxstc (appuserxstc_appuser_id, appuserxstc_appstc_id)
+        select appuser_id, node.id
+        from appuser
+        cross join lateral (
+          select id from appstc_paths
+          where appuser_id is not null
+          order by random() limit 2
+        ) node
+        """,
+        """
+        insert into appuserxperm (appuserxperm_appuser_id, appuserxperm_appperm_id)
+        select appuser_id, perm.appperm_id
+        from appuser
+        cross join lateral (
+          select appperm_id from appperm
+          where appuser_id is not null
+          order by random() limit 5
+        ) perm
+        """,
+    ):
+        conn.execute(text(sql), {"users": users, "hashed": hashed})
+
+    # API keys and logins of random users
+    names = [f"user{i}" for i in range(1, users + 1)]
+    key_hash = hash_password(SECRET)
+    conn.execute(
+        text(
+            """
+            insert into appuserkey (
+              appuserkey_appuser_id, appuserkey_key, appuserkey_ident
+            )
+            select appuser_id, 'key' || n || '-' || :key_hash, 'key' || n
+            from unnest(cast(:names as text[])) with ordinality as t(name, n)
+            join appuser on appuser_name = name
+            """
+        ),
+        {"names": rng.choices(names, k=apikeys), "key_hash": key_hash},
+    )
+    conn.execute(
+        text(
+            """
+            insert into appuserlogin (appuserlogin_appuser_id, appuserlogin_cookie)
+            select appuser_id, 'cookie' || n
+            from unnest(cast(:names as text[])) with ordinality as t(name, n)
+            join appuser on appuser_name = name
+            """
+        ),
+        {"names": rng.choices(names, k=logins)},
+    )
+
+    conn.execute(
+        text(
+            """
+            with usr as (
+              insert into appuser (appuser_name, appuser_password)
+              values ('admin', :hashed)
+              returning appuser_id
+            ),
+            grp as (
+              insert into appgroup (appgroup_zoperole) values ('Admin')
+              returning appgroup_id
+            ),
+            perm as (
+              insert into appperm (appperm_name) values ('Admin')
+              returning appperm_id
+            ),
+            root as (
+              select id from appstc_paths where depth = 1
+            ),
+            _xgroup as (
+              insert into apppermxgroup (
+                apppermxgroup_appperm_id, apppermxgroup_appgroup_id
+              )
+              select appperm_id, appgroup_id from perm, grp
+            ),
+            _xstc as (
+              insert into apppermxstc (apppermxstc_appperm_id, apppermxstc_appstc_id)
+              select appperm_id, id from perm, root
+            ),
+            _xperm as (
+              insert into appuserxperm (
+                appuserxperm_appuser_id, appuserxperm_appperm_id
+              )
+              select appuser_id, appperm_id from usr, perm
+            ),
+            _ustc as (
+              insert into appuserxstc (appuserxstc_appuser_id, appuserxstc_appstc_id)
+              select appuser_id, id from usr, root
+            )
+            insert into appuserlogin (appuserlogin_appuser_id, appuserlogin_cookie)
+            select appuser_id, :cookie from usr
+            """
+        ),
+        {"hashed": hashed, "cookie": ADMIN_COOKIE},
+    )
+
+    appstc_ids = list(
+        conn.execute(text("select id from appstc_paths order by id")).scalars()
+    )
+    return Dataset(
+        users=users,
+        apikeys=[f"Apikey key{i}-{SECRET}" for i in range(1, apikeys + 1)],
+        cookies=[f"cookie{i}" for i in range(1, logins + 1)],
+        appstc_ids=appstc_ids,
+    )
@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the per-request overhead of DBSessionMiddleware and
+SameSitePostMiddleware. Compares the BaseHTTPMiddleware implementations they
+replaced with the pure ASGI ones on an endpoint that does nothing. Uses an in-memory
+SQLite engine that is never queried, so only the middleware itself is measured.
+
+    python -m bench.middleware [--requests N]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+
+from src.auth import SameSitePostMiddleware
+from src.dbsession import DBSessionMiddleware, close, commit, db, rollback, settings
+
+
+class LegacyDBSessionMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        request.state.db = db.session()
+        try:
+            response = await call_next(request)
+            await commit(request.state.db)
+        except Exception:
+            await rollback(request.state.db)
+            raise
+        finally:
+            await close(request.state.db)
+        return response
+
+
+class LegacySameSitePostMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        if request.method in ("POST", "PUT", "PATCH"):
+            if request.headers.get("sec-fetch-site") != "same-origin":
+                return JSONResponse(
+                    status_code=401,
+                    content={"detail": f"Unauthorized: cross-site {request.method}"},
+                )
+        return await call_next(request)
+
+
+def make_app(*middlewares) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/")
+    async def endpoint() -> bool:
+        return True
+
+    for middleware in middlewares:
+        app.add_middleware(middleware)
+    return app
+
+
+async def run(app: FastAPI, requests: int) -> float:
+    """
+    Send requests directly through the ASGI interface and return the mean time per
+    request in microseconds
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"sec-fetch-site", b"same-origin")],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(min(requests, 1000)):  # Warm-up
+        await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    settings.connstr = "sqlite://"
+    settings.async_db = False
+    settings.pool_check_interval = 0
+
+    apps = {
+        "none": make_app(),
+        "basehttp": make_app(LegacyDBSessionMiddleware, LegacySameSitePostMiddleware),
+        "asgi": make_app(DBSessionMiddleware, SameSitePostMiddleware),
+    }
+    results = {name: asyncio.run(run(app, args.requests)) for name, app in apps.items()}
+    for name, us in results.items():
+        print(
+            f"{name:10} {us:8.1f} us/request, "
+            f"overhead {us - results['none']:8.1f} us/request"
+        )
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
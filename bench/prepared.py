@@ -0,0 +1,126 @@
+"""
+Savings from server-side prepared statements (settings.prepare_threshold) for the
+statements of the authentication phase. Each statement is executed on a single
+connection with psycopg's prepare_threshold None, so it is parsed and planned every
+time, and 0, so it is prepared on first use. The time per execution of both is
+compared with the planning time EXPLAIN (SUMMARY) reports for the statement.
+
+    python -m pytest bench/prepared.py -s [options, see conftest.py]
+"""
+
+import random
+import statistics
+import time
+from typing import Any, Optional
+
+import pytest
+from sqlalchemy import Connection, bindparam, create_engine, select
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.pool import NullPool
+
+from src.auth import _AUTH_READ_QUERY
+from src.model import AppUserKey
+
+from .generator import Dataset
+
+# A statement and its parameters
+Case = tuple[Any, dict[str, Any]]
+
+_CANDIDATES = (
+    select(AppUserKey)
+    .join(AppUserKey.appuser)
+    .options(contains_eager(AppUserKey.appuser))
+    .where(AppUserKey.ident == bindparam("ident"))
+)
+
+
+def _cases(statement: str, data: Dataset, count: int) -> list[Case]:
+    rng = random.Random(0)
+    if statement == "auth_cookie":
+        return [
+            (
+                _AUTH_READ_QUERY,
+                {
+                    "cookie": rng.choice(data.cookies),
+                    "appuser_id": None,
+                    "appstc_id": None,
+                },
+            )
+            for _ in range(count)
+        ]
+    if statement == "auth_cookie_appstc":
+        return [
+            (
+                _AUTH_READ_QUERY,
+                {
+                    "cookie": rng.choice(data.cookies),
+                    "appuser_id": None,
+                    "appstc_id": rng.choice(data.appstc_ids),
+                },
+            )
+            for _ in range(count)
+        ]
+    if statement == "apikey_candidates":
+        return [
+            (_CANDIDATES, {"ident": rng.choice(data.apikeys).split()[1].split("-")[0]})
+            for _ in range(count)
+        ]
+    raise ValueError(statement)
+
+
+def _connect(connstr: str, threshold: Optional[int]) -> Connection:
+    engine = create_engine(
+        connstr, poolclass=NullPool, connect_args={"prepare_threshold": threshold}
+    )
+    return engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+
+def _measure(conn: Connection, cases: list[Case]) -> float:
+    """
+    Median milliseconds per execution, after running a few to warm up
+    """
+    for statement, params in cases[:10]:
+        conn.execute(statement, params).all()
+    times = []
+    for statement, params in cases:
+        start = time.perf_counter()
+        conn.execute(statement, params).all()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def _planning(conn: Connection, cases: list[Case]) -> float:
+    """
+    Median planning time in milliseconds as reported by EXPLAIN
+    """
+    times = []
+    for statement, params in cases[:50]:
+        sql = str(statement.compile(conn))
+        plan = conn.exec_driver_sql(
+            f"explain (summary, format json) {sql}", params
+        ).scalar_one()
+        times.append(plan[0]["Planning Time"])
+    return statistics.median(times)
+
+
+@pytest.mark.parametrize(
+    "statement", ["auth_cookie", "auth_cookie_appstc", "apikey_candidates"]
+)
+def test_prepared(statement, connstr, dataset, bench_params, bench_results) -> None:
+    cases = _cases(statement, dataset, bench_params["requests"])
+    with _connect(connstr, None) as conn:
+        unprepared = _measure(conn, cases)
+        planning = _planning(conn, cases)
+    with _connect(connstr, 0) as conn:
+        prepared = _measure(conn, cases)
+    bench_results[f"prepared:{statement}"] = {
+        "executions": len(cases),
+        "unprepared_ms": unprepared,
+        "prepared_ms": prepared,
+        "saved_ms": unprepared - prepared,
+        "planning_ms": planning,
+    }
+    print(
+        f"\n{statement:20} unprepared {unprepared:7.3f} ms  prepared {prepared:7.3f}"
+        f" ms  saved {unprepared - prepared:7.3f} ms  planning {planning:7.3f} ms"
+    )
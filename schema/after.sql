@@ -23,13 +23,61 @@ create unique index if not exists apppermxgroup_appgroup_id_appperm_id on appper
 alter table appuserlogin alter column appuserlogin_appuser_id set not null;
 select db_create_fk_constraint('appuserlogin', 'appuser');
 create index if not exists appuserlogin_appuser_id on appuserlogin (appuserlogin_appuser_id);
-create index if not exists appuserlogin_cookie on appuserlogin (appuserlogin_cookie);
-create index if not exists appuserlogin_nextcookie on appuserlogin (appuserlogin_nextcookie);
+-- Lookups by cookie, the cookie rotation and the expiry only consider logins that
+-- are not done, so their indexes only cover those and stay sized to the active
+-- sessions. Ended logins are found for deletion by their own index, which is
+-- bounded by the retention (see src/retention.py).
+drop index if exists appuserlogin_cookie;
+drop index if exists appuserlogin_nextcookie;
+create index if not exists appuserlogin_active_cookie on appuserlogin (appuserlogin_cookie) where not appuserlogin_done;
+create index if not exists appuserlogin_active_nextcookie on appuserlogin (appuserlogin_nextcookie) where not appuserlogin_done;
+create index if not exists appuserlogin_active_id on appuserlogin (appuserlogin_id) where not appuserlogin_done;
+create index if not exists appuserlogin_active_createtime on appuserlogin (appuserlogin_createtime) where not appuserlogin_done;
+-- The end of a login is recorded when it is done, as the model does (see
+-- AppUserLogin in src/model.py). The retention of ended logins counts from then.
+create or replace function appuserlogin_set_endtime()
+returns trigger
+language plpgsql
+as $function$
+begin
+  if new.appuserlogin_done and new.appuserlogin_endtime is null then
+    new.appuserlogin_endtime = now();
+  end if;
+  return new;
+end;
+$function$;
+create or replace trigger appuserlogin_set_endtime
+  before insert or update of appuserlogin_done on appuserlogin
+  for each row execute function appuserlogin_set_endtime();
+update appuserlogin
+   set appuserlogin_endtime = appuserlogin_modtime
+ where appuserlogin_done and appuserlogin_endtime is null;
+drop index if exists appuserlogin_done_createtime;
+create index if not exists appuserlogin_done_endtime on appuserlogin (appuserlogin_endtime) where appuserlogin_done;
 
 alter table appuserkey alter column appuserkey_appuser_id set not null;
 select db_create_fk_constraint('appuserkey', 'appuser');
 create index if not exists appuserkey_appuser_id on appuserkey (appuserkey_appuser_id);
-create index if not exists appuserkey_key on appuserkey (appuserkey_key);
+-- The ident is the part of the key before the first dash. It is kept in its own
+-- column so finding the candidates for an API key can use an index. Keys are only
+-- looked up by it, so the index on the whole key is not needed.
+drop index if exists appuserkey_key;
+create or replace function appuserkey_set_ident()
+returns trigger
+language plpgsql
+as $function$
+begin
+  new.appuserkey_ident = split_part(new.appuserkey_key, '-', 1);
+  return new;
+end;
+$function$;
+create or replace trigger appuserkey_set_ident
+  before insert or update of appuserkey_key on appuserkey
+  for each row execute function appuserkey_set_ident();
+update appuserkey
+   set appuserkey_ident = split_part(appuserkey_key, '-', 1)
+ where appuserkey_ident is distinct from split_part(appuserkey_key, '-', 1);
+create index if not exists appuserkey_ident on appuserkey (appuserkey_ident);
 
 alter table appstc alter column appstc_name set not null;
 select db_create_fk_constraint('appstc', 'appstc', 'parent');
@@ -37,6 +85,108 @@ create index if not exists appstc_parent_appstc_id on appstc (appstc_parent_apps
 create unique index appstc_name_root on appstc (appstc_name) where appstc_parent_appstc_id is null;
 create unique index appstc_parent_appstc_id_name on appstc (appstc_parent_appstc_id, appstc_name);
 
+-- Cached paths of appstc, replacing the recursive view. Same as the DDL of
+-- AppStc_Paths in src/model.py.
+do $$
+begin
+  if exists (select 1 from pg_views where viewname = 'appstc_paths') then
+    drop view appstc_paths;
+  end if;
+end;
+$$;
+create table if not exists appstc_paths (
+  id bigint primary key references appstc (appstc_id)
+    on update cascade on delete cascade,
+  id_path bigint[] not null,
+  depth integer not null
+);
+create index if not exists appstc_paths_id_path
+  on appstc_paths using gin (id_path);
+
+create or replace function appstc_paths_insert()
+returns trigger
+language plpgsql
+as $function$
+declare
+  parent_path bigint[] := '{}';
+begin
+  if new.appstc_parent_appstc_id is not null then
+    select id_path into strict parent_path
+    from appstc_paths
+    where id = new.appstc_parent_appstc_id;
+  end if;
+  insert into appstc_paths (id, id_path, depth)
+  values (
+    new.appstc_id,
+    parent_path || new.appstc_id,
+    cardinality(parent_path) + 1
+  );
+  return null;
+end;
+$function$;
+
+create or replace function appstc_paths_move()
+returns trigger
+language plpgsql
+as $function$
+declare
+  old_path bigint[];
+  new_path bigint[] := '{}';
+begin
+  select id_path into strict old_path
+  from appstc_paths
+  where id = new.appstc_id;
+  if new.appstc_parent_appstc_id is not null then
+    select id_path into strict new_path
+    from appstc_paths
+    where id = new.appstc_parent_appstc_id;
+    if new_path @> array[new.appstc_id] then
+      raise exception 'Can not move appstc % below itself', new.appstc_id;
+    end if;
+  end if;
+  new_path := new_path || new.appstc_id;
+  -- The old path of the moved node is a prefix of all paths in its subtree
+  update appstc_paths
+  set
+    id_path = new_path || id_path[cardinality(old_path) + 1:],
+    depth = depth - cardinality(old_path) + cardinality(new_path)
+  where id_path @> array[new.appstc_id];
+  return null;
+end;
+$function$;
+
+create or replace trigger appstc_paths_insert
+  after insert on appstc
+  for each row execute function appstc_paths_insert();
+create or replace trigger appstc_paths_move
+  after update of appstc_parent_appstc_id on appstc
+  for each row
+  when (
+    old.appstc_parent_appstc_id is distinct from new.appstc_parent_appstc_id
+  )
+  execute function appstc_paths_move();
+-- Fill with the paths of all nodes that already exist
+insert into appstc_paths (id, id_path, depth)
+with recursive tree as (
+  select
+    appstc_id as id,
+    array[appstc_id] as id_path,
+    1 as depth
+  from appstc
+  where appstc_parent_appstc_id is null
+  union all
+  select
+    appstc_id,
+    id_path || array[appstc_id],
+    depth + 1
+  from appstc
+  join tree
+    on id = appstc_parent_appstc_id
+)
+select * from tree
+on conflict (id) do update
+set id_path = excluded.id_path, depth = excluded.depth;
+
 alter table appuserxstc alter column appuserxstc_appuser_id set not null;
 alter table appuserxstc alter column appuserxstc_appstc_id set not null;
 select db_create_fk_constraint('appuserxstc', 'appuser');
@@ -52,3 +202,165 @@ select db_create_fk_constraint('apppermxstc', 'appstc');
 create index if not exists apppermxstc_appperm_id on apppermxstc (apppermxstc_appperm_id);
 create index if not exists apppermxstc_appstc_id on apppermxstc (apppermxstc_appstc_id);
 create unique index if not exists apppermxstc_appperm_id_appstc_id on apppermxstc (apppermxstc_appperm_id, apppermxstc_appstc_id);
+
+-- Notify the app about changes that invalidate its cached API keys and roles,
+-- see src/listener.py. Same as TRIGGERS there.
+create or replace function auth_notify()
+returns trigger
+language plpgsql
+as $function$
+begin
+  perform pg_notify('auth_invalidate', tg_table_name);
+  return null;
+end;
+$function$;
+
+do $$
+declare
+  tbl text;
+begin
+  foreach tbl in array array[
+    'appuserkey', 'appgroup', 'apppermxgroup', 'appuserxperm', 'apppermxstc',
+    'appuserxstc', 'appstc'
+  ] loop
+    execute
+      'create or replace trigger ' || quote_ident(tbl || '_auth_notify')
+      || ' after insert or update or delete or truncate on ' || quote_ident(tbl)
+      || ' for each statement execute function auth_notify()';
+  end loop;
+end;
+$$;
+-- Of a user, the caches only hold the name. Other changes, like a password hashed
+-- again on login, must not clear them.
+create or replace trigger appuser_auth_notify
+after update of appuser_name or delete or truncate on appuser
+for each statement execute function auth_notify();
+
+-- Ended logins are dropped from the login caches of all workers
+create or replace function appuserlogin_notify_done()
+returns trigger
+language plpgsql
+as $function$
+begin
+  perform pg_notify('auth_invalidate', 'appuserlogin:' || new.appuserlogin_id);
+  return null;
+end;
+$function$;
+
+create or replace trigger appuserlogin_notify_done
+after update of appuserlogin_done on appuserlogin
+for each row
+when (new.appuserlogin_done and not old.appuserlogin_done)
+execute function appuserlogin_notify_done();
+
+alter table appcookierotation alter column appcookierotation_until_id set not null;
+
+-- Default appstc of each user. Same as the DDL of AppUser_DefaultStc in
+-- src/model.py.
+create table if not exists appuser_defaultstc (
+  id bigint primary key references appuser (appuser_id)
+    on update cascade on delete cascade,
+  appstc_id bigint not null
+);
+
+-- Recompute the default appstc of the given users. An upsert, as concurrent
+-- transactions can refresh the same user.
+create or replace function appuser_defaultstc_refresh(users bigint[])
+returns void
+language sql
+as $function$
+  insert into appuser_defaultstc (id, appstc_id)
+  select distinct on (appuserxstc_appuser_id)
+    appuserxstc_appuser_id,
+    appuserxstc_appstc_id
+  from appuserxstc
+  join appstc_paths
+    on id = appuserxstc_appstc_id
+  where appuserxstc_appuser_id = any(users)
+  order by appuserxstc_appuser_id, depth, id_path
+  on conflict (id) do update
+  set appstc_id = excluded.appstc_id
+  where appuser_defaultstc.appstc_id <> excluded.appstc_id;
+  delete from appuser_defaultstc
+  where
+    id = any(users)
+    and not exists (
+      select from appuserxstc
+      where appuserxstc_appuser_id = appuser_defaultstc.id
+    );
+$function$;
+
+-- Statement level, so changing many assignments at once refreshes each user
+-- once. Only the transition tables of the operation are referenced.
+create or replace function appuser_defaultstc_assign()
+returns trigger
+language plpgsql
+as $function$
+begin
+  if tg_op = 'INSERT' then
+    perform appuser_defaultstc_refresh(array(
+      select distinct appuserxstc_appuser_id from new_rows
+    ));
+  elsif tg_op = 'DELETE' then
+    perform appuser_defaultstc_refresh(array(
+      select distinct appuserxstc_appuser_id from old_rows
+    ));
+  else
+    perform appuser_defaultstc_refresh(array(
+      select appuserxstc_appuser_id from old_rows
+      union
+      select appuserxstc_appuser_id from new_rows
+    ));
+  end if;
+  return null;
+end;
+$function$;
+
+-- Moving a node changes the paths of its subtree and thereby the order
+create or replace function appuser_defaultstc_move()
+returns trigger
+language plpgsql
+as $function$
+begin
+  perform appuser_defaultstc_refresh(array(
+    select distinct appuserxstc_appuser_id
+    from appuserxstc
+    join new_rows
+      on new_rows.id = appuserxstc_appstc_id
+    join old_rows
+      on old_rows.id = new_rows.id
+    where old_rows.id_path is distinct from new_rows.id_path
+  ));
+  return null;
+end;
+$function$;
+
+-- A trigger with transition tables can only have one event
+create or replace trigger appuser_defaultstc_assign
+  after insert on appuserxstc
+  referencing new table as new_rows
+  for each statement execute function appuser_defaultstc_assign();
+create or replace trigger appuser_defaultstc_reassign
+  after update on appuserxstc
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function appuser_defaultstc_assign();
+create or replace trigger appuser_defaultstc_unassign
+  after delete on appuserxstc
+  referencing old table as old_rows
+  for each statement execute function appuser_defaultstc_assign();
+create or replace trigger appuser_defaultstc_move
+  after update on appstc_paths
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function appuser_defaultstc_move();
+-- Fill for all users
+select appuser_defaultstc_refresh(array(select appuser_id from appuser));
+
+-- Token buckets shared by all workers, see src/throttle.py. Same as the DDL of
+-- AppThrottle in src/model.py.
+create unlogged table if not exists appthrottle (
+  key text primary key,
+  tokens float8 not null,
+  rate float8 not null,
+  burst float8 not null,
+  updated timestamptz not null
+);
@@ -1,8 +1,11 @@
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Annotated, Optional
 
-from fastapi import FastAPI, Request, Response, status
+from fastapi import BackgroundTasks, FastAPI, Query, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy import func, not_, or_, select, update
+from sqlalchemy import not_, or_, select
+from starlette.concurrency import run_in_threadpool
 
 from .auth import (
     COOKIE,
@@ -10,16 +13,63 @@ from .auth import (
     LoginCookieDep,
     SameSitePostMiddleware,
     add_403_to_openapi,
+    forget_login,
     require_roles,
 )
-from .dbsession import DBSession, DBSessionMiddleware
+from .dbsession import DBSession, DBSessionMiddleware, db, execute
+from .hashing import HashingOverloaded, executor
+from .listener import listener
+from .metrics import render, render_gauge
 from .model import AppUserLogin
-
-app = FastAPI()
+from .retention import retention_scheduler
+from .rotation import rotation_scheduler, run_rotation, start_rotation
+from .throttle import Throttled, admit, failed
+from .treeroles import tree_roles
+from .warmup import readiness
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    readiness.start()
+    rotation_scheduler.start()
+    retention_scheduler.start()
+    yield
+    readiness.stop()
+    rotation_scheduler.stop()
+    retention_scheduler.stop()
+    await run_in_threadpool(listener.stop)
+    await db.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(DBSessionMiddleware)
 app.add_middleware(SameSitePostMiddleware)
 
 
+@app.exception_handler(HashingOverloaded)
+async def hashing_overloaded(request: Request, exc: HashingOverloaded) -> Response:
+    """
+    Fail fast if too many password or key verifications are already queued
+    """
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Service overloaded, try again later"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(Throttled)
+async def throttled(request: Request, exc: Throttled) -> Response:
+    """
+    Reject attempts to verify a password or key beyond the configured rates
+    """
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many attempts, try again later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 class Credentials(BaseModel):
     """
     Username and password sent to /login
@@ -34,6 +84,7 @@ class Credentials(BaseModel):
     responses={
         200: {"model": bool, "description": "Login successful, cookie set"},
         401: {"model": bool, "description": "Login failed"},
+        429: {"description": "Too many attempts for the username or client"},
     },
 )
 async def login(
@@ -42,10 +93,12 @@ async def login(
     response: Response,
     request: Request,
 ) -> bool:
-    login: Optional[AppUserLogin] = AppUserLogin.login(
+    await admit(request, creds.username)
+    login: Optional[AppUserLogin] = await AppUserLogin.login(
         session, creds.username, creds.password
     )
     if login is None:
+        await failed(creds.username)
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return False
     if not login.cookie:
@@ -65,19 +118,23 @@ async def login(
 async def logout(
     user: Auth, session: DBSession, cookie: LoginCookieDep, response: Response
 ) -> None:
-    login = session.execute(
-        select(AppUserLogin).where(
-            or_(
-                AppUserLogin.cookie == cookie,
-                AppUserLogin.nextcookie == cookie,
+    login = (
+        await execute(
+            session,
+            select(AppUserLogin).where(
+                or_(
+                    AppUserLogin.cookie == cookie,
+                    AppUserLogin.nextcookie == cookie,
+                ),
+                not_(AppUserLogin.done),
             ),
-            not_(AppUserLogin.done),
         )
     ).scalar_one_or_none()
     if login:
         login.done = True
         login.cookie = None
         login.nextcookie = None
+        forget_login(login.id, session)
     response.delete_cookie(COOKIE)
 
 
@@ -92,18 +149,90 @@ async def roles(user: Auth, response: Response) -> list[str]:
     return user.roles
 
 
+class AppstcRoles(BaseModel):
+    """
+    Roles of the user in one appstc, as returned by /roles/tree
+    """
+
+    appstc_id: int
+    roles: list[str]
+
+
+@app.get(
+    "/roles/tree",
+    response_class=StreamingResponse,
+    responses={
+        200: {"model": list[AppstcRoles], "description": "Roles per appstc"},
+        401: {"model": list, "description": "Not logged in"},
+    },
+)
+async def roles_tree(
+    user: Auth, ids: Annotated[Optional[list[int]], Query()] = None
+) -> Response:
+    """
+    Return the roles the user has in each appstc it can access, or only in those of
+    them given by `ids`. The response is streamed, since the tree can be large.
+    """
+    if user is None:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+    return StreamingResponse(tree_roles(user.id, ids), media_type="application/json")
+
+
 @app.post("/admin/rotate_cookies", status_code=status.HTTP_204_NO_CONTENT)
 @require_roles("Admin")
-async def rotate_cookies(session: DBSession) -> None:
+async def rotate_cookies(session: DBSession, background_tasks: BackgroundTasks) -> None:
+    """
+    Start rotating the cookies of all logins. The rotation runs in batches after the
+    response is sent (see rotation.py), usually it is rather done periodically.
+    """
+    await start_rotation(session)
+    background_tasks.add_task(run_rotation)
+
+
+@app.get("/admin/pool")
+@require_roles("Admin")
+async def pool() -> dict[str, dict[str, float]]:
+    """
+    State of the connection pools (checked out connections, overflow) and counters
+    of checkouts, timeouts and the time spent waiting for a connection
     """
-    Something that would usually rather be done periodically and can not be triggered
-    manually. Just to demonstrate require_roles.
+    return db.pool_status()
+
+
+@app.get(
+    "/ready",
+    responses={503: {"model": bool, "description": "Still warming up"}},
+    include_in_schema=False,
+)
+async def ready(response: Response) -> bool:
+    """
+    Whether the worker is warmed up (see warmup.py) and not shutting down, for the
+    readiness check of a load balancer
+    """
+    if not readiness.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return readiness.ready
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics() -> str:
+    """
+    Histograms of the request timings and the state of the pools and the hashing
+    executor, in the Prometheus text format
     """
-    session.execute(
-        update(AppUserLogin)
-        .where(not_(AppUserLogin.done))
-        .values(nextcookie=func.uuidv4())
+    parts = [render()]
+    for mode, pool_state in db.pool_status().items():
+        parts.append(
+            render_gauge(
+                f"auth_pool_{mode}", "State of the connection pool", "key", pool_state
+            )
+        )
+    parts.append(
+        render_gauge(
+            "auth_hashing", "Hashing executor", "key", {"pending": executor.pending}
+        )
     )
+    return "\n".join(parts) + "\n"
 
 
 add_403_to_openapi(app)
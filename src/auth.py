@@ -1,24 +1,43 @@
 import inspect
+import json
+import logging
 from dataclasses import dataclass
 from functools import wraps
-from typing import Annotated, Callable, Optional, TypeVar
+from itertools import chain
+from typing import Annotated, Awaitable, Callable, Optional, TypeVar
 
-from fastapi import Depends, HTTPException, Query, Response, status
+from fastapi import Depends, HTTPException, Query, Request, Response, status
 from fastapi.routing import APIRoute
 from fastapi.security import APIKeyCookie, APIKeyHeader
 from pydantic import BaseModel, Field
-from sqlalchemy import any_, not_, or_, select, text
-from starlette.middleware.base import BaseHTTPMiddleware
+from sqlalchemy import Row, event, exc, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import ORMExecuteState, Session, UOWTransaction
+from sqlalchemy.orm.attributes import get_history
+from starlette.datastructures import Headers
 from starlette.responses import JSONResponse
-
-from .dbsession import DBSession
-from .model import (
-    AppStc_Paths,
-    AppUser,
-    AppUserKey,
-    AppUserLogin,
-    AppUserXStc,
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .cache import Cache, TTLCache, digest, make_cache
+from .dbsession import (
+    AnySession,
+    DBSession,
+    autocommit,
+    close,
+    commit,
+    db,
+    execute,
+    settings,
 )
+from .listener import listener
+from .metrics import timed
+from .model import AppUser, AppUserKey
+from .roles import AllOf, Requirement, compile_requirement, registry
+from .stctree import StcTree, stc_index
+from .throttle import admit
+from .throttle import clear as clear_throttle
+
+logger = logging.getLogger(__name__)
 
 COOKIE = "__user_cookie"
 
@@ -47,71 +66,436 @@ class AuthInfo:
     Authentication information for the current user
     """
 
+    id: int
     name: str
-    roles: list[str]
+    # The roles of the user in the active appstc, see roles.py
+    role_mask: int
+
+    @property
+    def roles(self) -> list[str]:
+        return registry.names(self.role_mask)
+
+
+@dataclass(frozen=True)
+class UserRef:
+    """
+    The authenticated user, detached from any ORM session
+    """
+
+    id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class _ApikeyEntry:
+    appuserkey_id: int
+    user: UserRef
+
+
+@dataclass(frozen=True)
+class _LoginEntry:
+    appuserlogin_id: int
+    user: UserRef
+
+
+# Maps the digest of a verified API key to the key row and its user
+_apikey_cache: TTLCache[bytes, _ApikeyEntry] = TTLCache(
+    settings.apikey_cache_size, settings.apikey_cache_ttl
+)
+
+
+def _encode_login(entry: _LoginEntry) -> bytes:
+    return json.dumps([entry.appuserlogin_id, entry.user.id, entry.user.name]).encode()
+
+
+def _decode_login(data: bytes) -> _LoginEntry:
+    appuserlogin_id, user_id, name = json.loads(data)
+    return _LoginEntry(appuserlogin_id, UserRef(user_id, name))
+
+
+# The caches below are shared by the processes of the host if configured (see
+# cache.make_cache), so their values are converted to bytes for that. Role masks
+# mean the same in all of them then (see roles.RoleRegistry) and are stored as is.
+# Maps the digest of a login cookie to its login. Only cookies of logins without a
+# pending nextcookie are cached, so the cookie to send back is always the one the
+# user sent and no cookie is held in the cache. A nextcookie sent by the user is
+# rotated in the database and cached after that.
+_login_cache: Cache[bytes, _LoginEntry] = make_cache(
+    "login",
+    settings.login_cache_size,
+    settings.login_cache_ttl,
+    _encode_login,
+    _decode_login,
+    tag=lambda entry: entry.appuserlogin_id,
+)
+# Maps (appuser_id, appstc_id) to the mask of the roles the user has in that appstc
+_roles_cache: Cache[tuple[int, int], int] = make_cache(
+    "roles",
+    settings.roles_cache_size,
+    settings.roles_cache_ttl,
+    lambda mask: mask.to_bytes((mask.bit_length() + 7) // 8, "little"),
+    lambda data: int.from_bytes(data, "little"),
+)
+# Maps appuser_id to the appstc_ids the user is assigned to (appuserxstc)
+_assignments_cache: Cache[int, frozenset[int]] = make_cache(
+    "assignments",
+    settings.roles_cache_size,
+    settings.roles_cache_ttl,
+    lambda ids: json.dumps(sorted(ids)).encode(),
+    lambda data: frozenset(json.loads(data)),
+)
+# Tables whose changes might change the roles of a user
+_ROLES_TABLES = {
+    "appgroup",
+    "apppermxgroup",
+    "appuserxperm",
+    "apppermxstc",
+    "appuserxstc",
+    "appstc",
+}
+
+
+def _on_notify(payload: Optional[str]) -> None:
+    """
+    Invalidate caches when the database notifies about changes. The payload is the
+    name of the changed table, for appuserlogin optionally followed by ":" and the
+    IDs of logins that were ended or rotated, separated by ",".
+    """
+    table, _, row_id = (payload or "").partition(":")
+    everything = payload is None
+    if everything or table in ("appuser", "appuserkey"):
+        _apikey_cache.clear()
+    if everything or table == "appuser" or payload == "appuserlogin":
+        _login_cache.clear()
+    elif table == "appuserlogin" and row_id:
+        for appuserlogin_id in row_id.split(","):
+            forget_login(int(appuserlogin_id))
+    if everything or table in _ROLES_TABLES:
+        _roles_cache.clear()
+    if everything or table == "appuserxstc":
+        _assignments_cache.clear()
+    if everything or table == "appstc":
+        stc_index.invalidate()
+
+
+listener.subscribe(_on_notify)
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_apikeys_on_flush(session: Session, flush_context: UOWTransaction):
+    """
+    Drop cached API keys whose row was changed or deleted, or whose user was renamed
+    or deleted
+    """
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, AppUserKey):
+            key_id = obj.id
+            _apikey_cache.discard_where(lambda e: e.appuserkey_id == key_id)
+        elif isinstance(obj, AppUser) and (
+            obj in session.deleted or get_history(obj, "name").has_changes()
+        ):
+            user_id = obj.id
+            _apikey_cache.discard_where(lambda e: e.user.id == user_id)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _invalidate_apikeys_on_bulk(state: ORMExecuteState):
+    """
+    Bulk UPDATE/DELETE statements do not tell us which rows they hit, so clear all
+    """
+    if (state.is_update or state.is_delete) and any(
+        mapper.class_ in (AppUserKey, AppUser) for mapper in state.all_mappers
+    ):
+        _apikey_cache.clear()
 
 
-def _auth_apikey(session: DBSession, key: str) -> Optional[AppUser]:
+def forget_login(appuserlogin_id: int, session: Optional[AnySession] = None) -> None:
+    """
+    Drop the cached cookies of a login that ended. With the `session` ending it, they
+    are dropped again once it commits: A request reading the login before that
+    still finds it active and might cache it.
+    """
+    _login_cache.discard_tag(appuserlogin_id)
+    if session is not None:
+        event.listen(
+            session.sync_session if isinstance(session, AsyncSession) else session,
+            "after_commit",
+            lambda _: _login_cache.discard_tag(appuserlogin_id),
+            once=True,
+        )
+
+
+def forget_logins() -> None:
+    """
+    Drop all cached cookies, e.g. because all logins got a new nextcookie
+    """
+    _login_cache.clear()
+
+
+def clear_caches() -> None:
+    """
+    Drop all cached authentication data and the local throttling buckets
+    """
+    _apikey_cache.clear()
+    _login_cache.clear()
+    _roles_cache.clear()
+    _assignments_cache.clear()
+    stc_index.invalidate()
+    clear_throttle()
+
+
+_T = TypeVar("_T")
+
+
+async def _on_replica(query: Callable[[AnySession], Awaitable[_T]]) -> Optional[_T]:
+    """
+    Run a query on the replica in autocommit mode. Returns None if there is no
+    usable replica or the query fails, in which case the caller asks the primary.
+    """
+    session = db.replica_session()
+    if session is None:
+        return None
+    try:
+        await autocommit(session)
+        return await query(session)
+    except exc.SQLAlchemyError:
+        # Also a timeout of the replica pool
+        logger.warning("Query on the replica failed", exc_info=True)
+        return None
+    finally:
+        await close(session)
+
+
+async def _auth_apikey(
+    session: DBSession, key: str, request: Request
+) -> Optional[UserRef]:
     """
     Split provided Apikey on first dash. The first part is an identifier so we only
     check keys in the database that have the same initial part.
     The rest is checked against the hashed value in the database.
+    Keys that were verified recently are found in a cache keyed by a digest of the
+    key, skipping both the database and the hash verification.
+    The keys are read from the replica if possible. Keys it does not know (yet)
+    are looked up on the primary. Keys read from the replica are cached no longer
+    than it may lag behind, as a revocation can reach the cache before the replica.
+    With settings.apikey_migrate, keys still stored as argon2 hash are stored as
+    HMAC once they were verified.
+    Keys that are not cached count against the client's rate (see throttle.py).
     """
     if not key.startswith("Apikey "):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authorization header",
         )
-    return AppUserKey.find(session, key.split()[1])
-
-
-def _auth_cookie(
-    session: DBSession, cookie: str, response: Response
-) -> Optional[AppUser]:
-    """
-    Compare user cookie against appuserlogin_cookie and appuserlogin_nextcookie.
-    If the user sent nextcookie, rotate them (assuming that from now on the old
-    cookie will no longer be sent). In any case, set the cookie to be used in
-    the future in the response (there was something about browsers sometimes no
-    longer sending a cookie if we don't remind them with every request that
-    this cookie is to be set).
-    """
-    row = session.execute(
-        select(AppUserLogin, AppUser)
-        .join_from(AppUserLogin, AppUser)
-        .where(
-            or_(
-                AppUserLogin.cookie == cookie,
-                AppUserLogin.nextcookie == cookie,
-            ),
-            not_(AppUserLogin.done),
-        )
-    ).first()
-    if not row:
+    auth = key.split()[1]
+    cache_key = digest(auth)
+    entry = _apikey_cache.get(cache_key)
+    if entry is not None:
+        return entry.user
+    await admit(request)
+    ident, _, secret = auth.partition("-")
+    candidates = await _on_replica(
+        lambda replica: AppUserKey.candidates(replica, ident)
+    )
+    ttl: Optional[float] = settings.replica_max_lag
+    if not candidates:
+        await autocommit(session)
+        candidates = await AppUserKey.candidates(session, ident)
+        ttl = None
+    appuserkey = await AppUserKey.verify(candidates, secret)
+    if appuserkey is None:
         return None
-    login, user = row
+    if settings.apikey_migrate and settings.apikey_pepper and not appuserkey.is_hmac:
+        await autocommit(session)
+        await appuserkey.migrate(session, secret)
+    user = UserRef(id=appuserkey.appuser.id, name=appuserkey.appuser.name)
+    _apikey_cache.set(cache_key, _ApikeyEntry(appuserkey.id, user), ttl=ttl)
+    return user
+
+
+# Everything the authentication phase needs in one statement:
+# - The login matching the cookie (if given), rotating cookie and nextcookie if the
+#   user sent the nextcookie. The login columns are from before the rotation.
+# - The user, either of the login or given by ID (if authenticated by API key)
+# - The appstc: If one is requested, it is used if the user is assigned to it or
+#   one of its parents. Otherwise the "first" appstc of the user is used, which is
+#   kept in appuser_defaultstc.
+# - The roles of the user in that appstc
+# - All appstc the user is assigned to, to resolve the appstc using the StcTree
+_AUTH_SQL = """
+    with login as (
+      select
+        appuserlogin_id,
+        appuserlogin_appuser_id,
+        appuserlogin_cookie,
+        appuserlogin_nextcookie
+      from appuserlogin
+      where (
+        appuserlogin_cookie = cast(:cookie as text)
+        or appuserlogin_nextcookie = cast(:cookie as text)
+      )
+      and not appuserlogin_done
+      limit 1
+    ),
+    {rotate}
+    usr as (
+      select
+        appuser_id,
+        appuser_name
+      from appuser
+      where appuser_id = coalesce(
+        (select appuserlogin_appuser_id from login),
+        cast(:appuser_id as bigint)
+      )
+    ),
+    stc as (
+      select
+        appuser_id,
+        appuser_name,
+        case
+          when cast(:appstc_id as bigint) is null then (
+            select appuser_defaultstc.appstc_id
+            from appuser_defaultstc
+            where appuser_defaultstc.id = usr.appuser_id
+          )
+          when exists (
+            select 1
+            from appuserxstc
+            join appstc_paths
+              on appuserxstc_appstc_id = any(id_path)
+            where id = cast(:appstc_id as bigint)
+              and appuserxstc_appuser_id = appuser_id
+          ) then cast(:appstc_id as bigint)
+        end as appstc_id
+      from usr
+    )
+    select
+      stc.appuser_id,
+      stc.appuser_name,
+      login.appuserlogin_id as login_id,
+      login.appuserlogin_cookie as cookie,
+      login.appuserlogin_nextcookie as nextcookie,
+      stc.appstc_id,
+      (
+        select
+          array_agg(appuserxstc_appstc_id)
+        from appuserxstc
+        where appuserxstc_appuser_id = stc.appuser_id
+      ) as appstc_ids,
+      (
+        select
+          array_agg(appgroup_zoperole)
+        from appgroup
+        join apppermxgroup
+          on apppermxgroup_appgroup_id = appgroup_id
+        join appuserxperm
+          on appuserxperm_appperm_id = apppermxgroup_appperm_id
+         and appuserxperm_appuser_id = stc.appuser_id
+        join apppermxstc
+          on apppermxstc_appperm_id = apppermxgroup_appperm_id
+        join appstc_paths
+          on apppermxstc_appstc_id = any(id_path)
+         and id = stc.appstc_id
+      ) as roles
+    from stc
+    left join login on true
+"""
+_ROTATE = """rotate as (
+      update appuserlogin
+      set
+        appuserlogin_cookie = appuserlogin.appuserlogin_nextcookie,
+        appuserlogin_nextcookie = null
+      from login
+      where appuserlogin.appuserlogin_id = login.appuserlogin_id
+        and appuserlogin.appuserlogin_nextcookie = cast(:cookie as text)
+    ),"""
+_AUTH_QUERY = text(_AUTH_SQL.format(rotate=_ROTATE))
+# The same without the rotation, for the replica. If the user sent the nextcookie,
+# the query is repeated on the primary.
+_AUTH_READ_QUERY = text(_AUTH_SQL.format(rotate=""))
+
+
+async def warm_up_queries(session: AnySession) -> None:
+    """
+    Run the statements of the authentication phase once without a match, so they
+    are compiled and cached before the first request needs them
+    """
+    await autocommit(session)
+    params = {"cookie": None, "appuser_id": None, "appstc_id": None}
+    await execute(session, _AUTH_QUERY, params)
+    await execute(session, _AUTH_READ_QUERY, params)
+    await AppUserKey.candidates(session, "")
+    await commit(session)
+
+
+def _cached_roles(
+    tree: Optional[StcTree], appuser_id: int, requested: Optional[int]
+) -> Optional[int]:
+    """
+    Role mask of a known user from the caches, if possible. The appstc is resolved in
+    memory using the tree index and the cached assignments of the user. Nodes the
+    tree does not know (yet) are left to the database.
+    """
+    if tree is None or (requested is not None and requested not in tree):
+        return None
+    assigned = _assignments_cache.get(appuser_id)
+    if assigned is None or any(node not in tree for node in assigned):
+        return None
+    appstc_id = tree.resolve(assigned, requested)
+    if appstc_id is None:
+        return 0
+    return _roles_cache.get((appuser_id, appstc_id))
+
+
+async def _query_auth(
+    session: DBSession,
+    cookie: Optional[str],
+    appuser_id: Optional[int],
+    appstc_id: Optional[int],
+) -> tuple[Optional[Row], Optional[float]]:
+    """
+    Run _AUTH_READ_QUERY on the replica if possible. Logins it does not know (yet)
+    and cookies that need to be rotated are handled by _AUTH_QUERY on the primary.
+    Returns the row and, if it was read from the replica, for how long it may be
+    cached: No longer than the replica may lag behind, as the notification about a
+    change can clear the caches before the replica has it.
+    """
+    params = {"cookie": cookie, "appuser_id": appuser_id, "appstc_id": appstc_id}
+
+    async def read(replica: AnySession) -> Optional[Row]:
+        return (await execute(replica, _AUTH_READ_QUERY, params)).first()
+
+    row = await _on_replica(read)
+    if row is None or (cookie is not None and cookie == row.nextcookie):
+        await autocommit(session)
+        return (await execute(session, _AUTH_QUERY, params)).first(), None
+    return row, settings.replica_max_lag
 
-    send_cookie = login.nextcookie or login.cookie
-    if cookie == login.nextcookie:
-        login.cookie = login.nextcookie
-        login.nextcookie = None
 
+def _send_cookie(response: Response, cookie: str, nextcookie: Optional[str]) -> None:
+    """
+    Set the cookie to be used in the future in the response (there was something
+    about browsers sometimes no longer sending a cookie if we don't remind them
+    with every request that this cookie is to be set). If there is a nextcookie,
+    the user is to switch to it. Once the user sends it, the query rotates them
+    (assuming that from now on the old cookie will no longer be sent).
+    """
     response.set_cookie(
         key=COOKIE,
-        value=send_cookie,
+        value=nextcookie or cookie,
         httponly=True,
         secure=True,
         samesite="strict",
     )
-    return user
 
 
-def _process_auth(
+async def _process_auth(
     session: DBSession,
     cookie: LoginCookieDep,
     apikey: ApikeyHeaderDep,
     params: ContextParamsDep,
     response: Response,
+    request: Request,
 ) -> Optional[AuthInfo]:
     """
     Process authorization at the beginning of (essentially) every request.
@@ -120,72 +504,81 @@ def _process_auth(
     2) Check appstc (organization area). If an appstc_id is provided, check that the
        user is allowed to activate it. Otherwise select a default appstc
     3) Check which roles the user has in this appstc
+    Apart from finding an API key that is not cached, this is done by _AUTH_QUERY in
+    a single round trip. For API keys, the roles are usually cached, so the
+    database is not needed at all. The authentication phase runs in autocommit
+    mode, so it needs no BEGIN and COMMIT and is separate from the transaction of
+    the payload. If a replica is configured, the reads go there (see _query_auth).
     """
-    appuser = None
-    if apikey is not None:
-        appuser = _auth_apikey(session, apikey)
-    elif cookie is not None:
-        appuser = _auth_cookie(session, cookie, response)
-
-    if not appuser:
+    if apikey is None and cookie is None:
         return None
+    with timed("auth"):
+        return await _authenticate(session, cookie, apikey, params, response, request)
+
+
+async def _authenticate(
+    session: DBSession,
+    cookie: str,
+    apikey: str,
+    params: ContextParams,
+    response: Response,
+    request: Request,
+) -> Optional[AuthInfo]:
+    listener.start()
+    try:
+        user: Optional[UserRef] = None
+        if apikey is not None:
+            with timed("apikey"):
+                user = await _auth_apikey(session, apikey, request)
+            if user is None:
+                return None
+        else:
+            cookie_key = digest(cookie)
+            login = _login_cache.get(cookie_key)
+            if login is not None:
+                user = login.user
+                _send_cookie(response, cookie, None)
+        if user is not None:
+            mask = _cached_roles(stc_index.get(), user.id, params.appstc_id)
+            if mask is not None:
+                return AuthInfo(id=user.id, name=user.name, role_mask=mask)
+        generations = (
+            _roles_cache.generation,
+            _assignments_cache.generation,
+            _login_cache.generation,
+        )
+        # Login, appstc and roles in one round trip, so they can not be told apart
+        with timed("auth_query"):
+            row, ttl = await _query_auth(
+                session,
+                cookie if user is None else None,
+                None if user is None else user.id,
+                params.appstc_id,
+            )
+    finally:
+        # Ends the autocommit transaction, without a round trip
+        await commit(session)
 
-    # Check for appstc
-    appstc_id = params.appstc_id
-    if appstc_id:
-        if not session.execute(
-            select(
-                select(1)
-                .select_from(AppUserXStc)
-                .join(AppStc_Paths, AppUserXStc.appstc_id == any_(AppStc_Paths.id_path))
-                .where(AppStc_Paths.id == appstc_id)
-                .where(AppUserXStc.appuser_id == appuser.id)
-                .exists()
+    if row is None:
+        return None
+    if user is None:
+        _send_cookie(response, row.cookie, row.nextcookie)
+        if cookie == row.nextcookie:
+            # Rotated, the old cookie is no longer valid
+            _login_cache.pop(digest(row.cookie))
+        if row.nextcookie is None or cookie == row.nextcookie:
+            entry = _LoginEntry(
+                appuserlogin_id=row.login_id,
+                user=UserRef(id=row.appuser_id, name=row.appuser_name),
             )
-        ).scalar():
-            appstc_id = None
-    else:
-        # Find the "first" appstc for the user
-        appstc_id = session.execute(
-            select(AppUserXStc.appstc_id)
-            .join(AppStc_Paths, AppUserXStc.appstc_id == AppStc_Paths.id)
-            .where(AppUserXStc.appuser_id == appuser.id)
-            .order_by(AppStc_Paths.depth, AppStc_Paths.id_path)
-            .limit(1)
-        ).scalar()
-
-    roles: list[str] = []
-    if appstc_id:
-        rows = session.execute(
-            text(
-                """
-                select
-                  array_agg(appgroup_zoperole)
-                from appgroup
-                join apppermxgroup
-                  on apppermxgroup_appgroup_id = appgroup_id
-                join appuserxperm
-                  on appuserxperm_appperm_id = apppermxgroup_appperm_id
-                 and appuserxperm_appuser_id = :appuser_id
-                join apppermxstc
-                  on apppermxstc_appperm_id = apppermxgroup_appperm_id
-                join appstc_paths
-                  on apppermxstc_appstc_id = any(id_path)
-                 and id = :appstc_id
-                """
-            ),
-            {
-                "appuser_id": appuser.id,
-                "appstc_id": appstc_id,
-            },
-        ).all()
-        roles = rows[0][0] or []
-
-    result = AuthInfo(name=appuser.name, roles=roles)
-    # We commit here, so the authentication phase and the payload phase are
-    # done in separate transactions.
-    session.commit()
-    return result
+            _login_cache.set(cookie_key, entry, generations[2], ttl)
+    mask = registry.mask(row.roles or ())
+    if row.appstc_id is not None:
+        _roles_cache.set((row.appuser_id, row.appstc_id), mask, generations[0], ttl)
+    _assignments_cache.set(
+        row.appuser_id, frozenset(row.appstc_ids or ()), generations[1], ttl
+    )
+    return AuthInfo(id=row.appuser_id, name=row.appuser_name, role_mask=mask)
 
 
 Auth = Annotated[Optional[AuthInfo], Depends(_process_auth)]
@@ -194,31 +587,32 @@ Auth = Annotated[Optional[AuthInfo], Depends(_process_auth)]
 _F = TypeVar("_F", bound=Callable[..., object])
 
 
-def require_roles(*roles: str) -> Callable[[_F], _F]:
+def require_roles(*roles: Requirement) -> Callable[[_F], _F]:
     """
-    Decorator to check for given roles
+    Decorator to check for given roles. All of them are required, each can also be
+    an expression like AnyOf("A", Not("B")) (see roles.py). The requirement is
+    compiled once here, so the check per request only compares role masks.
+    Works for both coroutine and plain endpoints.
     """
+    requirement = AllOf(*roles)
+    check = compile_requirement(requirement)
+    # Plain roles are reported as missing
+    required = registry.mask(role for role in roles if isinstance(role, str))
+
+    async def checker(user: Auth) -> bool:
+        mask = 0 if user is None else user.role_mask
+        if not check(mask):
+            raise HTTPException(
+                status_code=403,
+                detail={
+                    "msg": "Missing required permissions",
+                    "missing": registry.names(required & ~mask),
+                    "required": str(requirement),
+                },
+            )
+        return True
 
-    def require(required: tuple[str, ...]):
-
-        def checker(user: Auth):
-            # Check if all required scopes are present
-            roles = set() if user is None else user.roles
-            missing = set(required) - set(roles)
-            if missing:
-                raise HTTPException(
-                    status_code=403,
-                    detail={
-                        "msg": "Missing required permissions",
-                        "missing": list(missing),
-                    },
-                )
-
-            return True
-
-        return checker
-
-    dep = Depends(require(roles))
+    dep = Depends(checker)
 
     def decorator(func: _F) -> _F:
         sig = inspect.signature(func)
@@ -234,11 +628,22 @@ def require_roles(*roles: str) -> Callable[[_F], _F]:
         params = list(sig.parameters.values()) + [dep_param]
         new_sig = sig.replace(parameters=params)
 
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            # remove scope_check if present before calling original func
-            kwargs.pop("scope_check", None)
-            return await func(*args, **kwargs)
+        # remove scope_check before calling original func. FastAPI runs a plain
+        # wrapper in the thread pool, like the function itself.
+        wrapper: Callable
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                kwargs.pop("scope_check", None)
+                return await func(*args, **kwargs)
+
+        else:
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                kwargs.pop("scope_check", None)
+                return func(*args, **kwargs)
 
         # attach the new signature so FastAPI sees the dependency
         wrapper.__signature__ = new_sig  # type: ignore
@@ -268,20 +673,25 @@ def add_403_to_openapi(app):
                 )
 
 
-class SameSitePostMiddleware(BaseHTTPMiddleware):
+class SameSitePostMiddleware:
     """
     Rejects all POST/PUT/PATCH requests that do not include a valid
     Sec-Fetch-Site header. Allowed values: "same-origin"
     """
 
-    async def dispatch(self, request, call_next):
-        if request.method in ("POST", "PUT", "PATCH"):
-            sec_fetch_site = request.headers.get("sec-fetch-site")
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT", "PATCH"):
+            sec_fetch_site = Headers(scope=scope).get("sec-fetch-site")
 
             if sec_fetch_site != "same-origin":
-                return JSONResponse(
+                response = JSONResponse(
                     status_code=401,
-                    content={"detail": f"Unauthorized: cross-site {request.method}"},
+                    content={"detail": f"Unauthorized: cross-site {scope['method']}"},
                 )
+                await response(scope, receive, send)
+                return
 
-        return await call_next(request)
+        await self.app(scope, receive, send)
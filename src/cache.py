@@ -0,0 +1,192 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Protocol, TypeVar
+
+from .dbsession import settings
+from .shmcache import SharedTTLCache, shared_store
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+_K_contra = TypeVar("_K_contra", bound=Hashable, contravariant=True)
+
+if settings.cache_secret:
+    _SECRET = settings.cache_secret.encode()
+elif settings.shm_cache_path:
+    # The same in all processes sharing the caches
+    _SECRET = shared_store().secret
+else:
+    _SECRET = os.urandom(32)
+
+
+def digest(value: str) -> bytes:
+    """
+    Keyed digest of a secret (API key, cookie) to be used as cache key, so the
+    plaintext secret is never held in a cache.
+    """
+    return hmac.new(_SECRET, value.encode(), hashlib.sha256).digest()
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Bounded in-process cache. Entries expire after `ttl` seconds and if more than
+    `maxsize` entries are stored, the least recently used ones are evicted. A
+    `maxsize` of 0 disables the cache.
+    Invalidations increment `generation`. A value computed from the database should
+    be stored passing the generation from before the query, so it is dropped if an
+    invalidation happened in between.
+    `tag` gives an ID of a value, to remove the entries of a row with discard_tag().
+    The keys are indexed by tag, so that takes time in the number of those entries.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float, tag: Optional[Callable[[V], int]] = None
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tag = tag
+        self.generation = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._tags: dict[int, set[K]] = {}
+        # Sync dependencies run in the thread pool, so we need to lock
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _untag(self, key: K, value: V) -> None:
+        """
+        Must hold the lock
+        """
+        if self.tag is None:
+            return
+        tag = self.tag(value)
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def _delete(self, key: K) -> Optional[tuple[float, V]]:
+        """
+        Must hold the lock
+        """
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._untag(key, item[1])
+        return item
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                self._delete(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(
+        self,
+        key: K,
+        value: V,
+        generation: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        Store the value for `ttl` seconds if given, but no longer than the TTL of the
+        cache
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._delete(key)
+            self._data[key] = (time.monotonic() + ttl, value)
+            if self.tag is not None:
+                self._tags.setdefault(self.tag(value), set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._delete(next(iter(self._data)))
+
+    def pop(self, key: K) -> Optional[V]:
+        with self._lock:
+            self.generation += 1
+            item = self._delete(key)
+        return None if item is None else item[1]
+
+    def discard_where(self, predicate: Callable[[V], bool]) -> None:
+        """
+        Remove all entries whose value matches. This is linear in the size of the
+        cache, so it is only meant for invalidations, which are rare.
+        """
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                self._delete(key)
+
+    def discard_tag(self, tag: int) -> None:
+        if self.tag is None:
+            raise TypeError("The cache has no tag function")
+        with self._lock:
+            self.generation += 1
+            for key in self._tags.pop(tag, ()):
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._tags.clear()
+
+
+class Cache(Protocol[_K_contra, V]):
+    """
+    The interface of TTLCache and SharedTTLCache
+    """
+
+    @property
+    def generation(self) -> int: ...
+
+    def get(self, key: _K_contra) -> Optional[V]: ...
+
+    def set(
+        self,
+        key: _K_contra,
+        value: V,
+        generation: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ) -> None: ...
+
+    def pop(self, key: _K_contra) -> Optional[V]: ...
+
+    def discard_tag(self, tag: int) -> None: ...
+
+    def discard_where(self, predicate: Callable[[V], bool]) -> None: ...
+
+    def clear(self) -> None: ...
+
+
+def make_cache(
+    name: str,
+    maxsize: int,
+    ttl: float,
+    encode: Callable[[V], bytes],
+    decode: Callable[[bytes], V],
+    tag: Optional[Callable[[V], int]] = None,
+) -> Cache:
+    """
+    A cache shared by the processes of the host in the region `name` of the shared
+    store if settings.shm_cache_path is set (see shmcache.py), otherwise a TTLCache
+    of `maxsize` entries. The values are stored in the shared one as converted by
+    `encode` and `decode`.
+    """
+    if settings.shm_cache_path:
+        return SharedTTLCache(shared_store(), name, ttl, encode, decode, tag)
+    return TTLCache(maxsize, ttl, tag)
@@ -0,0 +1,75 @@
+"""
+Find argon2 parameters for which verifying a password takes about the given time
+on this machine. The memory cost and parallelism are kept (reducing the memory
+only if even one iteration takes too long) and the time cost is increased until
+the target is reached. Prints the settings to use.
+
+    python -m src.calibrate [--target-ms 50] [--memory-cost 65536] [--parallelism 4]
+"""
+
+import argparse
+import statistics
+import time
+
+import argon2
+
+from .dbsession import settings
+
+
+def measure(hasher: argon2.PasswordHasher, repeat: int) -> float:
+    """
+    Median seconds to verify a password hashed with the hasher
+    """
+    hash = hasher.hash("calibration")
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hasher.verify(hash, "calibration")
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def calibrate(
+    target: float, memory_cost: int, parallelism: int, repeat: int = 5
+) -> tuple[int, int, float]:
+    """
+    Returns time cost, memory cost and the measured verify time in seconds
+    """
+    # Lower memory until a single iteration fits, argon2 needs at least 8 KiB per lane
+    while True:
+        seconds = measure(argon2.PasswordHasher(1, memory_cost, parallelism), repeat)
+        if seconds <= target or memory_cost <= 8 * parallelism * 2:
+            break
+        memory_cost //= 2
+    time_cost = 1
+    while True:
+        candidate = measure(
+            argon2.PasswordHasher(time_cost + 1, memory_cost, parallelism), repeat
+        )
+        if candidate > target:
+            return time_cost, memory_cost, seconds
+        time_cost += 1
+        seconds = candidate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target-ms", type=float, default=50)
+    parser.add_argument("--memory-cost", type=int, default=settings.argon2_memory_cost)
+    parser.add_argument("--parallelism", type=int, default=settings.argon2_parallelism)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    time_cost, memory_cost, seconds = calibrate(
+        args.target_ms / 1000, args.memory_cost, args.parallelism, args.repeat
+    )
+    print(f"ARGON2_TIME_COST={time_cost}")
+    print(f"ARGON2_MEMORY_COST={memory_cost}")
+    print(f"ARGON2_PARALLELISM={args.parallelism}")
+    print(
+        f"# Verify takes {seconds * 1000:.1f} ms, with {settings.hash_workers} hash "
+        f"workers about {settings.hash_workers / seconds:.0f} logins per second"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,405 @@
-from typing import Annotated
+import os
+from typing import Annotated, Any, AsyncIterator, Optional, Sequence, Union
 
-from fastapi import Depends, Request, Response
+from fastapi import Depends, Request
 from pydantic_settings import BaseSettings
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, Executable, Result, Row, create_engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import Session
-from sqlalchemy.pool import NullPool
-from starlette.middleware.base import BaseHTTPMiddleware
+from sqlalchemy.pool import NullPool, Pool
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .metrics import finish_request, start_request, timed
+from .pool import (
+    MeteredAsyncQueuePool,
+    MeteredQueuePool,
+    PoolValidator,
+    ReplicaMonitor,
+    pool_status,
+)
 
 
 class Settings(BaseSettings):
     connstr: str = "postgresql+psycopg://zope@/perfactema"
     sql_debug: bool = False
     pooling: bool = True  # Set to False for testing
+    # Use SQLAlchemy's asyncio extension with psycopg's async connections
+    async_db: bool = False
+    # Key for digests of secrets used as cache keys. Random per process if empty
+    cache_secret: str = ""
+    apikey_cache_size: int = 10000  # Set to 0 to disable
+    apikey_cache_ttl: float = 300
+    roles_cache_size: int = 10000  # Set to 0 to disable
+    # Safety net, roles are invalidated by notifications from the database
+    roles_cache_ttl: float = 300
+    # Logins by cookie. Logouts are propagated by notifications, so the TTL only
+    # bounds how long a login ended by other means stays usable.
+    login_cache_size: int = 100000  # Set to 0 to disable
+    login_cache_ttl: float = 60
+    # Memory mapped file (e.g. in /dev/shm) through which the worker processes of a
+    # host share the login, roles and assignments caches (see shmcache.py), instead
+    # of each having its own. Values are stored in slots of shm_value_size bytes,
+    # larger ones are not cached.
+    shm_cache_path: str = ""
+    shm_value_size: int = 256
+    # Resolve the appstc from an in-memory index of the tree, if the user is known.
+    # It is reloaded when notified about changes and after stc_index_ttl seconds.
+    stc_index: bool = True
+    stc_index_ttl: float = 300
+    # Listen for notifications from the triggers in schema/after.sql that
+    # invalidate the caches. Without it, only the TTL expires them.
+    notify_listen: bool = True
+    # Cookie rotation (see rotation.py): Seconds between runs (0 to disable), logins
+    # per batch and seconds to pause between batches
+    cookie_rotation_interval: float = 0
+    cookie_rotation_batch_size: int = 1000
+    cookie_rotation_pause: float = 0.1
+    # Retention of logins (see retention.py): Ended logins are deleted after
+    # login_retention_days, active ones are ended after login_max_age_days (0 for
+    # never). Runs every login_retention_interval seconds (0 to disable).
+    login_retention_days: float = 30
+    login_max_age_days: float = 0
+    login_retention_interval: float = 3600
+    login_retention_batch_size: int = 1000
+    login_retention_pause: float = 0.1
+    # Parameters for new argon2 hashes, see argon2.PasswordHasher (memory in KiB)
+    # and python -m src.calibrate. Passwords with outdated parameters are rehashed
+    # on login.
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536
+    argon2_parallelism: int = 4
+    # Key for the HMACs that new API keys are stored as, instead of argon2 hashes.
+    # Keys stored that way no longer verify if it changes. If empty, new keys
+    # still use argon2.
+    apikey_pepper: str = ""
+    # Replace the argon2 hash of an API key by its HMAC when it is used
+    apikey_migrate: bool = False
+    # Token buckets in front of password and API key verification (see
+    # throttle.py): Attempts per second and burst per username and per client
+    # address, a rate of 0 disables them. The limit per client is off by default:
+    # Behind a proxy, the client address is the one of the proxy unless uvicorn
+    # runs with --proxy-headers and trusts it (--forwarded-allow-ips), so all
+    # users would share one bucket.
+    throttle_user_rate: float = 0.1
+    throttle_user_burst: int = 10
+    throttle_client_rate: float = 0
+    throttle_client_burst: int = 30
+    throttle_size: int = 100000  # Buckets kept per kind in each process
+    # Also take the tokens from the buckets in the database shared by all workers
+    throttle_shared: bool = False
+    # Concurrent argon2 operations and how many more may wait before we return 503
+    hash_workers: int = os.cpu_count() or 1
+    hash_queue_depth: int = 64
+    # Connection pool, see sqlalchemy.pool.QueuePool. Connections are validated
+    # in the background every pool_check_interval seconds (0 to disable), so
+    # pool_pre_ping, which costs a round trip on every checkout, is off by default.
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_recycle: int = -1
+    pool_pre_ping: bool = False
+    pool_check_interval: float = 30
+    # psycopg prepares a statement on the server once it was executed this often
+    # on a connection, so it is no longer parsed and planned each time. 0 prepares
+    # everything right away. Set prepare to False to disable it, which is needed
+    # behind a proxy that pools transactions (like PgBouncer before 1.21). Each
+    # connection keeps the prepared_max most recently used ones.
+    prepare: bool = True
+    prepare_threshold: int = 5
+    prepared_max: int = 100
+    # Connections opened at startup (see warmup.py), at most pool_size. /ready
+    # reports 503 until the warm-up is done, it is retried every
+    # warmup_retry_interval seconds while it fails.
+    pool_warm_size: int = 5
+    warmup_retry_interval: float = 5
+    # Report the time spent per phase of the request (see metrics.py) in the
+    # Server-Timing header. They are collected for /metrics regardless.
+    server_timing: bool = False
+    # Streaming replica for the reads of the authentication phase, empty for none.
+    # It is only used while its lag, checked every replica_check_interval seconds,
+    # is at most replica_max_lag seconds.
+    replica_connstr: str = ""
+    replica_max_lag: float = 5
+    replica_check_interval: float = 5
 
 
 settings = Settings()
 
+AnySession = Union[Session, AsyncSession]
+
+
+class Database:
+    """
+    The engines for settings.connstr, created on first use. Only the one matching
+    settings.async_db is used, but switching is possible (the tests do that).
+    """
+
+    def __init__(self) -> None:
+        self.engine: Optional[Engine] = None
+        self.async_engine: Optional[AsyncEngine] = None
+        self.validators: list[PoolValidator] = []
+        # Monitors of the replica engines, by settings.async_db
+        self.replicas: dict[bool, ReplicaMonitor] = {}
+
+    def _engine_kw(self, poolclass: type[Pool]) -> dict[str, Any]:
+        connect_args = dict(
+            prepare_threshold=settings.prepare_threshold if settings.prepare else None
+        )
+        if not settings.pooling:
+            return dict(
+                echo=settings.sql_debug, poolclass=NullPool, connect_args=connect_args
+            )
+        return dict(
+            echo=settings.sql_debug,
+            connect_args=connect_args,
+            poolclass=poolclass,
+            pool_size=settings.pool_size,
+            max_overflow=settings.max_overflow,
+            pool_timeout=settings.pool_timeout,
+            pool_recycle=settings.pool_recycle,
+            pool_pre_ping=settings.pool_pre_ping,
+        )
+
+    def _setup(self, engine: Union[Engine, AsyncEngine]) -> None:
+        """
+        Configure new connections and start validating the pool
+        """
+        sync_engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+
+        @event.listens_for(sync_engine, "connect")
+        def configure(dbapi_connection, connection_record):
+            # The psycopg connection, also if wrapped for asyncio
+            conn = getattr(dbapi_connection, "driver_connection", dbapi_connection)
+            conn.prepared_max = settings.prepared_max
+
+        if settings.pooling and settings.pool_check_interval > 0:
+            validator = PoolValidator(engine, settings.pool_check_interval)
+            validator.start()
+            self.validators.append(validator)
+
+    def get_engine(self) -> Engine:
+        if self.engine is None:
+            self.engine = create_engine(
+                settings.connstr, **self._engine_kw(MeteredQueuePool)
+            )
+            self._setup(self.engine)
+        return self.engine
+
+    def get_async_engine(self) -> AsyncEngine:
+        """
+        Must be called from within the event loop the engine is used on
+        """
+        if self.async_engine is None:
+            self.async_engine = create_async_engine(
+                settings.connstr, **self._engine_kw(MeteredAsyncQueuePool)
+            )
+            self._setup(self.async_engine)
+        return self.async_engine
+
+    def session(self) -> AnySession:
+        if settings.async_db:
+            # Expired attributes would need IO on access, which an AsyncSession
+            # can not do implicitly
+            return AsyncSession(self.get_async_engine(), expire_on_commit=False)
+        return Session(self.get_engine())
+
+    def replica_session(self) -> Optional[AnySession]:
+        """
+        A session on the replica, if one is configured and it is not lagging behind
+        too much. Otherwise None, and the primary is to be used.
+        Must be called from within the event loop, so the monitor can be started.
+        """
+        if not settings.replica_connstr:
+            return None
+        monitor = self.replicas.get(settings.async_db)
+        if monitor is None:
+            engine: Union[Engine, AsyncEngine]
+            if settings.async_db:
+                engine = create_async_engine(
+                    settings.replica_connstr, **self._engine_kw(MeteredAsyncQueuePool)
+                )
+            else:
+                engine = create_engine(
+                    settings.replica_connstr, **self._engine_kw(MeteredQueuePool)
+                )
+            self._setup(engine)
+            monitor = ReplicaMonitor(engine, settings.replica_check_interval)
+            monitor.start()
+            self.replicas[settings.async_db] = monitor
+        if not monitor.usable(settings.replica_max_lag):
+            return None
+        if isinstance(monitor.engine, AsyncEngine):
+            return AsyncSession(monitor.engine, expire_on_commit=False)
+        return Session(monitor.engine)
 
-class DBSessionMiddleware(BaseHTTPMiddleware):
+    async def dispose(self) -> None:
+        """
+        Close all pooled connections and drop the engines, so they are created again
+        with the current settings on next use
+        """
+        for validator in self.validators:
+            validator.stop()
+        self.validators = []
+        if self.engine is not None:
+            await run_in_threadpool(self.engine.dispose)
+            self.engine = None
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+            self.async_engine = None
+        for monitor in self.replicas.values():
+            monitor.stop()
+            if isinstance(monitor.engine, AsyncEngine):
+                await monitor.engine.dispose()
+            else:
+                await run_in_threadpool(monitor.engine.dispose)
+        self.replicas = {}
+
+    def pool_status(self) -> dict[str, dict[str, float]]:
+        result = {}
+        if self.engine is not None:
+            result["sync"] = pool_status(self.engine.pool)
+        if self.async_engine is not None:
+            result["async"] = pool_status(self.async_engine.pool)
+        for is_async, monitor in self.replicas.items():
+            status = pool_status(monitor.engine.pool)
+            if monitor.lag is not None:
+                status["lag"] = monitor.lag
+            result["replica_async" if is_async else "replica_sync"] = status
+        return result
+
+
+db = Database()
+
+
+class DBSessionMiddleware:
     """
     Start a DB session for each request. Commit it at the end if there is no error,
     otherwise roll back and return a generic 500 error. Note that this does not mean
     that a request is not allowed to do its own commits in between.
+    With settings.async_db, the session is an AsyncSession.
+    The commit happens before the response is started, so a failing commit still
+    turns into a 500. Anything done after that (streamed bodies, background tasks)
+    is committed once more when the app is finished.
+    The middleware also collects the timings of the request and reports them in the
+    Server-Timing header if enabled.
     """
 
-    async def dispatch(self, request, call_next):
-        if not hasattr(self, "engine"):
-            self.engine = create_engine(
-                settings.connstr,
-                pool_pre_ping=True,
-                echo=settings.sql_debug,
-                poolclass=NullPool if not settings.pooling else None,
-            )
-        response = Response("Internal server error", status_code=500)
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = start_request()
+        session = db.session()
+        scope.setdefault("state", {})["db"] = session
+
+        async def send_committed(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                with timed("commit"):
+                    await commit(session)
+                if settings.server_timing:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", timings.server_timing().encode())
+                    ]
+            await send(message)
+
         try:
-            request.state.db = Session(self.engine)
-            response = await call_next(request)
-            request.state.db.commit()
+            await self.app(scope, receive, send_committed)
+            with timed("commit"):
+                await commit(session)
         except Exception:
-            request.state.db.rollback()
+            await rollback(session)
             raise
         finally:
-            request.state.db.close()
-        return response
+            await close(session)
+            finish_request(timings)
+
+
+async def execute(
+    session: AnySession, statement: Executable, params: Optional[dict] = None
+) -> Result:
+    """
+    Execute a statement on either kind of session. With a sync session, the query
+    runs in the thread pool so it does not block the event loop. The same holds for
+    the other helpers below, which return right away if there is no transaction.
+    """
+    if isinstance(session, AsyncSession):
+        return await session.execute(statement, params)
+    return await run_in_threadpool(session.execute, statement, params)
+
+
+async def stream(
+    session: AnySession,
+    statement: Executable,
+    params: Optional[dict] = None,
+    size: int = 1000,
+) -> AsyncIterator[Sequence[Row]]:
+    """
+    Execute a statement with a server side cursor and yield its rows in chunks of
+    `size`, so a large result is not held in memory at once. The transaction must
+    last until all rows are fetched, so this can not use the session of the request,
+    which is committed when the response starts.
+    """
+    statement = statement.execution_options(yield_per=size)
+    if isinstance(session, AsyncSession):
+        result = await session.stream(statement, params)
+        async for rows in result.partitions(size):
+            yield rows
+        return
+    sync_result = await run_in_threadpool(session.execute, statement, params)
+    while rows := await run_in_threadpool(sync_result.fetchmany, size):
+        yield rows
+
+
+async def autocommit(session: AnySession) -> None:
+    """
+    Run the transaction the session is about to begin in autocommit mode, so its
+    statements are sent without BEGIN and the commit that ends it needs no round
+    trip. The connection is reset to the normal isolation level when it is
+    released, so the session's next transaction is a regular one again.
+    """
+    if session.in_transaction():
+        return
+    options = {"isolation_level": "AUTOCOMMIT"}
+    if isinstance(session, AsyncSession):
+        await session.connection(execution_options=options)
+    else:
+        await run_in_threadpool(session.connection, execution_options=options)
+
+
+async def commit(session: AnySession) -> None:
+    if not session.in_transaction():
+        return
+    if isinstance(session, AsyncSession):
+        await session.commit()
+    else:
+        await run_in_threadpool(session.commit)
+
+
+async def rollback(session: AnySession) -> None:
+    if not session.in_transaction():
+        return
+    if isinstance(session, AsyncSession):
+        await session.rollback()
+    else:
+        await run_in_threadpool(session.rollback)
+
+
+async def close(session: AnySession) -> None:
+    if isinstance(session, AsyncSession):
+        await session.close()
+    elif session.in_transaction():
+        await run_in_threadpool(session.close)
+    else:
+        session.close()
 
 
 def _get_session(request: Request):
     return request.state.db
 
 
-DBSession = Annotated[Session, Depends(_get_session)]
+DBSession = Annotated[AnySession, Depends(_get_session)]
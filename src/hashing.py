@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+import argon2
+
+from .dbsession import settings
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+
+def make_hasher() -> argon2.PasswordHasher:
+    return argon2.PasswordHasher(
+        time_cost=settings.argon2_time_cost,
+        memory_cost=settings.argon2_memory_cost,
+        parallelism=settings.argon2_parallelism,
+    )
+
+
+# Creates new hashes with the configured parameters. Verifying uses the parameters
+# stored in the hash, so existing hashes stay valid if they change.
+hasher = make_hasher()
+# Verifying a password of a user that does not exist takes as long as for one whose
+# password is up to date
+DUMMY_HASH = hasher.hash(os.urandom(16).hex())
+
+
+class HashingOverloaded(Exception):
+    """
+    Raised if the hashing executor already has as many operations queued as it
+    accepts. Mapped to 503 by the app, so the request fails fast instead of waiting.
+    """
+
+
+def _verify(hash: str, password: str, hasher: argon2.PasswordHasher) -> bool:
+    try:
+        hasher.verify(hash, password)
+        return True
+    except argon2.exceptions.VerifyMismatchError:
+        return False
+
+
+class HashingExecutor:
+    """
+    Runs argon2 operations in a thread pool (argon2 releases the GIL), so they do not
+    block the event loop. At most `workers` operations run at the same time and at
+    most `queue_depth` further ones wait. Anything beyond that is rejected.
+    """
+
+    def __init__(self, workers: int, queue_depth: int):
+        self.limit = workers + queue_depth
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="hashing")
+
+    def submit(self, fn: Callable[..., _T], *args) -> "Future[_T]":
+        with self._lock:
+            if self.pending >= self.limit:
+                raise HashingOverloaded()
+            self.pending += 1
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._done()
+            raise
+        future.add_done_callback(lambda _: self._done())
+        return future
+
+    def _done(self) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, fn: Callable[..., _T], *args) -> _T:
+        """
+        Run in the executor and wait for the result, for use from sync code
+        """
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn: Callable[..., _T], *args) -> _T:
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+
+executor = HashingExecutor(settings.hash_workers, settings.hash_queue_depth)
+
+
+async def averify_hash(hash: str, password: str) -> bool:
+    with timed("argon2"):
+        return await executor.arun(_verify, hash, password, hasher)
+
+
+def hash_password(password: str) -> str:
+    with timed("argon2"):
+        return executor.run(hasher.hash, password)
+
+
+async def ahash_password(password: str) -> str:
+    with timed("argon2"):
+        return await executor.arun(hasher.hash, password)
+
+
+def needs_rehash(hash: str) -> bool:
+    """
+    Whether the hash was created with other parameters than the configured ones
+    """
+    return hasher.check_needs_rehash(hash)
+
+
+# Marks the HMAC of an API key, as opposed to an argon2 hash (which starts with $)
+HMAC_PREFIX = "hmac-sha256$"
+
+
+def hmac_hash(secret: str) -> str:
+    """
+    Keyed hash of a random secret like an API key, with settings.apikey_pepper as
+    key. Unlike passwords, such secrets have enough entropy to not need a slow hash,
+    so this takes microseconds and needs no executor.
+    """
+    if not settings.apikey_pepper:
+        raise RuntimeError("settings.apikey_pepper is not set")
+    digest = hmac.new(settings.apikey_pepper.encode(), secret.encode(), hashlib.sha256)
+    return HMAC_PREFIX + digest.hexdigest()
+
+
+@functools.cache
+def _log_missing_pepper() -> None:
+    logger.error("API keys stored as HMAC can not be verified without apikey_pepper")
+
+
+def verify_hmac(stored: str, secret: str) -> bool:
+    """
+    Whether `stored` is the HMAC of the secret. Without settings.apikey_pepper,
+    nothing matches.
+    """
+    if not settings.apikey_pepper:
+        _log_missing_pepper()
+        return False
+    with timed("hmac"):
+        return hmac.compare_digest(stored, hmac_hash(secret))
@@ -0,0 +1,136 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+import psycopg
+from sqlalchemy import make_url
+
+from .dbsession import settings
+
+logger = logging.getLogger(__name__)
+
+# Channel the triggers from schema/after.sql notify on, with the table as payload
+CHANNEL = "auth_invalidate"
+# The triggers notifying about changes, also in schema/after.sql
+TRIGGERS = """
+    create or replace function auth_notify()
+    returns trigger
+    language plpgsql
+    as $function$
+    begin
+      perform pg_notify('auth_invalidate', tg_table_name);
+      return null;
+    end;
+    $function$;
+
+    do $$
+    declare
+      tbl text;
+    begin
+      foreach tbl in array array[
+        'appuserkey', 'appgroup', 'apppermxgroup', 'appuserxperm', 'apppermxstc',
+        'appuserxstc', 'appstc'
+      ] loop
+        execute
+          'create or replace trigger ' || quote_ident(tbl || '_auth_notify')
+          || ' after insert or update or delete or truncate on ' || quote_ident(tbl)
+          || ' for each statement execute function auth_notify()';
+      end loop;
+    end;
+    $$;
+    -- Of a user, the caches only hold the name. Other changes, like a password hashed
+    -- again on login, must not clear them.
+    create or replace trigger appuser_auth_notify
+    after update of appuser_name or delete or truncate on appuser
+    for each statement execute function auth_notify();
+
+    -- Ended logins are dropped from the login caches of all workers
+    create or replace function appuserlogin_notify_done()
+    returns trigger
+    language plpgsql
+    as $function$
+    begin
+      perform pg_notify('auth_invalidate', 'appuserlogin:' || new.appuserlogin_id);
+      return null;
+    end;
+    $function$;
+
+    create or replace trigger appuserlogin_notify_done
+    after update of appuserlogin_done on appuserlogin
+    for each row
+    when (new.appuserlogin_done and not old.appuserlogin_done)
+    execute function appuserlogin_notify_done();
+"""
+
+
+class Listener:
+    """
+    Listens for notifications about changed tables on a dedicated connection in a
+    daemon thread and passes them to the subscribed callbacks.
+    Callbacks get the payload, which is the name of the changed table, possibly
+    followed by ":" and the IDs of changed rows, or None if notifications might
+    have been missed (when the connection is (re)established), in which case
+    everything derived from the database should be invalidated.
+    """
+
+    def __init__(self) -> None:
+        self.callbacks: list[Callable[[Optional[str]], None]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def subscribe(self, callback: Callable[[Optional[str]], None]) -> None:
+        self.callbacks.append(callback)
+
+    def start(self) -> None:
+        """
+        Start listening, if enabled and not running yet. Cheap to call repeatedly.
+        """
+        if self._thread is not None or not settings.notify_listen:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="auth-listener", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop listening and wait for the thread to end, which takes up to a second
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._stop.clear()
+
+    def dispatch(self, table: Optional[str]) -> None:
+        for callback in self.callbacks:
+            try:
+                callback(table)
+            except Exception:
+                logger.exception("Notification callback failed")
+
+    def _run(self) -> None:
+        conninfo = (
+            make_url(settings.connstr)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute(f"listen {CHANNEL}")
+                    self.dispatch(None)
+                    while not self._stop.is_set():
+                        # Returns every second to check whether to stop
+                        for notify in conn.notifies(timeout=1):
+                            self.dispatch(notify.payload)
+            except psycopg.Error:
+                logger.warning("Lost listener connection", exc_info=True)
+            self._stop.wait(1)
+
+
+listener = Listener()
@@ -0,0 +1,188 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar, Token
+from typing import Optional
+
+from sqlalchemy import Engine, event
+
+# Upper bounds in seconds
+TIME_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus sense, optionally split by the value of
+    one label
+    """
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...], label: str = ""
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        # Per label value: Count per bucket (the last one is +Inf) and sum
+        self._data: dict[str, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label: str = "") -> None:
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._data.get(label)
+            if data is None:
+                data = self._data[label] = ([0] * (len(self.buckets) + 1), [0.0])
+            data[0][idx] += 1
+            data[1][0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._data.items())
+        for label, (counts, total) in items:
+            prefix = f'{self.label}="{label}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            selector = "{" + prefix.rstrip(",") + "}" if prefix else ""
+            lines.append(f"{self.name}_sum{selector} {total}")
+            lines.append(f"{self.name}_count{selector} {cumulative}")
+        return lines
+
+
+def render_gauge(name: str, help: str, label: str, samples: dict[str, float]) -> str:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    lines.extend(f'{name}{{{label}="{key}"}} {value}' for key, value in samples.items())
+    return "\n".join(lines)
+
+
+REQUEST_SECONDS = Histogram(
+    "auth_request_seconds", "Duration of requests", TIME_BUCKETS
+)
+PHASE_SECONDS = Histogram(
+    "auth_phase_seconds", "Time spent in a phase of a request", TIME_BUCKETS, "phase"
+)
+QUERIES = Histogram(
+    "auth_request_queries", "Database queries per request", COUNT_BUCKETS
+)
+HISTOGRAMS = (REQUEST_SECONDS, PHASE_SECONDS, QUERIES)
+
+
+class RequestTimings:
+    """
+    Time spent per phase and number of queries of the current request
+    """
+
+    __slots__ = ("start", "phases", "queries", "token")
+    token: "Token[Optional[RequestTimings]]"
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.queries = 0
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """
+        Value of the Server-Timing header, durations in milliseconds
+        """
+        entries = [
+            f"{phase};dur={seconds * 1000:.3f}"
+            for phase, seconds in self.phases.items()
+        ]
+        entries.append(f'queries;desc="{self.queries}"')
+        entries.append(f"total;dur={self.elapsed() * 1000:.3f}")
+        return ", ".join(entries)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("timings", default=None)
+
+
+def start_request() -> RequestTimings:
+    """
+    Start collecting timings for the request handled by the current task. Threads
+    of the thread pool get a copy of the context, so they report to it as well.
+    """
+    timings = RequestTimings()
+    timings.token = _current.set(timings)
+    return timings
+
+
+def finish_request(timings: RequestTimings) -> None:
+    _current.reset(timings.token)
+    REQUEST_SECONDS.observe(timings.elapsed())
+    QUERIES.observe(timings.queries)
+
+
+class timed:
+    """
+    Context manager that adds the time spent in it to the given phase, both for the
+    current request and in PHASE_SECONDS
+    """
+
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase: str):
+        self.phase = phase
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        record(self.phase, time.perf_counter() - self.start)
+
+
+def record(phase: str, seconds: float) -> None:
+    PHASE_SECONDS.observe(seconds, phase)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    record("db", time.perf_counter() - conn.info["query_start"].pop())
+    timings = _current.get()
+    if timings is not None:
+        timings.queries += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed_query(context):
+    if context.connection is not None:
+        stack = context.connection.info.get("query_start")
+        if stack:
+            stack.pop()
+
+
+def render() -> str:
+    return "\n".join(line for hist in HISTOGRAMS for line in hist.render())
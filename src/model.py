@@ -1,33 +1,30 @@
-import os
+import secrets
 import uuid
-from datetime import datetime
-from typing import Optional, Self
+from datetime import datetime, timezone
+from typing import Optional, Self, Sequence
 
-import argon2
-from sqlalchemy import BigInteger, DateTime, ForeignKey, String, func, select
+from sqlalchemy import BigInteger, DateTime, ForeignKey, String, func, select, update
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
+    contains_eager,
     relationship,
+    validates,
 )
 from sqlalchemy.orm import mapped_column as col
 from sqlalchemy.types import ARRAY, Integer
 
-from .dbsession import DBSession
-
-DUMMY_HASH = argon2.PasswordHasher().hash(os.urandom(16).hex())
-
-
-def verify_hash(
-    hash: str, password: str, hasher: Optional[argon2.PasswordHasher] = None
-) -> bool:
-    if hasher is None:
-        hasher = argon2.PasswordHasher()
-    try:
-        hasher.verify(hash, password)
-        return True
-    except argon2.exceptions.VerifyMismatchError:
-        return False
+from .dbsession import DBSession, execute, settings
+from .hashing import (
+    DUMMY_HASH,
+    HMAC_PREFIX,
+    ahash_password,
+    averify_hash,
+    hash_password,
+    hmac_hash,
+    needs_rehash,
+    verify_hmac,
+)
 
 
 class Base(DeclarativeBase):
@@ -71,15 +68,6 @@ class Base(DeclarativeBase):
                     col.key = new_name  # keep ORM key in sync
 
 
-class View(DeclarativeBase):
-    """
-    Separate base for view definitions, so they are not created as tables but
-    can be used like tables
-    """
-
-    type_annotation_map = {str: String(), int: BigInteger()}
-
-
 class AppUser(Base):
     name: Mapped[str]
     password: Mapped[Optional[str]]
@@ -90,39 +78,89 @@ class AppUser(Base):
 
     @staticmethod
     def encrypt_pw(newpassword):
-        return argon2.PasswordHasher().hash(password=newpassword)
+        return hash_password(newpassword)
 
 
 class AppUserKey(Base):
     appuser_id: Mapped[int] = col(ForeignKey(AppUser.id))
     key: Mapped[str]
+    # Part of the key before the first dash, indexed for lookups
+    ident: Mapped[Optional[str]]
     appuser: Mapped[AppUser] = relationship()
 
+    @validates("key")
+    def _set_ident(self, _, key: str) -> str:
+        self.ident = key.split("-", 1)[0]
+        return key
+
+    @classmethod
+    def generate(cls, appuser_id: int) -> tuple[Self, str]:
+        """
+        Create a new random key for the user. Returns the row to be added and the
+        key to be given to the user, which is not stored anywhere.
+        It is stored as HMAC if settings.apikey_pepper is set, otherwise hashed with
+        argon2.
+        """
+        ident = secrets.token_hex(8)
+        secret = secrets.token_urlsafe(32)
+        if settings.apikey_pepper:
+            stored = hmac_hash(secret)
+        else:
+            stored = hash_password(secret)
+        return cls(appuser_id=appuser_id, key=f"{ident}-{stored}"), f"{ident}-{secret}"
+
+    @property
+    def is_hmac(self) -> bool:
+        return self.key.split("-", 1)[1].startswith(HMAC_PREFIX)
+
+    async def migrate(self, session: DBSession, secret: str) -> None:
+        """
+        Replace the argon2 hash of the key by its HMAC, given the verified secret.
+        Only if the key was not changed in between.
+        """
+        await execute(
+            session,
+            update(AppUserKey)
+            .where(AppUserKey.id == self.id, AppUserKey.key == self.key)
+            .values(key=f"{self.key.split('-', 1)[0]}-{hmac_hash(secret)}"),
+        )
+
     @staticmethod
-    def find(session: DBSession, auth: str) -> Optional[AppUser]:
+    async def candidates(session: DBSession, ident: str) -> Sequence["AppUserKey"]:
         """
-        Split the auth header into ident and key.
-        Find a key that, when split on the first "-", starts with the ident and
-        contains a hasded value of the key afterwards.
-        Returns the user name if something is found.
-        Note regarding timing attacks: This will scale with the number of
-        matches found under the given ident, but for zero matches it takes
-        roughly the same time as for one match.
+        The keys stored under the ident, with their users loaded
         """
-        ident, key = auth.split("-", 1)
-        candidates = session.execute(
-            select(AppUserKey, AppUser)
-            .where(func.regexp_match(AppUserKey.key, (ident + "-.*")).isnot(None))
-            .where(AppUserKey.appuser_id == AppUser.id)
+        stmt = (
+            select(AppUserKey)
+            .join(AppUserKey.appuser)
+            .options(contains_eager(AppUserKey.appuser))
+            .where(AppUserKey.ident == ident)
         )
-        hasher = argon2.PasswordHasher()
+        return (await execute(session, stmt)).scalars().all()
+
+    @staticmethod
+    async def verify(
+        candidates: Sequence["AppUserKey"], key: str
+    ) -> Optional["AppUserKey"]:
+        """
+        The candidate whose stored HMAC or argon2 hash matches the key, if any.
+        Note regarding timing attacks: This will scale with the number of
+        candidates, but for zero candidates it takes roughly the same time as for
+        one (of the kind new keys are created with).
+        """
         if not candidates:
-            verify_hash(hash=DUMMY_HASH, password=key, hasher=hasher)
+            if settings.apikey_pepper:
+                verify_hmac(HMAC_PREFIX, key)
+            else:
+                await averify_hash(hash=DUMMY_HASH, password=key)
             return None
-        for appuserkey, appuser in candidates:
-            _, encrypted = appuserkey.key.split("-", 1)
-            if verify_hash(hash=encrypted, password=key, hasher=hasher):
-                return appuser
+        for appuserkey in candidates:
+            _, stored = appuserkey.key.split("-", 1)
+            if stored.startswith(HMAC_PREFIX):
+                if verify_hmac(stored, key):
+                    return appuserkey
+            elif await averify_hash(hash=stored, password=key):
+                return appuserkey
         return None
 
 
@@ -131,30 +169,56 @@ class AppUserLogin(Base):
     cookie: Mapped[Optional[str]]
     nextcookie: Mapped[Optional[str]]
     done: Mapped[bool] = col(default=False)
+    # When the login was ended, retention counts from then (see retention.py)
+    endtime: Mapped[Optional[datetime]] = col(DateTime(timezone=True))
     user: Mapped[AppUser] = relationship()
 
+    @validates("done")
+    def _set_endtime(self, _, done: bool) -> bool:
+        if done and self.endtime is None:
+            self.endtime = datetime.now(timezone.utc)
+        return done
+
     @classmethod
-    def login(cls, session: DBSession, username: str, password: str) -> Optional[Self]:
+    async def login(
+        cls, session: DBSession, username: str, password: str
+    ) -> Optional[Self]:
         """
         Find the user with the given username and check its password. If there
-        is a match, create a login and return it.
+        is a match, create a login and return it. A password hashed with outdated
+        parameters is hashed again, so changed parameters take effect without a
+        migration.
         """
         stmt = select(AppUser).where(func.lower(AppUser.name) == func.lower(username))
         user: Optional[AppUser] = None
-        for user in session.execute(stmt).scalars():
+        for user in (await execute(session, stmt)).scalars():
             pass
         if not user or user.password is None:
             # Prevent timing attacks
-            verify_hash(DUMMY_HASH, password)
+            await averify_hash(DUMMY_HASH, password)
             return None
-        if not verify_hash(user.password, password):
+        if not await averify_hash(user.password, password):
             return None
+        if needs_rehash(user.password):
+            user.password = await ahash_password(password)
 
         login = cls(appuser_id=user.id, cookie=uuid.uuid4())
         session.add_all([login])
         return login
 
 
+class AppCookieRotation(Base):
+    """
+    A run of the cookie rotation (see rotation.py). Logins up to `until_id` get a
+    new nextcookie, `last_id` is where the next batch continues.
+    """
+
+    until_id: Mapped[int]
+    last_id: Mapped[int] = col(default=0)
+    rotated: Mapped[int] = col(default=0)
+    done: Mapped[bool] = col(default=False)
+
+
 class AppGroup(Base):
     zoperole: Mapped[str]
 
@@ -198,30 +262,234 @@ class AppPermXStc(Base):
     stc: Mapped[AppStc] = relationship()
 
 
-class AppStc_Paths(View):
+class Derived(DeclarativeBase):
+    """
+    Separate base for tables that are derived from other tables and kept up to date
+    by triggers, or that hold transient state. They are not created from the
+    mapping, but by executing `ddl` once the tables they are derived from exist.
+    """
+
+    type_annotation_map = {str: String(), int: BigInteger()}
+
+
+class AppStc_Paths(Derived):
+    """
+    Path from the root to each appstc, so checking for ancestors does not need a
+    recursive query. Triggers on appstc keep it up to date: Inserting a node adds
+    its path, moving a node rewrites the paths of its subtree only and deleting
+    cascades.
+    """
+
     __tablename__ = "appstc_paths"
     id: Mapped[int] = col("id", primary_key=True)
     id_path = col("id_path", ARRAY(Integer, as_tuple=True, zero_indexes=True))
     depth: Mapped[int] = col("depth")
-    # This is a simplified definition, the actual one does not use a recursive
-    # view, but a cached table so it can use indices. It also has some more
-    # columns, but these are the only ones we need.
-    definition = """
-        with recursive tree as (
-          select
-            appstc_id as id,
-            array[appstc_id] as id_path,
-            1 as depth
-          from appstc
-          where appstc_parent_appstc_id is null
-          union all
-          select
-            appstc_id,
-            id_path || array[appstc_id],
-            depth + 1
-          from appstc
-          join tree
-            on id = appstc_parent_appstc_id
-        )
-        select * from tree
+    # Also in schema/after.sql
+    ddl = """
+        create table if not exists appstc_paths (
+          id bigint primary key references appstc (appstc_id)
+            on update cascade on delete cascade,
+          id_path bigint[] not null,
+          depth integer not null
+        );
+        create index if not exists appstc_paths_id_path
+          on appstc_paths using gin (id_path);
+
+        create or replace function appstc_paths_insert()
+        returns trigger
+        language plpgsql
+        as $function$
+        declare
+          parent_path bigint[] := '{}';
+        begin
+          if new.appstc_parent_appstc_id is not null then
+            select id_path into strict parent_path
+            from appstc_paths
+            where id = new.appstc_parent_appstc_id;
+          end if;
+          insert into appstc_paths (id, id_path, depth)
+          values (
+            new.appstc_id,
+            parent_path || new.appstc_id,
+            cardinality(parent_path) + 1
+          );
+          return null;
+        end;
+        $function$;
+
+        create or replace function appstc_paths_move()
+        returns trigger
+        language plpgsql
+        as $function$
+        declare
+          old_path bigint[];
+          new_path bigint[] := '{}';
+        begin
+          select id_path into strict old_path
+          from appstc_paths
+          where id = new.appstc_id;
+          if new.appstc_parent_appstc_id is not null then
+            select id_path into strict new_path
+            from appstc_paths
+            where id = new.appstc_parent_appstc_id;
+            if new_path @> array[new.appstc_id] then
+              raise exception 'Can not move appstc % below itself', new.appstc_id;
+            end if;
+          end if;
+          new_path := new_path || new.appstc_id;
+          -- The old path of the moved node is a prefix of all paths in its subtree
+          update appstc_paths
+          set
+            id_path = new_path || id_path[cardinality(old_path) + 1:],
+            depth = depth - cardinality(old_path) + cardinality(new_path)
+          where id_path @> array[new.appstc_id];
+          return null;
+        end;
+        $function$;
+
+        create or replace trigger appstc_paths_insert
+          after insert on appstc
+          for each row execute function appstc_paths_insert();
+        create or replace trigger appstc_paths_move
+          after update of appstc_parent_appstc_id on appstc
+          for each row
+          when (
+            old.appstc_parent_appstc_id is distinct from new.appstc_parent_appstc_id
+          )
+          execute function appstc_paths_move();
+    """
+
+
+class AppUser_DefaultStc(Derived):
+    """
+    The "first" appstc of each user by (depth, id_path) of the ones it is assigned
+    to, used if a request names none. Triggers on appuserxstc and appstc_paths keep
+    it up to date, so the lookup is by primary key instead of sorting the
+    assignments on every request.
+    """
+
+    __tablename__ = "appuser_defaultstc"
+    id: Mapped[int] = col("id", primary_key=True)
+    appstc_id: Mapped[int] = col("appstc_id")
+    # Also in schema/after.sql
+    ddl = """
+        create table if not exists appuser_defaultstc (
+          id bigint primary key references appuser (appuser_id)
+            on update cascade on delete cascade,
+          appstc_id bigint not null
+        );
+
+        -- Recompute the default appstc of the given users. An upsert, as concurrent
+        -- transactions can refresh the same user.
+        create or replace function appuser_defaultstc_refresh(users bigint[])
+        returns void
+        language sql
+        as $function$
+          insert into appuser_defaultstc (id, appstc_id)
+          select distinct on (appuserxstc_appuser_id)
+            appuserxstc_appuser_id,
+            appuserxstc_appstc_id
+          from appuserxstc
+          join appstc_paths
+            on id = appuserxstc_appstc_id
+          where appuserxstc_appuser_id = any(users)
+          order by appuserxstc_appuser_id, depth, id_path
+          on conflict (id) do update
+          set appstc_id = excluded.appstc_id
+          where appuser_defaultstc.appstc_id <> excluded.appstc_id;
+          delete from appuser_defaultstc
+          where
+            id = any(users)
+            and not exists (
+              select from appuserxstc
+              where appuserxstc_appuser_id = appuser_defaultstc.id
+            );
+        $function$;
+
+        -- Statement level, so changing many assignments at once refreshes each user
+        -- once. Only the transition tables of the operation are referenced.
+        create or replace function appuser_defaultstc_assign()
+        returns trigger
+        language plpgsql
+        as $function$
+        begin
+          if tg_op = 'INSERT' then
+            perform appuser_defaultstc_refresh(array(
+              select distinct appuserxstc_appuser_id from new_rows
+            ));
+          elsif tg_op = 'DELETE' then
+            perform appuser_defaultstc_refresh(array(
+              select distinct appuserxstc_appuser_id from old_rows
+            ));
+          else
+            perform appuser_defaultstc_refresh(array(
+              select appuserxstc_appuser_id from old_rows
+              union
+              select appuserxstc_appuser_id from new_rows
+            ));
+          end if;
+          return null;
+        end;
+        $function$;
+
+        -- Moving a node changes the paths of its subtree and thereby the order
+        create or replace function appuser_defaultstc_move()
+        returns trigger
+        language plpgsql
+        as $function$
+        begin
+          perform appuser_defaultstc_refresh(array(
+            select distinct appuserxstc_appuser_id
+            from appuserxstc
+            join new_rows
+              on new_rows.id = appuserxstc_appstc_id
+            join old_rows
+              on old_rows.id = new_rows.id
+            where old_rows.id_path is distinct from new_rows.id_path
+          ));
+          return null;
+        end;
+        $function$;
+
+        -- A trigger with transition tables can only have one event
+        create or replace trigger appuser_defaultstc_assign
+          after insert on appuserxstc
+          referencing new table as new_rows
+          for each statement execute function appuser_defaultstc_assign();
+        create or replace trigger appuser_defaultstc_reassign
+          after update on appuserxstc
+          referencing old table as old_rows new table as new_rows
+          for each statement execute function appuser_defaultstc_assign();
+        create or replace trigger appuser_defaultstc_unassign
+          after delete on appuserxstc
+          referencing old table as old_rows
+          for each statement execute function appuser_defaultstc_assign();
+        create or replace trigger appuser_defaultstc_move
+          after update on appstc_paths
+          referencing old table as old_rows new table as new_rows
+          for each statement execute function appuser_defaultstc_move();
+    """
+
+
+class AppThrottle(Derived):
+    """
+    Token buckets shared by all workers (see throttle.py). Unlogged, since losing
+    them in a crash only resets the limits.
+    """
+
+    __tablename__ = "appthrottle"
+    key: Mapped[str] = col("key", primary_key=True)
+    tokens: Mapped[float] = col("tokens")
+    rate: Mapped[float] = col("rate")
+    burst: Mapped[float] = col("burst")
+    updated: Mapped[datetime] = col("updated", DateTime(timezone=True))
+    # Also in schema/after.sql
+    ddl = """
+        create unlogged table if not exists appthrottle (
+          key text primary key,
+          tokens float8 not null,
+          rate float8 not null,
+          burst float8 not null,
+          updated timestamptz not null
+        );
     """
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional, Union
+
+from sqlalchemy import Engine, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """
+    Counters about checkouts from a pool, in addition to what the pool itself knows
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, waited: float, timeout: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timeout
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def as_dict(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout had to wait and how many timed out
+    """
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.stats = PoolStats()
+
+    def recreate(self) -> QueuePool:
+        # Keep the counters if the pool is recreated, e.g. on dispose()
+        pool = super().recreate()
+        pool.stats = self.stats  # type: ignore[attr-defined]
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timeout = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timeout = True
+            raise
+        finally:
+            self.stats.record(time.perf_counter() - start, timeout)
+
+
+class MeteredAsyncQueuePool(MeteredQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_status(pool: Pool) -> dict[str, float]:
+    """
+    Current state of the pool and its counters
+    """
+    result: dict[str, float] = {}
+    if isinstance(pool, QueuePool):
+        result.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, MeteredQueuePool):
+        result.update(pool.stats.as_dict())
+    return result
+
+
+class _EngineTask(ABC):
+    """
+    Runs check() (or acheck() for async engines) every `interval` seconds, starting
+    right away. Runs in a daemon thread for sync engines and as a task on the running
+    event loop for async engines.
+    """
+
+    name = "engine-task"
+
+    def __init__(self, engine: Union[Engine, AsyncEngine], interval: float):
+        self.engine = engine
+        self.interval = interval
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        engine = self.engine
+        if isinstance(engine, AsyncEngine):
+            self._task = asyncio.get_running_loop().create_task(self._run_async(engine))
+        else:
+            threading.Thread(
+                target=self._run, args=(engine,), name=self.name, daemon=True
+            ).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    @abstractmethod
+    def check(self, engine: Engine) -> None: ...
+
+    @abstractmethod
+    async def acheck(self, engine: AsyncEngine) -> None: ...
+
+    def _run(self, engine: Engine) -> None:
+        while True:
+            # Whatever goes wrong, the next run might work
+            try:
+                self.check(engine)
+            except Exception:
+                logger.exception("%s failed", self.name)
+            if self._stop.wait(self.interval):
+                return
+
+    async def _run_async(self, engine: AsyncEngine) -> None:
+        while not self._stop.is_set():
+            try:
+                await self.acheck(engine)
+            except Exception:
+                logger.exception("%s failed", self.name)
+            await asyncio.sleep(self.interval)
+
+
+class PoolValidator(_EngineTask):
+    """
+    Periodically checks the idle connections of a pool with a trivial query, instead
+    of pinging on every checkout. If a connection turns out to be dead, SQLAlchemy
+    invalidates the whole pool, so the following checkouts reconnect instead of
+    failing.
+    """
+
+    name = "pool-validator"
+
+    def _idle(self) -> int:
+        pool = self.engine.pool
+        return pool.checkedin() if isinstance(pool, QueuePool) else 0
+
+    def check(self, engine: Engine) -> None:
+        # The queue is FIFO, so each checkout gets the next idle connection
+        for _ in range(self._idle()):
+            try:
+                with engine.connect() as conn:
+                    conn.exec_driver_sql("select 1")
+            except exc.DBAPIError:
+                logger.warning("Pool validation failed", exc_info=True)
+                break
+
+    async def acheck(self, engine: AsyncEngine) -> None:
+        for _ in range(self._idle()):
+            try:
+                async with engine.connect() as conn:
+                    await conn.exec_driver_sql("select 1")
+            except exc.DBAPIError:
+                logger.warning("Pool validation failed", exc_info=True)
+                break
+
+
+# Seconds the replica is behind. Zero if it replayed everything it received while
+# streaming, since then the last replayed transaction might just be old.
+_LAG_QUERY = """
+    select
+      case
+        when not pg_is_in_recovery() then 0
+        when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+          and exists (
+            select 1 from pg_stat_wal_receiver where status = 'streaming'
+          )
+          then 0
+        else extract(epoch from now() - pg_last_xact_replay_timestamp())
+      end
+"""
+
+
+class ReplicaMonitor(_EngineTask):
+    """
+    Periodically measures the replication lag of a replica. `lag` is None if it is
+    not known (yet), e.g. because the replica is not reachable.
+    """
+
+    name = "replica-monitor"
+
+    def __init__(self, engine: Union[Engine, AsyncEngine], interval: float):
+        super().__init__(engine, interval)
+        self.lag: Optional[float] = None
+
+    def usable(self, max_lag: float) -> bool:
+        lag = self.lag
+        return lag is not None and lag <= max_lag
+
+    def check(self, engine: Engine) -> None:
+        try:
+            with engine.connect() as conn:
+                lag = conn.exec_driver_sql(_LAG_QUERY).scalar()
+        except Exception:
+            self._failed()
+        else:
+            self.lag = None if lag is None else float(lag)
+
+    async def acheck(self, engine: AsyncEngine) -> None:
+        try:
+            async with engine.connect() as conn:
+                lag = (await conn.exec_driver_sql(_LAG_QUERY)).scalar()
+        except Exception:
+            self._failed()
+        else:
+            self.lag = None if lag is None else float(lag)
+
+    def _failed(self) -> None:
+        if self.lag is not None:
+            logger.warning("Replica not reachable, using the primary", exc_info=True)
+        self.lag = None
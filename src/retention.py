@@ -0,0 +1,178 @@
+"""
+Retention of logins: Logins that are older than settings.login_max_age_days are
+ended, logins that ended (appuserlogin_endtime) longer than
+settings.login_retention_days ago are deleted. Both are done in batches, each in its
+own short transaction, so appuserlogin and its indexes stay sized to the active
+sessions without long-running statements. Since each batch only removes rows from
+the set it selects from, an interrupted run needs no state to be continued.
+With settings.throttle_shared, buckets of throttle.py that are full again are
+deleted as well.
+
+    python -m src.retention [--batch-size 1000] [--pause 0.1]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import TextClause, text
+
+from .auth import forget_logins
+from .dbsession import close, commit, db, execute, rollback, settings
+from .throttle import PRUNE
+
+logger = logging.getLogger(__name__)
+
+# Ending a login fires appuserlogin_notify_done, which drops it from the caches
+_EXPIRE = text(
+    """
+    with batch as (
+      select appuserlogin_id
+      from appuserlogin
+      where not appuserlogin_done
+        and appuserlogin_createtime < :before
+      order by appuserlogin_createtime
+      limit :batch_size
+      for update skip locked
+    )
+    update appuserlogin
+    set
+      appuserlogin_done = true,
+      appuserlogin_endtime = now(),
+      appuserlogin_cookie = null,
+      appuserlogin_nextcookie = null
+    from batch
+    where appuserlogin.appuserlogin_id = batch.appuserlogin_id
+    """
+)
+
+_DELETE = text(
+    """
+    with batch as (
+      select appuserlogin_id
+      from appuserlogin
+      where appuserlogin_done
+        and appuserlogin_endtime < :before
+      order by appuserlogin_endtime
+      limit :batch_size
+      for update skip locked
+    )
+    delete from appuserlogin
+    using batch
+    where appuserlogin.appuserlogin_id = batch.appuserlogin_id
+    """
+)
+
+
+async def _batches(
+    statement: TextClause, before: datetime, batch_size: int, pause: float
+) -> int:
+    """
+    Execute the statement until it no longer hits any rows. Returns the total
+    number of rows.
+    """
+    total = 0
+    while True:
+        session = db.session()
+        try:
+            result = await execute(
+                session, statement, {"before": before, "batch_size": batch_size}
+            )
+            await commit(session)
+        except Exception:
+            await rollback(session)
+            raise
+        finally:
+            await close(session)
+        count = result.rowcount  # type: ignore[attr-defined]
+        if not count:
+            return total
+        total += count
+        await asyncio.sleep(pause)
+
+
+async def _prune_buckets() -> None:
+    session = db.session()
+    try:
+        await execute(session, PRUNE)
+        await commit(session)
+    except Exception:
+        await rollback(session)
+        raise
+    finally:
+        await close(session)
+
+
+async def run_retention(
+    batch_size: Optional[int] = None, pause: Optional[float] = None
+) -> tuple[int, int]:
+    """
+    End expired logins and delete old ended ones. Returns how many of each.
+    """
+    batch_size = (
+        settings.login_retention_batch_size if batch_size is None else batch_size
+    )
+    pause = settings.login_retention_pause if pause is None else pause
+    now = datetime.now(timezone.utc)
+    expired = 0
+    if settings.login_max_age_days > 0:
+        before = now - timedelta(days=settings.login_max_age_days)
+        expired = await _batches(_EXPIRE, before, batch_size, pause)
+        if expired:
+            forget_logins()
+    before = now - timedelta(days=settings.login_retention_days)
+    deleted = await _batches(_DELETE, before, batch_size, pause)
+    if settings.throttle_shared:
+        await _prune_buckets()
+    logger.info("Login retention: %s logins ended, %s deleted", expired, deleted)
+    return expired, deleted
+
+
+class RetentionScheduler:
+    """
+    Runs the retention every settings.login_retention_interval seconds (0 disables
+    it), as a task on the event loop of the app. Several workers doing so at the
+    same time skip each other's rows.
+    """
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and settings.login_retention_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.login_retention_interval)
+            try:
+                await run_retention()
+            except Exception:
+                logger.exception("Login retention failed")
+
+
+retention_scheduler = RetentionScheduler()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="End expired logins and delete old ended ones"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=settings.login_retention_batch_size
+    )
+    parser.add_argument("--pause", type=float, default=settings.login_retention_pause)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    asyncio.run(run_retention(args.batch_size, args.pause))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Roles as bitmasks. The registry interns role names (appgroup_zoperole) into bit
+positions, so the roles of a user are a single int. Requirements are built from role
+names with AllOf, AnyOf and Not and compiled once into a check of such an int, which
+takes a few integer operations regardless of how many roles the user has.
+"""
+
+import threading
+from typing import Callable, Iterable, Optional, Union
+
+from .dbsession import settings
+from .shmcache import SharedNames, shared_store
+
+
+class RoleRegistry:
+    """
+    Assigns each role name the next free bit on first use. Roles are few (one per
+    appgroup), so the masks stay small. With `shared` names (see shmcache.py), the
+    bits are assigned in the order the names were added there, so a mask means the
+    same in all processes sharing them.
+    """
+
+    def __init__(self, shared: Optional[SharedNames] = None) -> None:
+        self.shared = shared
+        self._bits: dict[str, int] = {}
+        self._names: list[str] = []
+        self._lock = threading.Lock()
+
+    def _add(self, name: str) -> None:
+        """
+        Must hold the lock
+        """
+        self._bits[name] = 1 << len(self._names)
+        self._names.append(name)
+
+    def _read_shared(self) -> None:
+        """
+        Must hold the lock
+        """
+        if self.shared is not None:
+            for name in self.shared.get()[len(self._names) :]:
+                self._add(name)
+
+    def bit(self, name: str) -> int:
+        bit = self._bits.get(name)
+        if bit is None:
+            with self._lock:
+                if name not in self._bits:
+                    if self.shared is None:
+                        self._add(name)
+                    else:
+                        self.shared.index(name)
+                        self._read_shared()
+                bit = self._bits[name]
+        return bit
+
+    def mask(self, names: Iterable[str]) -> int:
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def names(self, mask: int) -> list[str]:
+        """
+        The roles in the mask, sorted by name
+        """
+        if mask.bit_length() > len(self._names):
+            # Added by another process
+            with self._lock:
+                self._read_shared()
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self._names[low.bit_length() - 1])
+            mask ^= low
+        return sorted(result)
+
+
+registry = RoleRegistry(shared_store().names if settings.shm_cache_path else None)
+
+
+class AllOf:
+    def __init__(self, *requirements: "Requirement"):
+        self.requirements = requirements
+
+    def __str__(self) -> str:
+        return f"all_of({', '.join(map(str, self.requirements))})"
+
+
+class AnyOf:
+    def __init__(self, *requirements: "Requirement"):
+        self.requirements = requirements
+
+    def __str__(self) -> str:
+        return f"any_of({', '.join(map(str, self.requirements))})"
+
+
+class Not:
+    def __init__(self, requirement: "Requirement"):
+        self.requirement = requirement
+
+    def __str__(self) -> str:
+        return f"not({self.requirement})"
+
+
+# A role name or an expression of them
+Requirement = Union[str, AllOf, AnyOf, Not]
+
+
+def compile_requirement(requirement: Requirement) -> Callable[[int], bool]:
+    """
+    A function telling whether a mask of roles fulfills the requirement. The role
+    names among the operands of AllOf and AnyOf are merged into one mask, so only
+    nested expressions cost a further call.
+    """
+    if isinstance(requirement, str):
+        bit = registry.bit(requirement)
+        return lambda mask: bool(mask & bit)
+    if isinstance(requirement, Not):
+        inner = compile_requirement(requirement.requirement)
+        return lambda mask: not inner(mask)
+    names = [r for r in requirement.requirements if isinstance(r, str)]
+    required = registry.mask(names)
+    nested = [
+        compile_requirement(r)
+        for r in requirement.requirements
+        if not isinstance(r, str)
+    ]
+    if isinstance(requirement, AllOf):
+        if not nested:
+            return lambda mask: mask & required == required
+        return lambda mask: (
+            mask & required == required and all(check(mask) for check in nested)
+        )
+    if not nested:
+        return lambda mask: bool(mask & required)
+    return lambda mask: bool(mask & required) or any(check(mask) for check in nested)
@@ -0,0 +1,266 @@
+"""
+Rotation of login cookies: Every login that is not done gets a new nextcookie,
+which the user is told to switch to with the next request.
+Instead of a single UPDATE over all logins, which holds the row locks of all of
+them until it is finished, logins are rotated in batches of increasing ID, each in
+its own short transaction. The progress of a run is stored in appcookierotation,
+so an interrupted run is continued by the next process that runs a batch. Each
+batch locks the row of the run, so several processes can work on the same run
+without rotating a login twice.
+
+    python -m src.rotation [--batch-size 1000] [--pause 0.1]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy import func, not_, select, text
+
+from .auth import forget_login
+from .dbsession import AnySession, close, commit, db, execute, rollback, settings
+from .model import AppCookieRotation, AppUserLogin
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Progress:
+    """
+    State of a run after a batch, detached from the session
+    """
+
+    id: int
+    until_id: int
+    last_id: int
+    rotated: int
+    done: bool
+
+
+_BATCH = text(
+    """
+    with batch as (
+      select appuserlogin_id
+      from appuserlogin
+      where appuserlogin_id > :last_id
+        and appuserlogin_id <= :until_id
+        and not appuserlogin_done
+      order by appuserlogin_id
+      limit :batch_size
+    ),
+    rotated as (
+      update appuserlogin
+      set appuserlogin_nextcookie = uuidv4()
+      from batch
+      where appuserlogin.appuserlogin_id = batch.appuserlogin_id
+        and not appuserlogin.appuserlogin_done
+      returning appuserlogin.appuserlogin_id
+    )
+    select
+      (select max(appuserlogin_id) from batch) as last_id,
+      (select count(*) from rotated) as rotated,
+      (select array_agg(appuserlogin_id) from rotated) as ids
+    """
+)
+
+# Tells the other workers which logins to drop from their caches, in as few
+# notifications as the limit of their payload (8000 bytes) allows
+_NOTIFY = text(
+    """
+    select pg_notify(
+      'auth_invalidate',
+      'appuserlogin:' || string_agg(cast(id as text), ',')
+    )
+    from (
+      select id, (row_number() over () - 1) / 300 as chunk
+      from unnest(cast(:ids as bigint[])) as id
+    ) as ids
+    group by chunk
+    """
+)
+
+
+async def start_rotation(session: AnySession) -> AppCookieRotation:
+    """
+    Start a run covering all current logins, unless one is still unfinished, in
+    which case that one is returned. New logins get a fresh cookie anyway.
+    """
+    # Serializes concurrent starts, released at the end of the transaction
+    await execute(
+        session, select(func.pg_advisory_xact_lock(func.hashtext("appcookierotation")))
+    )
+    current = await _current(session)
+    if current is not None:
+        return current
+    until_id = (await execute(session, select(func.max(AppUserLogin.id)))).scalar()
+    run = AppCookieRotation(until_id=until_id or 0)
+    session.add(run)
+    return run
+
+
+async def _current(
+    session: AnySession, lock: bool = False
+) -> Optional[AppCookieRotation]:
+    stmt = (
+        select(AppCookieRotation)
+        .where(not_(AppCookieRotation.done))
+        .order_by(AppCookieRotation.id)
+        .limit(1)
+    )
+    if lock:
+        stmt = stmt.with_for_update()
+    return (await execute(session, stmt)).scalar_one_or_none()
+
+
+async def rotate_batch(session: AnySession, batch_size: int) -> Optional[Progress]:
+    """
+    Rotate the next batch of the unfinished run, if there is one, and commit.
+    Returns the progress of the run.
+    """
+    run = await _current(session, lock=True)
+    if run is None:
+        await commit(session)
+        return None
+    row = (
+        await execute(
+            session,
+            _BATCH,
+            {
+                "last_id": run.last_id,
+                "until_id": run.until_id,
+                "batch_size": batch_size,
+            },
+        )
+    ).one()
+    if row.last_id is None:
+        run.done = True
+    else:
+        run.last_id = row.last_id
+        run.rotated += row.rotated
+    progress = Progress(run.id, run.until_id, run.last_id, run.rotated, run.done)
+    if row.ids:
+        # Cached logins do not know their nextcookie, here and in other workers
+        await execute(session, _NOTIFY, {"ids": row.ids})
+    await commit(session)
+    for appuserlogin_id in row.ids or ():
+        forget_login(appuserlogin_id)
+    return progress
+
+
+async def run_rotation(
+    batch_size: Optional[int] = None,
+    pause: Optional[float] = None,
+    progress: Optional[Callable[[Progress], None]] = None,
+) -> None:
+    """
+    Rotate batches until no unfinished run is left, pausing between them so the
+    rotation does not starve the requests. Uses its own sessions, so it can run as
+    a background task.
+    """
+    batch_size = (
+        settings.cookie_rotation_batch_size if batch_size is None else batch_size
+    )
+    pause = settings.cookie_rotation_pause if pause is None else pause
+    while True:
+        session = db.session()
+        try:
+            state = await rotate_batch(session, batch_size)
+        except Exception:
+            await rollback(session)
+            raise
+        finally:
+            await close(session)
+        if state is None:
+            return
+        logger.info(
+            "Cookie rotation %s: %s logins rotated, at ID %s of %s",
+            state.id,
+            state.rotated,
+            state.last_id,
+            state.until_id,
+        )
+        if progress is not None:
+            progress(state)
+        if not state.done:
+            await asyncio.sleep(pause)
+
+
+class RotationScheduler:
+    """
+    Starts a run every settings.cookie_rotation_interval seconds (0 disables it) and
+    continues unfinished runs, e.g. of a process that was stopped. Runs as a task on
+    the event loop of the app.
+    """
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and settings.cookie_rotation_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _start_if_due(self) -> None:
+        session = db.session()
+        try:
+            last = (
+                await execute(session, select(func.max(AppCookieRotation.createtime)))
+            ).scalar()
+            if last is not None and (
+                time.time() - last.timestamp() < settings.cookie_rotation_interval
+            ):
+                return
+            await start_rotation(session)
+            await commit(session)
+        finally:
+            await close(session)
+
+    async def _run(self) -> None:
+        # Check more often than the interval, so a run interrupted by a restart
+        # is continued soon
+        check = min(settings.cookie_rotation_interval, 60)
+        while True:
+            try:
+                await self._start_if_due()
+                await run_rotation()
+            except Exception:
+                logger.exception("Cookie rotation failed")
+            await asyncio.sleep(check)
+
+
+rotation_scheduler = RotationScheduler()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rotate the cookies of all active logins, continuing an "
+        "interrupted run if there is one"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=settings.cookie_rotation_batch_size
+    )
+    parser.add_argument("--pause", type=float, default=settings.cookie_rotation_pause)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    async def rotate() -> None:
+        session = db.session()
+        try:
+            await start_rotation(session)
+            await commit(session)
+        finally:
+            await close(session)
+        await run_rotation(args.batch_size, args.pause)
+
+    asyncio.run(rotate())
+
+
+if __name__ == "__main__":
+    main()
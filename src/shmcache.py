@@ -0,0 +1,483 @@
+"""
+Caches shared by all worker processes of a host, in a memory mapped file (see
+settings.shm_cache_path), so each entry is stored and warmed once instead of once
+per worker. The file holds a region per cache, each a fixed number of slots of
+fixed size, grouped into sets of WAYS slots. A key is hashed to a set and stored in
+one of its slots, replacing the one that expires first if all are taken.
+
+Reads take no lock. A writer marks the slot as being written by making its
+sequence number odd and stores a CRC of the content, so a reader that copies a slot
+while it is written sees either the odd number or a mismatching CRC and treats the
+slot as empty. Writers lock the set they write to, with a lock that works across
+processes (fcntl) as well as between threads.
+
+Clearing a region increments its epoch, which makes all slots written before
+invalid at once. Like TTLCache, every invalidation also increments the generation,
+so a value computed before it is not stored. Both counters are shared, so an
+invalidation in one worker applies to all.
+
+After the regions, the file holds a list of names that is only appended to, so all
+processes number the names alike (see SharedNames).
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, Iterator, Optional, TypeVar
+
+from .dbsession import settings
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+MAGIC = b"AUTHSHM1"
+# Slots per set
+WAYS = 8
+# Locks per region, each set uses the one of its number modulo STRIPES
+STRIPES = 64
+HEADER_SIZE = 4096
+# Offset of the bytes locked with fcntl, which are not otherwise used
+_LOCK_BASE = 1024
+_NAMES_LOCK = _LOCK_BASE - 1
+# Bytes for the names of SharedNames
+NAMES_SIZE = 1 << 20
+# Magic, digest of the layout, secret for cache keys
+_HEADER = struct.Struct("<8s16s32s")
+# Generation and epoch of a region
+_REGION = struct.Struct("<QQ")
+_REGION_SIZE = 64
+# Sequence number, CRC of the rest, epoch, expiry (time.monotonic(), which is the
+# same clock for all processes), fingerprint of the key and length of the value
+_SLOT = struct.Struct("<IIQd16sH6x")
+_SEQ = struct.Struct("<I")
+_TAG = struct.Struct("<q")
+# Number of names, each is stored as its length and UTF-8 bytes
+_COUNT = struct.Struct("<I")
+_LENGTH = struct.Struct("<H")
+
+
+class _Lock:
+    """
+    Exclusive lock on one byte of the file. fcntl locks are held per process, so a
+    thread lock is needed as well.
+    """
+
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self.offset = offset
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> None:
+        self._lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.offset)
+
+    def __exit__(self, *exc) -> None:
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+        self._lock.release()
+
+
+@dataclass(frozen=True)
+class Region:
+    index: int
+    offset: int
+    slots: int
+    value_size: int
+
+    @property
+    def slot_size(self) -> int:
+        return _SLOT.size + -(-self.value_size // 8) * 8
+
+    @property
+    def tags(self) -> int:
+        """
+        Offset of the tags of the slots, see SharedTTLCache.discard_tag
+        """
+        return self.offset + _REGION_SIZE
+
+    @property
+    def data(self) -> int:
+        return self.tags + _TAG.size * self.slots
+
+    @property
+    def size(self) -> int:
+        return _REGION_SIZE + (_TAG.size + self.slot_size) * self.slots
+
+
+class SharedStore:
+    """
+    The mapped file with a region of `slots` slots per name, each holding values of
+    up to `value_size` bytes. The first process creates the file. If it exists with
+    another layout, it is replaced, processes still using the old one keep it until
+    they end.
+    """
+
+    def __init__(self, path: str, slots: dict[str, int], value_size: int):
+        self.regions: dict[str, Region] = {}
+        offset = HEADER_SIZE
+        for index, (name, count) in enumerate(slots.items()):
+            region = Region(index, offset, -(-count // WAYS) * WAYS, value_size)
+            self.regions[name] = region
+            offset += region.size
+        self.names_offset = offset
+        self.size = offset + NAMES_SIZE
+        layout = hashlib.blake2b(
+            repr((self.size, sorted(self.regions.items()))).encode(), digest_size=16
+        ).digest()
+        self.fd = self._open(path, layout)
+        self.mm = mmap.mmap(self.fd, self.size)
+        self.secret: bytes = _HEADER.unpack_from(self.mm, 0)[2]
+        self.names = SharedNames(self, self.names_offset, NAMES_SIZE)
+
+    def _open(self, path: str, layout: bytes) -> int:
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self._usable(fd, path, layout):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return fd
+            # Also releases the lock
+            os.close(fd)
+
+    def _usable(self, fd: int, path: str, layout: bytes) -> bool:
+        """
+        Whether the locked file can be used, after initializing it if it is new
+        """
+        try:
+            if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                # Replaced by another process while we waited for the lock
+                return False
+        except FileNotFoundError:
+            return False
+        size = os.fstat(fd).st_size
+        if size == 0:
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, _HEADER.pack(MAGIC, layout, os.urandom(32)), 0)
+            for region in self.regions.values():
+                # Epoch 0 marks empty slots
+                os.pwrite(fd, _REGION.pack(0, 1), region.offset)
+            return True
+        if size == self.size and os.pread(fd, 24, 0) == MAGIC + layout:
+            return True
+        os.unlink(path)
+        return False
+
+
+class SharedNames:
+    """
+    A list of names in a SharedStore, only ever appended to, so the position of a
+    name is the same in all processes. Reads take no lock, the count is increased
+    after a name is written.
+    """
+
+    def __init__(self, store: SharedStore, offset: int, size: int):
+        self.store = store
+        self.offset = offset
+        self.size = size
+        self._names: list[str] = []
+        self._index: dict[str, int] = {}
+        # Where the next name not read yet starts
+        self._pos = offset + _COUNT.size
+        self._lock = threading.Lock()
+        self._file_lock = _Lock(store.fd, _NAMES_LOCK)
+
+    def _read(self) -> None:
+        """
+        Must hold the lock
+        """
+        mm = self.store.mm
+        count = _COUNT.unpack_from(mm, self.offset)[0]
+        while len(self._names) < count:
+            length = _LENGTH.unpack_from(mm, self._pos)[0]
+            start = self._pos + _LENGTH.size
+            name = mm[start : start + length].decode()
+            self._index[name] = len(self._names)
+            self._names.append(name)
+            self._pos = start + length
+
+    def get(self) -> list[str]:
+        with self._lock:
+            self._read()
+            return list(self._names)
+
+    def index(self, name: str) -> int:
+        """
+        The position of the name, appending it if it is not in the list yet
+        """
+        with self._lock:
+            self._read()
+            if name in self._index:
+                return self._index[name]
+            with self._file_lock:
+                self._read()
+                if name in self._index:
+                    return self._index[name]
+                data = name.encode()
+                end = self._pos + _LENGTH.size + len(data)
+                if end > self.offset + self.size:
+                    raise RuntimeError("No room for more names in the shared store")
+                mm = self.store.mm
+                _LENGTH.pack_into(mm, self._pos, len(data))
+                mm[self._pos + _LENGTH.size : end] = data
+                _COUNT.pack_into(mm, self.offset, len(self._names) + 1)
+                self._read()
+            return self._index[name]
+
+
+class SharedTTLCache(Generic[K, V]):
+    """
+    A cache in a region of a SharedStore, with the interface of TTLCache. Values are
+    stored as bytes by `encode` and `decode`, values longer than the region allows
+    are not cached. Keys are stored as a fingerprint of their repr, so they must
+    have the same repr in all processes. Entries are replaced by expiry rather than
+    by use.
+    """
+
+    def __init__(
+        self,
+        store: SharedStore,
+        name: str,
+        ttl: float,
+        encode: Callable[[V], bytes],
+        decode: Callable[[bytes], V],
+        tag: Optional[Callable[[V], int]] = None,
+    ):
+        self.store = store
+        self.region = store.regions[name]
+        self.maxsize = self.region.slots
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self.tag = tag
+        base = _LOCK_BASE + self.region.index * (STRIPES + 1)
+        self._stripes = [_Lock(store.fd, base + i) for i in range(STRIPES)]
+        self._region_lock = _Lock(store.fd, base + STRIPES)
+
+    @property
+    def generation(self) -> int:
+        return _REGION.unpack_from(self.store.mm, self.region.offset)[0]
+
+    def _epoch(self) -> int:
+        return _REGION.unpack_from(self.store.mm, self.region.offset)[1]
+
+    def _bump(self, epoch: int = 0) -> None:
+        with self._region_lock:
+            generation, current = _REGION.unpack_from(self.store.mm, self.region.offset)
+            _REGION.pack_into(
+                self.store.mm, self.region.offset, generation + 1, current + epoch
+            )
+
+    @staticmethod
+    def _fingerprint(key: K) -> bytes:
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    def _set_of(self, fingerprint: bytes) -> int:
+        return int.from_bytes(fingerprint[:8], "little") % (self.maxsize // WAYS)
+
+    def _slots(
+        self, set_index: int
+    ) -> Iterator[tuple[int, Optional[tuple[int, float, bytes, bytes]]]]:
+        """
+        Index and content (epoch, expiry, fingerprint, value) of the slots of the
+        set, None for slots being written. The set is copied at once.
+        """
+        size = self.region.slot_size
+        first = set_index * WAYS
+        start = self.region.data + first * size
+        buf = self.store.mm[start : start + WAYS * size]
+        for way in range(WAYS):
+            offset = way * size
+            seq, crc, epoch, expires, fingerprint, length = _SLOT.unpack_from(
+                buf, offset
+            )
+            end = offset + _SLOT.size + length
+            if (
+                seq & 1
+                or length > self.region.value_size
+                or zlib.crc32(buf[offset + 8 : end]) != crc
+            ):
+                yield first + way, None
+            else:
+                value = buf[offset + _SLOT.size : end]
+                yield first + way, (epoch, expires, fingerprint, value)
+
+    def _write(
+        self,
+        index: int,
+        epoch: int,
+        expires: float,
+        fingerprint: bytes,
+        value: bytes,
+        tag: int,
+    ) -> None:
+        """
+        Must hold the lock of the set
+        """
+        mm = self.store.mm
+        offset = self.region.data + index * self.region.slot_size
+        seq = (_SEQ.unpack_from(mm, offset)[0] | 1) & 0xFFFFFFFF
+        _SEQ.pack_into(mm, offset, seq)
+        body = _SLOT.pack(0, 0, epoch, expires, fingerprint, len(value))[8:] + value
+        mm[offset + 8 : offset + 8 + len(body)] = body
+        _SEQ.pack_into(mm, offset + 4, zlib.crc32(body))
+        _TAG.pack_into(mm, self.region.tags + index * _TAG.size, tag)
+        _SEQ.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF)
+
+    def _clear_slot(self, index: int) -> None:
+        self._write(index, 0, 0.0, bytes(16), b"", 0)
+
+    def __len__(self) -> int:
+        epoch = self._epoch()
+        now = time.monotonic()
+        return sum(
+            1
+            for set_index in range(self.maxsize // WAYS)
+            for _, slot in self._slots(set_index)
+            if slot is not None and slot[0] == epoch and slot[1] >= now
+        )
+
+    def get(self, key: K) -> Optional[V]:
+        if self.maxsize <= 0:
+            return None
+        fingerprint = self._fingerprint(key)
+        epoch = self._epoch()
+        now = time.monotonic()
+        for _, slot in self._slots(self._set_of(fingerprint)):
+            if (
+                slot is not None
+                and slot[2] == fingerprint
+                and slot[0] == epoch
+                and slot[1] >= now
+            ):
+                return self.decode(slot[3])
+        return None
+
+    def set(
+        self,
+        key: K,
+        value: V,
+        generation: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if generation is not None and generation != self.generation:
+            return
+        data = self.encode(value)
+        if len(data) > self.region.value_size:
+            return
+        fingerprint = self._fingerprint(key)
+        set_index = self._set_of(fingerprint)
+        epoch = self._epoch()
+        now = time.monotonic()
+        with self._stripes[set_index % STRIPES]:
+            # The slot of the same key, else a free one, else the first to expire
+            candidates = []
+            for index, slot in self._slots(set_index):
+                if slot is not None and slot[2] == fingerprint:
+                    candidates.append((0, 0.0, index))
+                elif slot is None or slot[0] != epoch or slot[1] < now:
+                    candidates.append((1, 0.0, index))
+                else:
+                    candidates.append((2, slot[1], index))
+            index = min(candidates)[2]
+            self._write(
+                index,
+                epoch,
+                now + ttl,
+                fingerprint,
+                data,
+                self.tag(value) if self.tag else 0,
+            )
+        # Invalidated while we were writing, the value might be outdated
+        if generation is not None and generation != self.generation:
+            self._remove(set_index, fingerprint)
+
+    def _remove(self, set_index: int, fingerprint: bytes) -> Optional[bytes]:
+        epoch = self._epoch()
+        with self._stripes[set_index % STRIPES]:
+            for index, slot in self._slots(set_index):
+                if slot is not None and slot[2] == fingerprint:
+                    self._clear_slot(index)
+                    return slot[3] if slot[0] == epoch else None
+        return None
+
+    def pop(self, key: K) -> Optional[V]:
+        self._bump()
+        if self.maxsize <= 0:
+            return None
+        fingerprint = self._fingerprint(key)
+        value = self._remove(self._set_of(fingerprint), fingerprint)
+        return None if value is None else self.decode(value)
+
+    def discard_tag(self, tag: int) -> None:
+        """
+        Remove the entries with the given tag. The tags are stored next to each
+        other, so they are found by searching the bytes without decoding any value.
+        """
+        self._bump()
+        if not tag:
+            return
+        mm = self.store.mm
+        needle = _TAG.pack(tag)
+        start = self.region.tags
+        end = start + _TAG.size * self.maxsize
+        pos = mm.find(needle, start, end)
+        while pos != -1:
+            if (pos - start) % _TAG.size:
+                pos = mm.find(needle, pos + 1, end)
+                continue
+            index = (pos - start) // _TAG.size
+            with self._stripes[index // WAYS % STRIPES]:
+                if _TAG.unpack_from(mm, pos)[0] == tag:
+                    self._clear_slot(index)
+            pos = mm.find(needle, pos + _TAG.size, end)
+
+    def discard_where(self, predicate: Callable[[V], bool]) -> None:
+        """
+        Remove all entries whose value matches. This decodes every entry, so it is
+        only meant for rare invalidations, see also discard_tag().
+        """
+        self._bump()
+        epoch = self._epoch()
+        for set_index in range(self.maxsize // WAYS):
+            for _, slot in self._slots(set_index):
+                if (
+                    slot is not None
+                    and slot[0] == epoch
+                    and predicate(self.decode(slot[3]))
+                ):
+                    self._remove(set_index, slot[2])
+
+    def clear(self) -> None:
+        self._bump(epoch=1)
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def shared_store() -> SharedStore:
+    """
+    The store at settings.shm_cache_path, with the regions of the shared caches of
+    auth.py
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SharedStore(
+                settings.shm_cache_path,
+                {
+                    "login": settings.login_cache_size,
+                    "roles": settings.roles_cache_size,
+                    "assignments": settings.roles_cache_size,
+                },
+                settings.shm_value_size,
+            )
+        return _store
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+
+from .dbsession import close, db, execute, settings
+from .model import AppStc_Paths
+
+logger = logging.getLogger(__name__)
+
+
+class StcTree:
+    """
+    Immutable in-memory index of the appstc hierarchy, built from appstc_paths.
+    Sorting the paths gives a pre-order traversal in which each subtree is a
+    contiguous interval, so checking whether a node is an ancestor of another is
+    two comparisons. The rank of each node by (depth, id_path) gives the "first"
+    of a set of nodes in the same order the database uses.
+    """
+
+    def __init__(self, paths: Iterable[tuple[int, tuple[int, ...]]]):
+        ordered = sorted(paths, key=lambda item: item[1])
+        self.start: dict[int, int] = {}
+        self.end: dict[int, int] = {}
+        stack: list[int] = []
+        for pos, (node, path) in enumerate(ordered):
+            # The stack holds the ancestors of the current node
+            while len(stack) >= len(path):
+                self.end[stack.pop()] = pos - 1
+            self.start[node] = pos
+            stack.append(node)
+        while stack:
+            self.end[stack.pop()] = len(ordered) - 1
+        self.rank = {
+            node: rank
+            for rank, (node, _) in enumerate(
+                sorted(ordered, key=lambda item: (len(item[1]), item[1]))
+            )
+        }
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __contains__(self, node: int) -> bool:
+        return node in self.start
+
+    def is_ancestor(self, ancestor: int, node: int) -> bool:
+        """
+        Whether `ancestor` is `node` itself or one of its parents
+        """
+        pos = self.start.get(node)
+        first = self.start.get(ancestor)
+        if pos is None or first is None:
+            return False
+        return first <= pos <= self.end[ancestor]
+
+    def resolve(
+        self, assigned: Iterable[int], requested: Optional[int]
+    ) -> Optional[int]:
+        """
+        The appstc used for a user assigned to the given nodes: The requested one
+        if the user is assigned to it or one of its parents, otherwise none. If none
+        is requested, the "first" of the assigned nodes.
+        """
+        if requested is not None:
+            if any(self.is_ancestor(node, requested) for node in assigned):
+                return requested
+            return None
+        known = [node for node in assigned if node in self.rank]
+        return min(known, key=self.rank.__getitem__) if known else None
+
+
+class StcIndex:
+    """
+    Holds the current StcTree. It is loaded in the background on first use and
+    whenever the tree changed (see invalidate()). While no valid tree is loaded,
+    get() returns None and callers need to ask the database. After
+    settings.stc_index_ttl seconds, it is reloaded while the old one is still used,
+    in case a change was not notified.
+    """
+
+    def __init__(self) -> None:
+        self.tree: Optional[StcTree] = None
+        self.generation = 0
+        # When the tree is to be reloaded (time.monotonic())
+        self.expires = 0.0
+        # The running load, if any. Referenced here so it is not garbage collected.
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[StcTree]:
+        """
+        Must be called from within the event loop, so loading can be started
+        """
+        tree = self.tree
+        if settings.stc_index and (tree is None or self.expires < time.monotonic()):
+            self._start()
+        return tree
+
+    async def load(self) -> Optional[StcTree]:
+        """
+        Wait until the tree is loaded, starting a load if none is running. Returns
+        None if loading failed or the tree was invalidated meanwhile.
+        """
+        if self.tree is None:
+            # Waiting is cancelled, not the load other callers might wait for
+            await asyncio.shield(self._start())
+        return self.tree
+
+    def _start(self) -> asyncio.Task:
+        with self._lock:
+            if self._task is None:
+                task = asyncio.get_running_loop().create_task(
+                    self._load(self.generation)
+                )
+                task.add_done_callback(self._done)
+                self._task = task
+            return self._task
+
+    def _done(self, task: asyncio.Task) -> None:
+        with self._lock:
+            if self._task is task:
+                self._task = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self.tree = None
+
+    async def _load(self, generation: int) -> None:
+        session = db.session()
+        try:
+            rows = await execute(session, select(AppStc_Paths.id, AppStc_Paths.id_path))
+            tree = StcTree((row.id, row.id_path) for row in rows)
+            with self._lock:
+                if generation == self.generation:
+                    self.tree = tree
+                    self.expires = time.monotonic() + settings.stc_index_ttl
+        except Exception:
+            logger.exception("Loading the appstc tree failed")
+        finally:
+            await close(session)
+
+
+stc_index = StcIndex()
@@ -4,8 +4,9 @@ from sqlalchemy import create_engine, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from ..app import app
+from ..auth import clear_caches
 from ..dbsession import settings
-from ..model import AppStc, AppUser, Base, View
+from ..model import AppStc, AppUser, Base, Derived
 
 
 @pytest.fixture
@@ -41,10 +42,8 @@ def session(connstr):
     # Create tables for each test
     Base.metadata.create_all(engine)
 
-    for view in View.__subclasses__():
-        name = view.__tablename__
-        defn = view.definition
-        session.execute(text(f"create or replace view {name} as {defn}"))
+    for derived in Derived.__subclasses__():
+        session.connection().exec_driver_sql(derived.ddl)
 
     root = AppStc(name="root")
     session.add_all([root])
@@ -56,19 +55,27 @@ def session(connstr):
     session.commit()
     SessionLocal.close()
 
-    for view in View.__subclasses__():
-        session.execute(text(f"drop view if exists {view.__tablename__} cascade"))
+    for derived in Derived.__subclasses__():
+        session.execute(text(f"drop table if exists {derived.__tablename__} cascade"))
     session.commit()
     Base.metadata.drop_all(engine)
 
 
-@pytest.fixture
-def client(connstr, session):
+@pytest.fixture(params=[False, True], ids=["sync", "async"])
+def client(request, connstr, session):
     """
     Return a FastAPI test client. Patches the settings to use the correct connection
     string and no pooling, so when the database is teared down and built up between
-    tests, we don't use any stale connections.
+    tests, we don't use any stale connections. Cached authentication data is
+    dropped, since IDs are reused when the database is rebuilt. The listener for
+    invalidations and the background loading of the appstc tree are disabled, they
+    would keep the database from being dropped.
+    Each test using the client runs with both the sync and the async database mode.
     """
     settings.connstr = connstr
     settings.pooling = False
+    settings.notify_listen = False
+    settings.stc_index = False
+    settings.async_db = request.param
+    clear_caches()
     return TestClient(app)
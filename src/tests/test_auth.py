@@ -1,5 +1,21 @@
-from sqlalchemy import func, select
+import asyncio
 
+import pytest
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.orm import Session
+
+from ..auth import (
+    COOKIE,
+    UserRef,
+    _apikey_cache,
+    _login_cache,
+    _LoginEntry,
+    _on_notify,
+    clear_caches,
+    forget_login,
+)
+from ..cache import digest
+from ..dbsession import db, settings
 from ..model import (
     AppGroup,
     AppPerm,
@@ -7,9 +23,13 @@ from ..model import (
     AppPermXStc,
     AppStc,
     AppUser,
+    AppUserKey,
+    AppUserLogin,
     AppUserXPerm,
     AppUserXStc,
 )
+from ..throttle import clear as clear_throttle
+from ..throttle import client_buckets, user_buckets
 
 wrong_pw = "12345"
 correct_pw = "1234"
@@ -52,6 +72,36 @@ def test_auth(client):
     assert response.json() == []
 
 
+@pytest.mark.parametrize("shared", [False, True])
+def test_throttle(client, monkeypatch, shared) -> None:
+    """
+    Failed login attempts beyond the burst of a username are rejected before the
+    password is checked, other usernames are not affected. Successful logins do not
+    count, rejected ones take no token of the client either.
+    """
+    monkeypatch.setattr(settings, "throttle_shared", shared)
+    monkeypatch.setattr(user_buckets, "burst", 2)
+    monkeypatch.setattr(client_buckets, "rate", 0.001)
+    monkeypatch.setattr(client_buckets, "burst", 6)
+
+    def attempt(username: str, password: str = wrong_pw) -> int:
+        if shared:
+            # Only the shared buckets count
+            clear_throttle()
+        return client.post(
+            "/login",
+            json={"username": username, "password": password},
+            headers={"sec-fetch-site": "same-origin"},
+        ).status_code
+
+    assert [attempt("test", correct_pw) for _ in range(3)] == [200, 200, 200]
+    assert [attempt("test") for _ in range(3)] == [401, 401, 429]
+    assert attempt("test", correct_pw) == 429
+    assert attempt("other") == 401
+    # Six attempts were admitted, which empties the bucket of the client
+    assert attempt("third") == 429
+
+
 def test_roles(client, session) -> None:
     """
     Set up a user that is assigned to two permission groups, but on two different
@@ -100,6 +150,14 @@ def test_roles(client, session) -> None:
     # are equal) is chosen.
     assert client.get("/roles").json() == ["A"]
 
+    # All at once, or only some of them
+    tree = [{"appstc_id": id, "roles": [name]} for name, id in appstc_ids.items()]
+    assert client.get("/roles/tree").json() == tree
+    response = client.get(
+        "/roles/tree", params={"ids": [appstc_ids["B"], root.id]}
+    ).json()
+    assert response == [{"appstc_id": appstc_ids["B"], "roles": ["B"]}]
+
     # Check that required_roles is checked correctly
     assert (
         client.post(
@@ -119,3 +177,194 @@ def test_roles(client, session) -> None:
     # Log out and check roles afterwards
     client.cookies = dict(client.post("/logout", headers=headers).cookies)
     assert client.get("/roles").json() == []
+
+
+def test_apikey(client, session) -> None:
+    """
+    Authenticate with an API key. The second request is served from the cache,
+    deleting the key invalidates it.
+    """
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    key = AppUserKey(appuser_id=user.id, key="ident-" + AppUser.encrypt_pw("secret"))
+    session.add(key)
+    session.commit()
+
+    headers = {"Authorization": "Apikey ident-secret"}
+    for _ in range(2):
+        response = client.get("/roles", headers=headers)
+        assert response.status_code == 200
+    wrong = {"Authorization": "Apikey ident-wrong"}
+    assert client.get("/roles", headers=wrong).status_code == 401
+
+    session.delete(key)
+    session.commit()
+    assert client.get("/roles", headers=headers).status_code == 401
+
+
+def test_apikey_user_change(client, session) -> None:
+    """
+    Cached keys of a user are kept if its password changes, e.g. when it is hashed
+    again on login, and dropped if it is renamed
+    """
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    session.add(AppUserKey(appuser_id=user.id, key="ident-" + user.encrypt_pw("key")))
+    session.commit()
+    assert client.get("/roles", headers={"Authorization": "Apikey ident-key"}).ok
+    assert len(_apikey_cache) == 1
+    user.password = user.encrypt_pw("other")
+    session.commit()
+    assert len(_apikey_cache) == 1
+    user.name = "renamed"
+    session.commit()
+    assert len(_apikey_cache) == 0
+
+
+def test_apikey_hmac(client, session, monkeypatch) -> None:
+    """
+    Keys created with a pepper are stored as HMAC. With migration enabled, an
+    argon2 key is converted when it is used and keeps working.
+    """
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    legacy = AppUserKey(appuser_id=user.id, key="old-" + AppUser.encrypt_pw("secret"))
+    monkeypatch.setattr(settings, "apikey_pepper", "pepper")
+    monkeypatch.setattr(settings, "apikey_migrate", True)
+    key, plain = AppUserKey.generate(user.id)
+    assert key.is_hmac
+    session.add_all([legacy, key])
+    session.commit()
+
+    assert client.get("/roles", headers={"Authorization": f"Apikey {plain}"}).ok
+    headers = {"Authorization": "Apikey old-secret"}
+    assert client.get("/roles", headers=headers).ok
+    session.refresh(legacy)
+    assert legacy.is_hmac
+    clear_caches()
+    assert client.get("/roles", headers=headers).ok
+
+
+def test_login_cache(client) -> None:
+    """
+    A cached login cookie is no longer accepted once the login ended
+    """
+    headers = {"sec-fetch-site": "same-origin"}
+    cookies = dict(
+        client.post(
+            "/login",
+            json={"username": "test", "password": correct_pw},
+            headers=headers,
+        ).cookies
+    )
+    client.cookies = cookies
+    for _ in range(2):
+        assert client.get("/roles").status_code == 200
+    client.post("/logout", headers=headers)
+    client.cookies = cookies
+    assert client.get("/roles").status_code == 401
+
+
+def test_forget_login_after_commit() -> None:
+    """
+    A login cached by a concurrent request before the logout committed is dropped
+    on commit
+    """
+    session = Session(create_engine("sqlite://"))
+    forget_login(5, session)
+    _login_cache.set(b"cookie", _LoginEntry(5, UserRef(1, "test")))
+    assert _login_cache.get(b"cookie") is not None
+    session.commit()
+    assert _login_cache.get(b"cookie") is None
+
+
+def test_notify_logins() -> None:
+    """
+    A notification about logins drops only the ones it lists
+    """
+    for login_id in (1, 2, 3):
+        _login_cache.set(str(login_id).encode(), _LoginEntry(login_id, UserRef(1, "")))
+    _on_notify("appuserlogin:1,2")
+    assert [_login_cache.get(k) is None for k in (b"1", b"2", b"3")] == [
+        True,
+        True,
+        False,
+    ]
+    clear_caches()
+
+
+def test_login_cache_nextcookie(client, session) -> None:
+    """
+    A login with a pending nextcookie is not cached until the user switched to it,
+    and the cookie sent back is always the one to use
+    """
+    headers = {"sec-fetch-site": "same-origin"}
+    cookie = client.post(
+        "/login",
+        json={"username": "test", "password": correct_pw},
+        headers=headers,
+    ).cookies[COOKIE]
+    login = session.execute(select(AppUserLogin)).scalar_one()
+    login.nextcookie = "next"
+    session.commit()
+    clear_caches()
+    for _ in range(2):
+        client.cookies = {COOKIE: cookie}
+        response = client.get("/roles")
+        assert response.status_code == 200
+        assert response.cookies[COOKIE] == "next"
+        assert _login_cache.get(digest(cookie)) is None
+    for _ in range(2):
+        client.cookies = {COOKIE: "next"}
+        response = client.get("/roles")
+        assert response.status_code == 200
+        assert response.cookies[COOKIE] == "next"
+        assert _login_cache.get(digest("next")) is not None
+    client.cookies = {COOKIE: cookie}
+    assert client.get("/roles").status_code == 401
+
+
+def test_replica(client, connstr, session, monkeypatch) -> None:
+    """
+    Use the test database as its own replica. Logins and API keys are read from
+    it while its lag is low enough, otherwise from the primary. What was read from
+    the replica is cached no longer than the allowed lag.
+    """
+    monkeypatch.setattr(settings, "replica_connstr", connstr)
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    session.add(AppUserKey(appuser_id=user.id, key="ident-" + user.encrypt_pw("key")))
+    session.commit()
+    headers = {"sec-fetch-site": "same-origin"}
+    client.cookies = dict(
+        client.post(
+            "/login",
+            json={"username": "test", "password": correct_pw},
+            headers=headers,
+        ).cookies
+    )
+    apikey = {"Authorization": "Apikey ident-key"}
+    statements: list[str] = []
+    try:
+        # Creates the monitor of the replica. It is stopped and given a lag, so the
+        # test does not depend on when it runs.
+        assert client.get("/roles").status_code == 200
+        monitor = db.replicas[settings.async_db]
+        monitor.stop()
+        monitor.lag = 0
+        engine = monitor.engine
+        event.listen(
+            getattr(engine, "sync_engine", engine),
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        # Read from the replica, they are cached no longer than the allowed lag
+        for max_lag, used in ((5, True), (0, True), (-1, False)):
+            monkeypatch.setattr(settings, "replica_max_lag", max_lag)
+            statements.clear()
+            clear_caches()
+            assert client.get("/roles").status_code == 200
+            assert any("appuserlogin" in s for s in statements) == used
+            cached = _login_cache.get(digest(client.cookies[COOKIE])) is not None
+            assert cached == (max_lag != 0)
+            assert client.get("/roles", headers=apikey).status_code == 200
+            assert any("appuserkey" in s for s in statements) == used
+            assert (_apikey_cache.get(digest("ident-key")) is not None) == cached
+    finally:
+        asyncio.run(db.dispose())
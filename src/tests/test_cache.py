@@ -0,0 +1,90 @@
+import time
+
+from ..cache import TTLCache, digest
+
+
+def test_lru_eviction() -> None:
+    """
+    If the cache is full, the least recently used entry is dropped
+    """
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl() -> None:
+    """
+    Entries expire after the TTL
+    """
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_capped() -> None:
+    """
+    An entry can be given a shorter TTL, but not a longer one
+    """
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1, ttl=0)
+    cache.set("b", 2, ttl=60)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+
+
+def test_discard_where() -> None:
+    cache: TTLCache[str, int] = TTLCache(maxsize=10, ttl=60)
+    for i in range(5):
+        cache.set(str(i), i)
+    cache.discard_where(lambda v: v % 2 == 0)
+    assert [cache.get(str(i)) for i in range(5)] == [None, 1, None, 3, None]
+
+
+def test_discard_tag() -> None:
+    """
+    Entries are removed by tag, also after being replaced or evicted
+    """
+    cache: TTLCache[str, int] = TTLCache(maxsize=3, ttl=60, tag=lambda v: v // 10)
+    cache.set("a", 10)
+    cache.set("b", 11)
+    cache.set("c", 20)
+    # Replacing moves the key to another tag
+    cache.set("b", 21)
+    cache.discard_tag(2)
+    assert [cache.get(k) for k in "abc"] == [10, None, None]
+    # Evicting removes the key from its tag
+    cache.set("d", 30)
+    cache.set("e", 31)
+    cache.set("f", 40)
+    assert cache.get("a") is None
+    cache.discard_tag(1)
+    cache.discard_tag(3)
+    assert len(cache) == 1
+    assert cache._tags == {4: {"f"}}
+
+
+def test_digest() -> None:
+    assert digest("secret") == digest("secret")
+    assert digest("secret") != digest("secret2")
+    assert b"secret" not in digest("secret")
+
+
+def test_generation() -> None:
+    """
+    A value computed before an invalidation is not stored
+    """
+    cache: TTLCache[str, int] = TTLCache(maxsize=10, ttl=60)
+    generation = cache.generation
+    cache.clear()
+    cache.set("a", 1, generation)
+    assert cache.get("a") is None
+    cache.set("a", 1, cache.generation)
+    assert cache.get("a") == 1
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+import argon2
+import pytest
+
+from ..dbsession import settings
+from ..hashing import (
+    HashingExecutor,
+    HashingOverloaded,
+    averify_hash,
+    hash_password,
+    hmac_hash,
+    needs_rehash,
+    verify_hmac,
+)
+
+
+def test_overload() -> None:
+    """
+    Operations beyond the worker count and queue depth are rejected right away
+    """
+    executor = HashingExecutor(workers=1, queue_depth=1)
+    release = threading.Event()
+    futures = [executor.submit(release.wait) for _ in range(2)]
+    with pytest.raises(HashingOverloaded):
+        executor.submit(release.wait)
+    release.set()
+    for future in futures:
+        assert future.result()
+
+
+def test_averify() -> None:
+    hash = hash_password("1234")
+    assert asyncio.run(averify_hash(hash, "1234"))
+    assert not asyncio.run(averify_hash(hash, "12345"))
+
+
+def test_needs_rehash() -> None:
+    """
+    Hashes with other parameters are still verified, but need to be rehashed
+    """
+    old = argon2.PasswordHasher(time_cost=1, memory_cost=1024).hash("1234")
+    assert asyncio.run(averify_hash(old, "1234"))
+    assert needs_rehash(old)
+    assert not needs_rehash(hash_password("1234"))
+
+
+def test_hmac(monkeypatch) -> None:
+    monkeypatch.setattr(settings, "apikey_pepper", "pepper")
+    stored = hmac_hash("secret")
+    assert verify_hmac(stored, "secret")
+    assert not verify_hmac(stored, "wrong")
+    monkeypatch.setattr(settings, "apikey_pepper", "other")
+    assert not verify_hmac(stored, "secret")
+    # Misconfigured, keys are rejected instead of failing the request
+    monkeypatch.setattr(settings, "apikey_pepper", "")
+    assert not verify_hmac(stored, "secret")
@@ -0,0 +1,91 @@
+import time
+from typing import Optional
+
+from sqlalchemy import select
+
+from ..auth import COOKIE, _login_cache, _roles_cache
+from ..cache import digest
+from ..dbsession import settings
+from ..listener import TRIGGERS, listener
+from ..model import (
+    AppGroup,
+    AppPerm,
+    AppPermXGroup,
+    AppPermXStc,
+    AppStc,
+    AppUser,
+    AppUserLogin,
+    AppUserXPerm,
+    AppUserXStc,
+)
+from ..stctree import StcTree, stc_index
+
+
+def test_notify(client, session, monkeypatch) -> None:
+    """
+    Changes made by another session reach the caches through the triggers and the
+    listener: A revoked permission drops the cached roles, an ended login its
+    cached cookie and a new appstc the tree
+    """
+    session.connection().exec_driver_sql(TRIGGERS)
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    root: AppStc = session.execute(select(AppStc)).scalar_one()
+    group = AppGroup(zoperole="A")
+    perm = AppPerm(name="A")
+    session.add_all([group, perm])
+    session.flush()
+    grant = AppUserXPerm(appuser_id=user.id, appperm_id=perm.id)
+    session.add_all(
+        [
+            grant,
+            AppUserXStc(appuser_id=user.id, appstc_id=root.id),
+            AppPermXGroup(appperm_id=perm.id, appgroup_id=group.id),
+            AppPermXStc(appperm_id=perm.id, appstc_id=root.id),
+        ]
+    )
+    session.commit()
+
+    payloads: list[Optional[str]] = []
+
+    def received(payload: Optional[str]) -> None:
+        deadline = time.monotonic() + 10
+        while payload not in payloads:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    monkeypatch.setattr(settings, "notify_listen", True)
+    listener.subscribe(payloads.append)
+    try:
+        listener.start()
+        # Connected, which clears everything once
+        received(None)
+        cookie = client.post(
+            "/login",
+            json={"username": "test", "password": "1234"},
+            headers={"sec-fetch-site": "same-origin"},
+        ).cookies[COOKIE]
+        client.cookies = {COOKIE: cookie}
+        assert client.get("/roles").json() == ["A"]
+        assert _roles_cache.get((user.id, root.id)) is not None
+        assert _login_cache.get(digest(cookie)) is not None
+
+        session.delete(grant)
+        session.commit()
+        received("appuserxperm")
+        assert _roles_cache.get((user.id, root.id)) is None
+        assert client.get("/roles").json() == []
+
+        login = session.execute(select(AppUserLogin)).scalar_one()
+        login.done = True
+        session.commit()
+        received(f"appuserlogin:{login.id}")
+        assert _login_cache.get(digest(cookie)) is None
+
+        stc_index.tree = StcTree([(root.id, (root.id,))])
+        session.add(AppStc(name="child", parent_appstc_id=root.id))
+        session.commit()
+        received("appstc")
+        assert stc_index.tree is None
+    finally:
+        listener.stop()
+        listener.callbacks.remove(payloads.append)
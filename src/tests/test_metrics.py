@@ -0,0 +1,29 @@
+from ..metrics import Histogram, finish_request, start_request, timed
+
+
+def test_histogram() -> None:
+    hist = Histogram("phase_seconds", "Test", (0.1, 1), "phase")
+    hist.observe(0.05, "auth")
+    hist.observe(0.5, "auth")
+    hist.observe(5, "auth")
+    lines = hist.render()
+    assert 'phase_seconds_bucket{phase="auth",le="0.1"} 1' in lines
+    assert 'phase_seconds_bucket{phase="auth",le="1"} 2' in lines
+    assert 'phase_seconds_bucket{phase="auth",le="+Inf"} 3' in lines
+    assert 'phase_seconds_count{phase="auth"} 3' in lines
+
+
+def test_server_timing() -> None:
+    timings = start_request()
+    with timed("auth"):
+        pass
+    with timed("auth"):
+        pass
+    finish_request(timings)
+    with timed("other"):
+        # Not part of the request anymore
+        pass
+    header = timings.server_timing()
+    assert header.startswith("auth;dur=")
+    assert 'queries;desc="0"' in header
+    assert "other" not in header
@@ -0,0 +1,102 @@
+from typing import Optional
+
+from sqlalchemy import delete, select, update
+
+from ..model import AppStc, AppStc_Paths, AppUser, AppUser_DefaultStc, AppUserXStc
+
+
+def test_appstc_paths(session) -> None:
+    """
+    The cached paths follow inserting, moving and deleting nodes
+    """
+    root = session.execute(select(AppStc)).scalar_one()
+    a = AppStc(name="a", parent_appstc_id=root.id)
+    b = AppStc(name="b", parent_appstc_id=root.id)
+    session.add_all([a, b])
+    session.flush()
+    c = AppStc(name="c", parent_appstc_id=a.id)
+    session.add(c)
+    session.flush()
+
+    def paths():
+        return dict(
+            session.execute(select(AppStc_Paths.id, AppStc_Paths.id_path)).all()
+        )
+
+    assert paths() == {
+        root.id: (root.id,),
+        a.id: (root.id, a.id),
+        b.id: (root.id, b.id),
+        c.id: (root.id, a.id, c.id),
+    }
+
+    a.parent_appstc_id = b.id
+    session.flush()
+    assert paths()[c.id] == (root.id, b.id, a.id, c.id)
+    depth = session.execute(
+        select(AppStc_Paths.depth).where(AppStc_Paths.id == c.id)
+    ).scalar_one()
+    assert depth == 4
+
+    session.delete(c)
+    session.flush()
+    assert c.id not in paths()
+
+
+def test_default_stc(session) -> None:
+    """
+    The default appstc of a user follows its assignments and moves of the tree, also
+    if one statement changes the assignments of several users
+    """
+    root = session.execute(select(AppStc)).scalar_one()
+    user = session.execute(select(AppUser)).scalar_one()
+    a = AppStc(name="a", parent_appstc_id=root.id)
+    session.add(a)
+    session.flush()
+    b = AppStc(name="b", parent_appstc_id=a.id)
+    session.add(b)
+    session.flush()
+
+    def default(of: Optional[AppUser] = None):
+        return session.execute(
+            select(AppUser_DefaultStc.appstc_id).where(
+                AppUser_DefaultStc.id == (of or user).id
+            )
+        ).scalar_one_or_none()
+
+    assert default() is None
+    assign_b = AppUserXStc(appuser_id=user.id, appstc_id=b.id)
+    session.add(assign_b)
+    session.flush()
+    assert default() == b.id
+    assign_a = AppUserXStc(appuser_id=user.id, appstc_id=a.id)
+    session.add(assign_a)
+    session.flush()
+    assert default() == a.id
+
+    # b is now higher up than a
+    b.parent_appstc_id = root.id
+    session.flush()
+    a.parent_appstc_id = b.id
+    session.flush()
+    assert default() == b.id
+
+    session.delete(assign_b)
+    session.flush()
+    assert default() == a.id
+
+    # Statements changing the assignments of several users at once
+    other = AppUser("other", "1234")
+    session.add(other)
+    session.flush()
+    session.add(AppUserXStc(appuser_id=other.id, appstc_id=root.id))
+    session.flush()
+    session.execute(
+        update(AppUserXStc)
+        .where(AppUserXStc.appuser_id == user.id)
+        .values(appuser_id=other.id)
+    )
+    assert default() is None
+    assert default(other) == root.id
+    session.execute(delete(AppUserXStc).where(AppUserXStc.appuser_id == other.id))
+    assert default(other) is None
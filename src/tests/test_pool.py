@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+from sqlalchemy import Engine, create_engine, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import NullPool
+
+from .. import dbsession
+from ..pool import MeteredQueuePool, PoolValidator, _EngineTask, pool_status
+
+
+def test_pool_status() -> None:
+    """
+    Checkouts and timeouts are counted
+    """
+    engine = create_engine(
+        "sqlite://",
+        poolclass=MeteredQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.01,
+    )
+    with engine.connect():
+        assert pool_status(engine.pool)["checked_out"] == 1
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+    status = pool_status(engine.pool)
+    assert status["checked_out"] == 0
+    assert status["checkouts"] == 2
+    assert status["timeouts"] == 1
+    assert status["max_wait_seconds"] >= 0.01
+
+    # Counters survive recreating the pool
+    engine.dispose()
+    assert pool_status(engine.pool)["checkouts"] == 2
+
+
+def test_validator_survives_errors() -> None:
+    """
+    An unexpected error in one check does not end the validation
+    """
+    calls: list[None] = []
+    done = threading.Event()
+
+    class Failing(PoolValidator):
+        def check(self, engine: Engine) -> None:
+            calls.append(None)
+            if len(calls) == 1:
+                raise OSError("unexpected")
+            done.set()
+
+        async def acheck(self, engine: AsyncEngine) -> None:
+            raise NotImplementedError
+
+    validator = Failing(create_engine("sqlite://"), 0.01)
+    validator.start()
+    try:
+        assert done.wait(5)
+    finally:
+        validator.stop()
+
+
+def test_engine_task_abstract() -> None:
+    """
+    A task missing one of the checks can not be created
+    """
+
+    class Partial(_EngineTask):
+        def check(self, engine: Engine) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Partial(create_engine("sqlite://"), 1)  # type: ignore[abstract]
+
+
+def test_prepare_from_env(monkeypatch) -> None:
+    """
+    Prepared statements can be disabled through the environment
+    """
+    monkeypatch.setenv("PREPARE", "false")
+    monkeypatch.setenv("PREPARE_THRESHOLD", "0")
+    monkeypatch.setattr(dbsession, "settings", dbsession.Settings())
+    kw = dbsession.db._engine_kw(NullPool)
+    assert kw["connect_args"] == {"prepare_threshold": None}
+    monkeypatch.setenv("PREPARE", "true")
+    monkeypatch.setattr(dbsession, "settings", dbsession.Settings())
+    kw = dbsession.db._engine_kw(NullPool)
+    assert kw["connect_args"] == {"prepare_threshold": 0}
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+
+from ..dbsession import settings
+from ..model import AppUser, AppUserLogin
+from ..retention import run_retention
+
+
+def test_retention(client, session, monkeypatch) -> None:
+    """
+    Old logins are ended, logins that ended long ago deleted, in batches smaller
+    than the number of affected logins. An old login that ended recently is kept.
+    """
+    monkeypatch.setattr(settings, "login_retention_days", 30)
+    monkeypatch.setattr(settings, "login_max_age_days", 7)
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    now = datetime.now(timezone.utc)
+    # Days since creation and since the end
+    ages = {
+        "new": (1, None),
+        "expired": (10, None),
+        "expired2": (10, None),
+        "old": (40, 35),
+        "ended": (40, 1),
+    }
+    for cookie, (days, ended) in ages.items():
+        session.add(
+            AppUserLogin(
+                appuser_id=user.id,
+                cookie=cookie,
+                done=ended is not None,
+                endtime=None if ended is None else now - timedelta(days=ended),
+                createtime=now - timedelta(days=days),
+            )
+        )
+    session.add(AppUserLogin(appuser_id=user.id, cookie=None, done=True))
+    session.commit()
+
+    assert asyncio.run(run_retention(batch_size=1, pause=0)) == (2, 1)
+    session.expire_all()
+    logins = session.execute(select(AppUserLogin)).scalars().all()
+    assert sorted((login.cookie or "", login.done) for login in logins) == [
+        ("", True),
+        ("", True),
+        ("", True),
+        ("ended", True),
+        ("new", False),
+    ]
+    assert all(login.endtime is not None for login in logins if login.done)
@@ -0,0 +1,59 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ..auth import AuthInfo, _process_auth, require_roles
+from ..roles import AllOf, AnyOf, Not, RoleRegistry, compile_requirement, registry
+
+
+def test_registry() -> None:
+    """
+    Each role gets its own bit, names are listed sorted
+    """
+    roles = RoleRegistry()
+    mask = roles.mask(["B", "A", "B"])
+    assert mask == 0b11
+    assert roles.bit("C") == 0b100
+    assert roles.names(mask | roles.bit("C")) == ["A", "B", "C"]
+
+
+def test_compile_requirement() -> None:
+    check = compile_requirement(AllOf("A", AnyOf("B", "C"), Not("D")))
+
+    def allowed(*roles: str) -> bool:
+        return check(registry.mask(roles))
+
+    assert allowed("A", "B")
+    assert allowed("A", "C")
+    assert not allowed("A")
+    assert not allowed("B", "C")
+    assert not allowed("A", "B", "D")
+
+
+def test_require_roles() -> None:
+    """
+    Both coroutine and plain endpoints are checked
+    """
+    app = FastAPI()
+
+    @app.get("/async")
+    @require_roles("Admin")
+    async def async_endpoint() -> str:
+        return "async"
+
+    @app.get("/sync")
+    @require_roles(AnyOf("Admin", "Manager"))
+    def sync_endpoint() -> str:
+        return "sync"
+
+    client = TestClient(app)
+    for roles, status in [(["Admin"], 200), (["Manager"], 403), ([], 403)]:
+        user = AuthInfo(id=1, name="test", role_mask=registry.mask(roles))
+        app.dependency_overrides[_process_auth] = lambda: user
+        assert client.get("/async").status_code == status
+    app.dependency_overrides[_process_auth] = lambda: AuthInfo(1, "test", 0)
+    response = client.get("/async")
+    assert response.json()["detail"]["missing"] == ["Admin"]
+    assert client.get("/sync").status_code == 403
+    manager = AuthInfo(1, "test", registry.mask(["Manager"]))
+    app.dependency_overrides[_process_auth] = lambda: manager
+    assert client.get("/sync").json() == "sync"
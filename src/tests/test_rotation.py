@@ -0,0 +1,48 @@
+import asyncio
+
+from sqlalchemy import select
+
+from ..auth import UserRef, _login_cache, _LoginEntry
+from ..dbsession import close, commit, db
+from ..model import AppCookieRotation, AppUser, AppUserLogin
+from ..rotation import run_rotation, start_rotation
+
+
+def test_rotation(client, session) -> None:
+    """
+    Rotate in batches smaller than the number of logins. Done logins and those
+    created after the start are skipped.
+    """
+    user: AppUser = session.execute(select(AppUser)).scalar_one()
+    logins = [AppUserLogin(appuser_id=user.id, cookie=str(i)) for i in range(5)]
+    logins[1].done = True
+    session.add_all(logins)
+    session.commit()
+
+    async def rotate() -> list[int]:
+        rotation_session = db.session()
+        await start_rotation(rotation_session)
+        await commit(rotation_session)
+        await close(rotation_session)
+        new = AppUserLogin(appuser_id=user.id, cookie="new")
+        session.add(new)
+        session.commit()
+        # Only the cached logins that were rotated are dropped
+        for key, login in ((b"0", logins[0]), (b"new", new)):
+            _login_cache.set(key, _LoginEntry(login.id, UserRef(user.id, "test")))
+        progress: list[int] = []
+        await run_rotation(
+            batch_size=2, pause=0, progress=lambda p: progress.append(p.rotated)
+        )
+        return progress
+
+    assert asyncio.run(rotate()) == [2, 4, 4]
+    assert _login_cache.get(b"0") is None
+    assert _login_cache.get(b"new") is not None
+    session.expire_all()
+    rotated = session.execute(
+        select(AppUserLogin.cookie).where(AppUserLogin.nextcookie.is_not(None))
+    ).scalars()
+    assert sorted(rotated) == ["0", "2", "3", "4"]
+    run = session.execute(select(AppCookieRotation)).scalar_one()
+    assert run.done and run.rotated == 4
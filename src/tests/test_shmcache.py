@@ -0,0 +1,129 @@
+import multiprocessing
+import time
+
+from ..roles import RoleRegistry
+from ..shmcache import WAYS, SharedStore, SharedTTLCache
+
+
+def make(path, slots: int = 64, ttl: float = 60) -> SharedTTLCache[str, str]:
+    store = SharedStore(str(path), {"test": slots}, 32)
+    return SharedTTLCache(
+        store, "test", ttl, str.encode, bytes.decode, tag=lambda value: len(value)
+    )
+
+
+def _set_in_other_process(path) -> None:
+    make(path).set("a", "from child")
+
+
+def _add_roles_in_other_process(path) -> None:
+    RoleRegistry(make(path).store.names).mask(["B", "C"])
+
+
+def test_shared(tmp_path) -> None:
+    """
+    Processes opening the same file see each other's entries and invalidations
+    """
+    path = tmp_path / "cache"
+    cache = make(path)
+    process = multiprocessing.get_context("spawn").Process(
+        target=_set_in_other_process, args=(path,)
+    )
+    process.start()
+    process.join()
+    assert cache.get("a") == "from child"
+    other = make(path)
+    other.clear()
+    assert cache.get("a") is None
+    assert cache.generation == other.generation == 1
+
+
+def test_operations(tmp_path) -> None:
+    cache = make(tmp_path / "cache")
+    cache.set("a", "1")
+    cache.set("b", "22")
+    cache.set("c", "x" * 33)  # Too large
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", "22", None)
+    assert len(cache) == 2
+    assert cache.pop("a") == "1"
+    assert cache.get("a") is None
+    cache.set("a", "1")
+    cache.discard_tag(2)
+    assert (cache.get("a"), cache.get("b")) == ("1", None)
+    cache.discard_where(lambda value: value == "1")
+    assert cache.get("a") is None
+
+
+def test_generation(tmp_path) -> None:
+    """
+    A value computed before an invalidation is not stored
+    """
+    cache = make(tmp_path / "cache")
+    generation = cache.generation
+    cache.pop("other")
+    cache.set("a", "1", generation)
+    assert cache.get("a") is None
+    cache.set("a", "1", cache.generation)
+    assert cache.get("a") == "1"
+
+
+def test_ttl_and_eviction(tmp_path) -> None:
+    """
+    Entries expire, and a full set replaces the entry that expires first
+    """
+    cache = make(tmp_path / "cache", slots=WAYS, ttl=0.05)
+    cache.set("old", "1")
+    time.sleep(0.06)
+    assert cache.get("old") is None
+    cache.ttl = 60
+    for i in range(WAYS + 1):
+        cache.set(str(i), str(i))
+    assert cache.get("0") is None
+    assert all(cache.get(str(i)) == str(i) for i in range(1, WAYS + 1))
+
+
+def test_torn_slot(tmp_path) -> None:
+    """
+    A slot whose content does not match its CRC, as seen while it is written, is
+    ignored
+    """
+    cache = make(tmp_path / "cache", slots=WAYS)
+    cache.set("a", "value")
+    mm = cache.store.mm
+    pos = mm.find(b"value", cache.region.data)
+    mm[pos] = ord("V")
+    assert cache.get("a") is None
+
+
+def test_layout_change(tmp_path) -> None:
+    """
+    A file with another layout is replaced
+    """
+    path = tmp_path / "cache"
+    make(path, slots=8).set("a", "1")
+    cache = make(path, slots=16)
+    assert cache.maxsize == 16
+    assert cache.get("a") is None
+    cache.set("a", "2")
+    assert make(path, slots=16).get("a") == "2"
+
+
+def test_shared_roles(tmp_path) -> None:
+    """
+    Registries on the same names give the same bits to the same roles, whichever
+    process added them first
+    """
+    path = tmp_path / "cache"
+    roles = RoleRegistry(make(path).store.names)
+    assert roles.bit("A") == 0b1
+    process = multiprocessing.get_context("spawn").Process(
+        target=_add_roles_in_other_process, args=(path,)
+    )
+    process.start()
+    process.join()
+    # A mask from the other process, with roles this one did not know yet
+    assert roles.names(0b110) == ["B", "C"]
+    assert roles.bit("C") == 0b100
+    other = RoleRegistry(make(path).store.names)
+    assert other.mask(["D", "A"]) == 0b1001
+    assert roles.bit("D") == 0b1000
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from ..auth import _assignments_cache, _cached_roles, _roles_cache
+from ..dbsession import settings
+from ..stctree import StcIndex, StcTree
+
+
+def test_stctree() -> None:
+    """
+    Ancestor checks and resolving the appstc for a user, on the tree
+    1 -> (2 -> (4, 5), 3 -> 6)
+    """
+    tree = StcTree(
+        [
+            (1, (1,)),
+            (2, (1, 2)),
+            (3, (1, 3)),
+            (4, (1, 2, 4)),
+            (5, (1, 2, 5)),
+            (6, (1, 3, 6)),
+        ]
+    )
+    assert tree.is_ancestor(1, 6)
+    assert tree.is_ancestor(2, 2)
+    assert tree.is_ancestor(2, 5)
+    assert not tree.is_ancestor(2, 6)
+    assert not tree.is_ancestor(5, 2)
+    assert not tree.is_ancestor(2, 7)
+
+    assert tree.resolve({2}, 5) == 5
+    assert tree.resolve({2, 6}, 3) is None
+    assert tree.resolve({2, 6}, 6) == 6
+    # Default is the one with the lowest depth, then by path
+    assert tree.resolve({4, 6, 3}, None) == 3
+    assert tree.resolve({6, 4}, None) == 4
+    assert tree.resolve(set(), None) is None
+
+
+def test_stcindex_task(monkeypatch) -> None:
+    """
+    The index keeps a reference to its load while it runs and drops it afterwards
+    """
+    monkeypatch.setattr(settings, "stc_index", True)
+    index = StcIndex()
+
+    async def load(generation: int) -> None:
+        index.tree = StcTree([(1, (1,))])
+        index.expires = time.monotonic() + 60
+
+    monkeypatch.setattr(index, "_load", load)
+
+    async def run() -> None:
+        assert index.get() is None
+        task = index._task
+        assert task is not None
+        # Only one load at a time
+        assert index.get() is None
+        assert index._task is task
+        await task
+        assert index._task is None
+        assert index.get() is not None
+
+    asyncio.run(run())
+
+
+def test_stcindex_load(monkeypatch) -> None:
+    """
+    load() waits for the tree, or returns None if it could not be loaded
+    """
+    index = StcIndex()
+    trees = [None, StcTree([(1, (1,))])]
+
+    async def load(generation: int) -> None:
+        index.tree = trees.pop(0)
+
+    monkeypatch.setattr(index, "_load", load)
+
+    async def run() -> None:
+        assert await index.load() is None
+        assert await index.load() is not None
+        assert index._task is None
+
+    asyncio.run(run())
+
+
+def test_stcindex_ttl(monkeypatch) -> None:
+    """
+    An expired tree is still returned while its reload runs
+    """
+    monkeypatch.setattr(settings, "stc_index", True)
+    index = StcIndex()
+    old = StcTree([(1, (1,))])
+    new = StcTree([(1, (1,)), (2, (1, 2))])
+    index.tree = old
+
+    async def load(generation: int) -> None:
+        index.tree = new
+        index.expires = time.monotonic() + 60
+
+    monkeypatch.setattr(index, "_load", load)
+
+    async def run() -> None:
+        assert index.get() is old
+        assert index._task is not None
+        await index._task
+        assert index.get() is new
+        assert index._task is None
+
+    asyncio.run(run())
+
+
+def test_cached_roles_unknown_node() -> None:
+    """
+    Nodes missing from the tree are resolved by the database, not as no roles
+    """
+    tree = StcTree([(1, (1,)), (2, (1, 2))])
+    _assignments_cache.set(10, frozenset({1}))
+    _roles_cache.set((10, 2), 0b1)
+    try:
+        assert _cached_roles(tree, 10, 2) == 0b1
+        assert _cached_roles(tree, 10, 3) is None
+        _assignments_cache.set(10, frozenset({1, 3}))
+        assert _cached_roles(tree, 10, None) is None
+    finally:
+        _assignments_cache.clear()
+        _roles_cache.clear()
@@ -0,0 +1,37 @@
+from ..throttle import TokenBuckets
+
+
+def test_token_buckets() -> None:
+    """
+    Each key has its own bucket, an empty one tells how long to wait
+    """
+    buckets = TokenBuckets(rate=0.5, burst=2, maxsize=10)
+    assert buckets.take("a") == 0
+    assert buckets.take("a") == 0
+    assert 1.9 < buckets.take("a") <= 2
+    assert buckets.take("b") == 0
+    assert TokenBuckets(rate=0, burst=0, maxsize=10).take("a") == 0
+
+
+def test_token_buckets_eviction() -> None:
+    """
+    Dropping the least recently used bucket makes it full again
+    """
+    buckets = TokenBuckets(rate=0.001, burst=1, maxsize=1)
+    assert buckets.take("a") == 0
+    assert buckets.take("a") > 0
+    assert buckets.take("b") == 0
+    assert buckets.take("a") == 0
+
+
+def test_token_buckets_debit() -> None:
+    """
+    Waiting does not take a token, a debit takes one even from an empty bucket
+    """
+    buckets = TokenBuckets(rate=0.5, burst=1, maxsize=10)
+    assert buckets.wait("a") == 0
+    assert buckets.wait("a") == 0
+    buckets.debit("a")
+    buckets.debit("a")
+    assert 3.9 < buckets.wait("a") <= 4
+    assert 3.9 < buckets.take("a") <= 4
@@ -0,0 +1,14 @@
+import time
+
+
+def test_ready(client) -> None:
+    """
+    /ready reports 503 until the warm-up started by the lifespan is done
+    """
+    assert client.get("/ready").status_code == 503
+    with client:
+        deadline = time.monotonic() + 10
+        while client.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    assert client.get("/ready").status_code == 503
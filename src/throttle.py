@@ -0,0 +1,264 @@
+"""
+Admission control in front of password and API key verification. Each attempt
+takes a token from the bucket of its client address. Logins also need a token in the
+bucket of the username, which is only taken if the password turns out to be wrong,
+so logging in regularly never locks out a user. The buckets refill at a configured
+rate up to a burst. An attempt finding a bucket empty is rejected with 429 before
+any database query or hashing, and then takes no token at all.
+How many verifications run or wait at the same time is bounded by the hashing
+executor, beyond that requests get 503 (see hashing.py).
+The buckets are kept per process. With settings.throttle_shared, an attempt
+admitted locally also takes its tokens from buckets in the unlogged table
+appthrottle (and a failed login its token), so the limits hold across all workers.
+Those buckets see the attempts of all workers, so one that is empty locally is empty
+there as well, and the local buckets still reject most of the excess without a
+round trip.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import Request
+from sqlalchemy import text
+
+from .dbsession import autocommit, close, db, execute, settings
+
+
+class Throttled(Exception):
+    """
+    Raised if an attempt exceeds the rate of one of its buckets. Mapped to 429 by the
+    app.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """
+    Token buckets by key, each holding up to `burst` tokens and refilling with `rate`
+    tokens per second. At most `maxsize` buckets are kept, dropping the least recently
+    used ones only makes them full again. A `rate` of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # Tokens and the time they were counted, by key
+        self._data: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, key: str) -> float:
+        """
+        Returns 0 if there is a token, otherwise the seconds until there will be one
+        """
+        return self._update(key, 0, False)
+
+    def take(self, key: str) -> float:
+        """
+        Take a token. Returns 0 if there was one, otherwise the seconds until there
+        will be one.
+        """
+        return self._update(key, 1, False)
+
+    def debit(self, key: str) -> None:
+        """
+        Take a token even if there is none, leaving the bucket in debt
+        """
+        self._update(key, 1, True)
+
+    def _update(self, key: str, cost: int, force: bool) -> float:
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._data.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0
+            if tokens >= 1 or force:
+                tokens -= cost
+            else:
+                wait = (1 - tokens) / self.rate
+            self._data[key] = (tokens, now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return wait
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+user_buckets = TokenBuckets(
+    settings.throttle_user_rate, settings.throttle_user_burst, settings.throttle_size
+)
+client_buckets = TokenBuckets(
+    settings.throttle_client_rate,
+    settings.throttle_client_burst,
+    settings.throttle_size,
+)
+
+# Takes `cost` tokens from each of the given buckets if all of them have a token,
+# otherwise none. Returns the empty buckets with their tokens. The existing buckets
+# are locked in the order of their keys, so concurrent statements do not deadlock,
+# missing ones are full.
+_TAKE = text(
+    """
+    with b (key, rate, burst, cost) as (
+      select *
+      from unnest(
+        cast(:keys as text[]),
+        cast(:rates as float8[]),
+        cast(:bursts as float8[]),
+        cast(:costs as float8[])
+      )
+    ),
+    current as (
+      select
+        t.key,
+        least(
+          b.burst, t.tokens + extract(epoch from now() - t.updated) * b.rate
+        ) as tokens
+      from appthrottle as t
+      join b on b.key = t.key
+      order by t.key
+      for update of t
+    ),
+    empty as (
+      select key, tokens from current where tokens < 1
+    ),
+    updated as (
+      update appthrottle as t
+      set
+        tokens = current.tokens - b.cost,
+        rate = b.rate,
+        burst = b.burst,
+        updated = now()
+      from current
+      join b on b.key = current.key
+      where t.key = current.key and b.cost > 0 and not exists (select from empty)
+    ),
+    inserted as (
+      insert into appthrottle (key, tokens, rate, burst, updated)
+      select key, burst - cost, rate, burst, now()
+      from b
+      where
+        cost > 0
+        and not exists (select from empty)
+        and key not in (select key from current)
+      on conflict (key) do nothing
+    )
+    select key, tokens from empty
+    """
+)
+
+# Takes a token from the bucket even if it has none
+_DEBIT = text(
+    """
+    insert into appthrottle as t (key, tokens, rate, burst, updated)
+    values (:key, cast(:burst as float8) - 1, :rate, :burst, now())
+    on conflict (key) do update
+    set
+      tokens = least(
+        excluded.burst,
+        t.tokens + extract(epoch from now() - t.updated) * excluded.rate
+      ) - 1,
+      rate = excluded.rate,
+      burst = excluded.burst,
+      updated = now()
+    """
+)
+
+# Buckets that are full again are the same as no bucket
+PRUNE = text(
+    """
+    delete from appthrottle
+    where updated + make_interval(secs => (burst - tokens) / rate) < now()
+    """
+)
+
+
+async def _take_shared(buckets: dict[str, tuple[TokenBuckets, int]]) -> float:
+    """
+    Take the tokens from the shared buckets, or none if one of them is empty. Runs in
+    its own session in autocommit mode, so the rows are only locked for the
+    statement.
+    """
+    session = db.session()
+    try:
+        await autocommit(session)
+        result = await execute(
+            session,
+            _TAKE,
+            {
+                "keys": list(buckets),
+                "rates": [b.rate for b, _ in buckets.values()],
+                "bursts": [b.burst for b, _ in buckets.values()],
+                "costs": [cost for _, cost in buckets.values()],
+            },
+        )
+        empty = result.all()
+    finally:
+        await close(session)
+    return max(
+        ((1 - row.tokens) / buckets[row.key][0].rate for row in empty), default=0.0
+    )
+
+
+async def admit(request: Request, username: Optional[str] = None) -> None:
+    """
+    Take the token of the client for an attempt to verify a password or key, raising
+    Throttled if it or the bucket of the username has none. Call failed() once the
+    password turned out to be wrong.
+    """
+    # The bucket and the tokens to take from it, by key
+    buckets: dict[str, tuple[TokenBuckets, int]] = {}
+    if request.client is not None and client_buckets.rate > 0:
+        buckets[f"client:{request.client.host}"] = (client_buckets, 1)
+    if username is not None and user_buckets.rate > 0:
+        buckets[f"user:{username.lower()}"] = (user_buckets, 0)
+    # Only a single bucket is taken from, after all were checked
+    wait = max((b.wait(key) for key, (b, _) in buckets.items()), default=0.0)
+    if not wait:
+        wait = max(
+            (b.take(key) for key, (b, cost) in buckets.items() if cost), default=0.0
+        )
+    if not wait and buckets and settings.throttle_shared:
+        wait = await _take_shared(buckets)
+    if wait:
+        raise Throttled(math.ceil(wait))
+
+
+async def failed(username: str) -> None:
+    """
+    Take the token of a failed login from the bucket of the username
+    """
+    if user_buckets.rate <= 0:
+        return
+    key = f"user:{username.lower()}"
+    user_buckets.debit(key)
+    if not settings.throttle_shared:
+        return
+    session = db.session()
+    try:
+        await autocommit(session)
+        await execute(
+            session,
+            _DEBIT,
+            {"key": key, "rate": user_buckets.rate, "burst": user_buckets.burst},
+        )
+    finally:
+        await close(session)
+
+
+def clear() -> None:
+    """
+    Forget the local buckets
+    """
+    user_buckets.clear()
+    client_buckets.clear()
@@ -0,0 +1,83 @@
+"""
+Roles of a user in every appstc it can access, so a client drawing the tree does not
+need to call /roles for each node. One query computes them for all nodes: The nodes
+accessible are the ones the user is assigned to and everything below them, and the
+roles in a node are the ones granted on the node or any of its ancestors. Both use
+appstc_paths, like the roles in _AUTH_QUERY (see auth.py).
+"""
+
+import json
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import text
+
+from .dbsession import close, db, stream
+
+# Rows per chunk of the response
+CHUNK = 1000
+
+_TREE_ROLES = text(
+    """
+    with accessible as (
+      select distinct
+        node.id,
+        node.id_path
+      from appuserxstc
+      join appstc_paths as node
+        on node.id_path @> array[appuserxstc_appstc_id]
+      where appuserxstc_appuser_id = :appuser_id
+        and (
+          cast(:ids as bigint[]) is null
+          or node.id = any(cast(:ids as bigint[]))
+        )
+    ),
+    granted as (
+      select
+        apppermxstc_appstc_id as appstc_id,
+        appgroup_zoperole as role
+      from appuserxperm
+      join apppermxgroup
+        on apppermxgroup_appperm_id = appuserxperm_appperm_id
+      join appgroup
+        on appgroup_id = apppermxgroup_appgroup_id
+      join apppermxstc
+        on apppermxstc_appperm_id = appuserxperm_appperm_id
+      where appuserxperm_appuser_id = :appuser_id
+    )
+    select
+      accessible.id as appstc_id,
+      coalesce(
+        array_agg(distinct granted.role) filter (where granted.role is not null),
+        '{}'
+      ) as roles
+    from accessible
+    left join granted
+      on granted.appstc_id = any(accessible.id_path)
+    group by accessible.id
+    order by accessible.id
+    """
+)
+
+
+async def tree_roles(appuser_id: int, ids: Optional[list[int]]) -> AsyncIterator[str]:
+    """
+    JSON array of {"appstc_id": ..., "roles": [...]} for the accessible nodes, or
+    only those of them in `ids`, in chunks as the rows are fetched. Reads from the
+    replica if possible, in a session of its own that lasts while the response is
+    streamed.
+    """
+    session = db.replica_session() or db.session()
+    try:
+        yield "["
+        separator = ""
+        params = {"appuser_id": appuser_id, "ids": ids}
+        async for rows in stream(session, _TREE_ROLES, params, CHUNK):
+            parts = []
+            for row in rows:
+                item = {"appstc_id": row.appstc_id, "roles": row.roles}
+                parts.append(separator + json.dumps(item))
+                separator = ","
+            yield "".join(parts)
+        yield "]"
+    finally:
+        await close(session)
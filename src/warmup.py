@@ -0,0 +1,72 @@
+"""
+Warm-up of a worker before it takes traffic. Started from the lifespan of the app,
+it creates the engine and opens settings.pool_warm_size connections, runs the
+statements of the authentication phase on each of them, starts the hashing threads,
+the listener and the replica monitor and waits for the appstc index. Until then,
+/ready reports 503, so a load balancer only sends requests to warm workers.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from .auth import warm_up_queries
+from .dbsession import close, db, settings
+from .hashing import DUMMY_HASH, averify_hash
+from .listener import listener
+from .stctree import stc_index
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_up() -> None:
+    count = min(settings.pool_warm_size, settings.pool_size) if settings.pooling else 1
+    # All sessions are open at the same time, so each gets its own connection,
+    # which goes back to the pool when it is closed
+    sessions = [db.session() for _ in range(max(count, 1))]
+    try:
+        await asyncio.gather(*(warm_up_queries(session) for session in sessions))
+    finally:
+        await asyncio.gather(*(close(session) for session in sessions))
+    await averify_hash(DUMMY_HASH, "")
+    listener.start()
+    replica = db.replica_session()
+    if replica is not None:
+        await close(replica)
+    if settings.stc_index and await stc_index.load() is None:
+        raise RuntimeError("The appstc tree could not be loaded")
+
+
+class Readiness:
+    """
+    Runs the warm-up as a task on the event loop of the app, retrying until it
+    succeeds. `ready` is set once it did and cleared again on shutdown.
+    """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await warm_up()
+            except Exception:
+                logger.exception("Warm-up failed")
+                await asyncio.sleep(settings.warmup_retry_interval)
+            else:
+                self.ready = True
+                return
+
+
+readiness = Readiness()